@@ -5,6 +5,8 @@ from dcanalysis import *
 from symbolicdc import *
 from analysis_ss import *
 from nportanalysis import *
+from opstore import OperatingPointStore
 import symbolic
 import numeric
+import sparse
 
@@ -63,6 +63,9 @@ class CircuitResult(IVResultDict, InternalResultDict):
 def remove_row_col(matrices, n, toolkit):
     result = []
     for A in matrices:
+        if A is None:
+            result.append(A)
+            continue
         for axis in range(len(A.shape)):
             A=toolkit.delete(A, [n], axis=axis)
         result.append(A)
@@ -96,8 +99,20 @@ class Analysis(sim.Analysis):
         self.result = None
         self.epar = epar
 
+    def create_solver(self):
+        """Return a linear solver object from the toolkit or None
+        
+        The solver is kept by the analysis and reused between Newton 
+        iterations so that the factorization of the Jacobian can be 
+        reused by the chord method.
+        """
+        if hasattr(self.toolkit, 'LinearSolver'):
+            return self.toolkit.LinearSolver()
+
 def fsolve(f, x0, args=(), full_output=False, maxiter=200,
-           xtol=1e-6, reltol=1e-4, abstol=1e-12, toolkit='Numeric'):
+           xtol=1e-6, reltol=1e-4, abstol=1e-12, toolkit='Numeric',
+           solver=None, limit=None, maxdamp=8, chord=False, reuse=False,
+           contraction=0.3):
     """Solve a multidimensional non-linear equation with Newton-Raphson's method
 
     In each iteration the linear system
@@ -105,32 +120,132 @@ def fsolve(f, x0, args=(), full_output=False, maxiter=200,
     M{J(x_n)(x_{n+1}-x_n) + F(xn) = 0
 
     is solved and a new value for x is obtained x_{n+1}
-    
+
+    The linear system is solved by the solve method of the *solver* 
+    object if given, which keeps the factorization for the chord method 
+    below. Otherwise toolkit.linearsolver is used.
+
+    The Newton step is first limited by the *limit* function if given, 
+    which is called as limit(xnew, xold) and returns the limited x. If the 
+    norm of the residual increases the step is then halved up to *maxdamp*
+    times.
+
+    With *chord* set and a solver that has a resolve method the 
+    factorization of the Jacobian is kept between iterations (the chord or
+    modified Newton method). The function is then called as 
+    f(x, jacobian=False) when the Jacobian isn't needed and may return 
+    None instead of it. A new Jacobian is evaluated and factorized when 
+    the update decreases less than a factor *contraction* per iteration 
+    or the step was limited or damped. If *reuse* is also set the 
+    factorization that the solver has from an earlier call is used in 
+    the first iteration.
+
+    The iteration has converged when the weighted RMS norm of the update 
+    and the update was not limited, or the weighted RMS norm of the residual,
+    is less than one. The update is weighted by reltol*|x| + xtol and the 
+    residual by reltol*max(|F|) + abstol.
+
+    The infodict output contains the number of iterations (niter), 
+    function evaluations (nfev), Jacobian factorizations (nfactor), limited
+    steps (nlimit) and damped steps (ndamp), the final residual (fvec) and
+    the iterate with the smallest residual norm (xbest).
+
+    >>> def f(x): return numeric.array([x[0]**2 - 4]), numeric.array([[2*x[0]]])
+    >>> x, infodict, ier, mesg = fsolve(f, numeric.array([1.]), 
+    ...                                 full_output=True, toolkit=numeric)
+    >>> print x, mesg, infodict['niter']
+    [ 2.] Success 5
+
+    A residual that is not a number also damps the step
+
+    >>> def f(x): 
+    ...     if x[0] <= 0: return numeric.array([float('nan')]), None
+    ...     return numeric.array([numeric.log(x[0])]), numeric.array([[1/x[0]]])
+    >>> x, infodict, ier, mesg = fsolve(f, numeric.array([3.]), 
+    ...                                 full_output=True, toolkit=numeric)
+    >>> print x, mesg, infodict['ndamp']
+    [ 1.] Success 1
+
     """
+    if solver is None:
+        linearsolver = toolkit.linearsolver
+    else:
+        linearsolver = solver.solve
+
+    chord = chord and hasattr(solver, 'resolve')
+
+    def wrms(e):
+        if len(e) == 0:
+            return 0
+        return toolkit.sqrt(toolkit.dot(e, e) / len(e))
+
+    infodict = {'niter': 0, 'nfev': 0, 'nfactor': 0, 'nlimit': 0, 'ndamp': 0}
+
+    def evaluate(x, jacobian=True):
+        infodict['nfev'] += 1
+        if chord:
+            return f(x, *args, jacobian=jacobian)
+        return f(x, *args)
     
-    converged = False
     ier = 2
+    # TODO: Make sure J is never 0, e.g. by gmin (stepping)
+    F, J = evaluate(x0, not (reuse and chord and solver.factorized))
+    xbest, Fbest = x0, wrms(F)
+    lastnorm = None
     for i in xrange(maxiter):
-        F, J = f(x0, *args) # TODO: Make sure J is never 0, e.g. by gmin (stepping)
-        xdiff = toolkit.linearsolver(J, -F)# TODO: Limit xdiff to improve convergence
+        infodict['niter'] += 1
+        if J is None:
+            xdiff = solver.resolve(-F)
+        else:
+            xdiff = linearsolver(J, -F)
+            infodict['nfactor'] += 1
 
         x = x0 + xdiff
+        limited = False
+        if limit is not None:
+            x = limit(x, x0)
+            limited = not toolkit.alltrue(x == x0 + xdiff)
+            infodict['nlimit'] += limited
 
-        if toolkit.alltrue(abs(xdiff) < reltol * toolkit.maximum(x, x0) + xtol):
-            ier = 1
-            mesg = "Success"
-            break
-        if toolkit.alltrue(abs(F) < reltol * max(F) + abstol):
+        xerr = (x - x0) / (reltol * toolkit.maximum(abs(x), abs(x0)) + xtol)
+
+        ## Refresh the Jacobian when the chord iteration converges slowly
+        norm = wrms(xerr)
+        jacobian = not chord or limited or \
+            (lastnorm is not None and norm > contraction * lastnorm)
+        lastnorm = norm
+
+        Fnew, Jnew = evaluate(x, jacobian)
+
+        ## Damp the step while the residual increases
+        for damp in xrange(maxdamp):
+            if wrms(Fnew) <= wrms(F):
+                break
+            x = x0 + 0.5 * (x - x0)
+            Fnew, Jnew = evaluate(x)
+            infodict['ndamp'] += 1
+            limited = True
+
+        if limited:
+            xerr = (x - x0) / (reltol * toolkit.maximum(abs(x), abs(x0)) + 
+                               xtol)
+        Ferr = Fnew / (reltol * max(abs(Fnew)) + abstol)
+
+        x0, F, J = x, Fnew, Jnew
+
+        if wrms(F) < Fbest:
+            xbest, Fbest = x, wrms(F)
+
+        if (wrms(xerr) < 1 and not limited) or wrms(Ferr) < 1:
             ier = 1
             mesg = "Success"
             break
-            
-        x0 = x
 
     if ier == 2:
         mesg = "No convergence. xerror = "+str(xdiff)
     
-    infodict = {}
+    infodict['fvec'] = F
+    infodict['xbest'] = xbest
     if full_output:
         return x, infodict, ier, mesg
     else:
@@ -15,6 +15,8 @@ from pycircuit.circuit.dcanalysis import DC
 
 import numeric
 import types
+import threading
+from collections import OrderedDict
 
 
 class CircuitResultAC(CircuitResult):
@@ -40,7 +42,11 @@ class SSAnalysis(Analysis):
     parameters = [Parameter(name='analysis', desc='Analysis name', default='ss'),
                    Parameter(name='dcx', desc='Provided DC-solution vector', 
                              unit='', 
-                             default=None)]
+                             default=None),
+                   Parameter(name='opcache', 
+                             desc='OperatingPointCache of dc solutions, '
+                             'default is the cache of an enclosing with '
+                             'statement if any', unit='', default=None)]
 
     def __init__(self, cir, toolkit=None, **kvargs):    
         self.parameters = super(SSAnalysis, self).parameters + self.parameters            
@@ -49,7 +55,7 @@ class SSAnalysis(Analysis):
 
     def ss_map_function(self, func, ss, refnode):
         """Apply a function over a list of frequencies or a single frequency"""
-        irefnode = self.cir.nodes.index(refnode)
+        irefnode = self.cir.get_node_index(refnode)
 
         def myfunc(s):
             x = func(s)
@@ -66,7 +72,8 @@ class SSAnalysis(Analysis):
         return dc_steady_state(self.cir, freqs, refnode, self.toolkit, 
                                complexfreq = complexfreq, u = u, 
                                analysis=self.par.analysis,
-                               epar=self.epar,x0=self.par.dcx)
+                               epar=self.epar,x0=self.par.dcx,
+                               opcache=self.par.opcache)
 
 class AC(SSAnalysis):
     """
@@ -306,7 +313,7 @@ class Noise(SSAnalysis):
 
     def noise_map_function(self, func, ss, refnode):
         """Apply a function over a list of frequencies or a single frequency"""
-        irefnode = self.cir.nodes.index(refnode)
+        irefnode = self.cir.get_node_index(refnode)
 
         def myfunc(s):
             x, g = func(s)
@@ -373,7 +380,7 @@ class Noise(SSAnalysis):
             
         ## Refer the voltages to the gnd node by removing
         ## the rows and columns that corresponds to this node
-        irefnode = self.cir.nodes.index(refnode)
+        irefnode = self.cir.get_node_index(refnode)
         G,C,CY,u = remove_row_col((G,C,CY,u), irefnode, tk)
         
         xn2out, gain = self.noise_map_function(noisesolve, ss, refnode)
@@ -400,9 +407,111 @@ class Noise(SSAnalysis):
         return result
 
 
+class OperatingPointCache(object):
+    """Cache of dc operating points and linearized circuit matrices
+
+    The entries are keyed by the hashkey of the circuit, the environment 
+    parameters and the reference node. Each entry is a dictionary with the 
+    dc solution x, the G and C matrices at x and the CY matrices keyed by 
+    frequency. At most *maxsize* entries and *maxfreqs* CY matrices per 
+    entry are kept, the least recently used is dropped first.
+
+    The cache is only used by the small-signal analyses it is given to by
+    the opcache parameter, or inside a with statement where it is used 
+    by all of them. The entries are cleared when the with statement exits.
+    A cached operating point is only correct if the hashkey of all elements
+    includes all their state.
+
+    The *stats* attribute counts the number of hits and misses.
+
+    >>> from pycircuit.circuit import numeric
+    >>> c = SubCircuit()
+    >>> c['is'] = IS(gnd, 1, i=1e-3)
+    >>> c['D'] = Diode(1, gnd)
+    >>> cache = OperatingPointCache()
+    >>> entry = cache.entry(c, defaultepar, gnd)
+    >>> entry['x'] = None
+    >>> cache.entry(c, defaultepar, gnd) is entry
+    True
+    >>> c['D'].ipar.IS = 2e-14
+    >>> cache.entry(c, defaultepar, gnd) is entry
+    False
+    >>> cache.stats
+    {'miss': 2, 'hit': 1}
+
+    """
+    def __init__(self, maxsize=16, maxfreqs=4):
+        self.maxsize = maxsize
+        self.maxfreqs = maxfreqs
+        self.entries = OrderedDict()
+        self.stats = {'hit': 0, 'miss': 0}
+
+    def __enter__(self):
+        _active_opcaches().append(self)
+        return self
+
+    def __exit__(self, *args):
+        _active_opcaches().remove(self)
+        self.clear()
+
+    def clear(self):
+        self.entries.clear()
+
+    def key(self, cir, epar, refnode):
+        return (cir.hashkey(), pycircuit.circuit.circuit.hashable_params(epar),
+                cir.get_node_index(refnode))
+
+    def entry(self, cir, epar, refnode):
+        """Return the entry of the circuit, a new entry is empty"""
+        key = self.key(cir, epar, refnode)
+
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.stats['miss'] += 1
+            entry = {'CY': OrderedDict()}
+            while len(self.entries) >= self.maxsize:
+                self.entries.popitem(last=False)
+        else:
+            self.stats['hit'] += 1
+
+        self.entries[key] = entry
+        return entry
+
+    def CY(self, entry, cir, x, w, epar):
+        """Return the CY matrix of an entry at frequencies w"""
+        wkey = pycircuit.circuit.circuit.hashable(numeric.array(w))
+        CYs = entry['CY']
+        CY = CYs.pop(wkey, None)
+        if CY is None:
+            CY = cir.CY(x, w, epar)
+            while len(CYs) >= self.maxfreqs:
+                CYs.popitem(last=False)
+        CYs[wkey] = CY
+        return CY
+
+## Operating point caches of enclosing with statements of each thread
+_opcaches = threading.local()
+
+def _active_opcaches():
+    if not hasattr(_opcaches, 'stack'):
+        _opcaches.stack = []
+    return _opcaches.stack
+
+def active_opcache():
+    """Return the cache of the innermost with statement or None"""
+    stack = _active_opcaches()
+    if len(stack) > 0:
+        return stack[-1]
+
 def dc_steady_state(cir, freqs, refnode, toolkit, complexfreq = False, 
-                    analysis='ac', u = None, epar=defaultepar, x0=None):
-    """Return G,C,CY,u matrices at dc steady-state and complex frequencies"""
+                    analysis='ac', u = None, epar=defaultepar, x0=None,
+                    opcache=None):
+    """Return G,C,CY,u matrices at dc steady-state and complex frequencies
+
+    When the dc solution is calculated the operating point and the 
+    linearized matrices are looked up in *opcache* first, or in the 
+    cache of an enclosing with statement (see OperatingPointCache).
+    """
 
     n = cir.n
 
@@ -411,23 +520,43 @@ def dc_steady_state(cir, freqs, refnode, toolkit, complexfreq = False,
     else:
         ss = 2j*toolkit.pi*freqs
 
-    if x0 is None:
-        if toolkit.symbolic:
-            x=None
-        else:
-        #x = zeros(n) ## FIXME, this should be calculated from the dc analysis
-            resdc=DC(cir).solve()
-            x = resdc.x
+    if opcache is None:
+        opcache = active_opcache()
+
+    entry = None
+    if x0 is None and not toolkit.symbolic and opcache is not None:
+        entry = opcache.entry(cir, epar, refnode)
+
+    if entry is not None and 'x' in entry:
+        x, G, C = entry['x'], entry['G'], entry['C']
     else:
-        x = x0 #provide the DC steady-state FIXME: need to add parameter to AC
+        if x0 is None:
+            if toolkit.symbolic:
+                x=None
+            else:
+                resdc=DC(cir, epar=epar).solve()
+                x = resdc.x
+        else:
+            x = x0 #provide the DC steady-state
+
+        G = cir.G(x, epar)
+        C = cir.C(x, epar)
+
+        if entry is not None:
+            entry.update(x=x, G=G, C=C)
 
-    G = cir.G(x, epar)
-    C = cir.C(x, epar)
-    CY = cir.CY(x, toolkit.imag(ss), epar)
+    w = toolkit.imag(ss)
+    if entry is not None:
+        CY = opcache.CY(entry, cir, x, w, epar)
+
+        ## The analyses may modify the matrices 
+        x, G, C, CY = [A.copy() for A in (x, G, C, CY)]
+    else:
+        CY = cir.CY(x, w, epar)
 
     ## Allow for custom stimuli, mainly used by other analyses
     if u == None:
-        u = cir.u(x, analysis=analysis, epar=epar)
+        u = cir.u(0, analysis=analysis, epar=epar)
 
     return G, C, CY, u, x, ss
 
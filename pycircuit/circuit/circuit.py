@@ -4,26 +4,42 @@
 
 from pycircuit.utilities.param import Parameter, ParameterDict#, EvalError
 from pycircuit.utilities.misc import indent, inplace_add_selected, \
-    inplace_add_selected_2d, create_index_vectors
+    inplace_add_selected_2d, create_index_vectors, batch_notifications
 from copy import copy
 import types
 import numeric
 import numpy as np
+import scipy.sparse
 
 default_toolkit = numeric
 
 timedomain_analyses = ('dc', 'tran')
 
+## Analyses where u is evaluated repeatedly at the same time and is cached
+constant_u_analyses = ('dc', 'ac')
+
 class Node(object):
-    """A Node object represents a point in an electric circuit"""
+    """A Node object represents a point in an electric circuit
+
+    The node names are interned as large netlists contain many nodes with 
+    the same name, e.g. the terminal nodes of the elements.
+    """
+    __slots__ = ('name', 'isglobal')
+
     def __init__(self, name=None, isglobal = False):
         if name.endswith('!'):
             name = name[:-1]
             isglobal = True
+
+        if type(name) is str:
+            name = intern(name)
             
         self.name = name
         self.isglobal = isglobal
 
+    def __reduce__(self):
+        return self.__class__, (self.name, self.isglobal)
+
     def __hash__(self): return hash(self.name)
 
     def __eq__(self, a): 
@@ -59,6 +75,8 @@ class Branch(object):
     plus to minus.a
     
     """
+    __slots__ = ('plus', 'minus', 'name')
+
     def __init__(self, plus, minus, name=None):
         """Initiate a branch
 
@@ -75,6 +93,9 @@ class Branch(object):
         self.minus = minus
         self.name = name
 
+    def __reduce__(self):
+        return self.__class__, (self.plus, self.minus, self.name)
+
     def __hash__(self): return hash(self.plus) ^ hash(self.minus)
 
     def __eq__(self, a): 
@@ -147,7 +168,9 @@ class Circuit(object):
 
         *linear* 
           A boolean value that is true if i(x) and q(x) are linear 
-          functions
+          functions. The default is False, an element that sets it to True
+          gets its G and C matrices evaluated only once by compiled 
+          circuits.
 
     """
 
@@ -156,7 +179,13 @@ class Circuit(object):
     branches = []
     terminals = []
     instparams = []
-    linear = True
+    linear = False
+
+    ## Hashed node and branch to index maps, created when needed
+    _indexmaps = None
+
+    ## Lists shorter than this are searched linearly
+    _indexmap_minsize = 16
     
     def __init__(self, *args, **kvargs):
         if 'toolkit' in kvargs:
@@ -217,6 +246,32 @@ class Circuit(object):
     def _ipar_changed(self, subject):
         self.update_iparv(ignore_errors=True)
 
+    def batch_update(self):
+        """Return a context manager that coalesces parameter updates
+
+        Inside the with-block parameter changes of the circuit and its 
+        instances do not trigger updates of the instances. When the block 
+        exits each instance is updated once. Parameters of other circuits
+        and changes made by other threads are not deferred.
+
+        >>> from elements import R
+        >>> c = SubCircuit()
+        >>> c['R1'] = R(1, 0)
+        >>> with c.batch_update():
+        ...     c['R1'].ipar.r = 2e3
+        ...     c['R1'].iparv.r
+        1000.0
+        >>> c['R1'].iparv.r
+        2000.0
+
+        """
+        return batch_notifications(self._xparameterdicts())
+
+    def _xparameterdicts(self):
+        """Iterator over the parameter dictionaries of the hierarchy"""
+        yield self.ipar
+        yield self.iparv
+
     def add_nodes(self, *names):
         """Create internal nodes in the circuit and return the new nodes
 
@@ -245,8 +300,9 @@ class Circuit(object):
         if self.__class__.nodes is self.nodes:
             self.nodes = list(self.nodes)
 
-        if node not in self.nodes:
+        if self._lookup_index('nodes', node) is None:
             self.nodes.append(node)
+            self._append_index('nodes', node)
         self.nodenames[node.name] = node
 
     def append_branches(self, *branches):
@@ -255,7 +311,65 @@ class Circuit(object):
         if self.__class__.branches is self.branches:
             self.branches = list(self.branches)
 
-        self.branches.extend(branches)
+        for branch in branches:
+            self.branches.append(branch)
+            self._append_index('branches', branch)
+
+    def _invalidate_indices(self):
+        """Forget node and branch indices after nodes or branches have been 
+        removed or moved"""
+        self._indexmaps = None
+
+    def _indexmap(self, listname):
+        """Return dictionary that maps items of the nodes or branches list 
+        to their index in the list
+
+        The dictionary is kept between calls and is rebuilt when the list 
+        has been replaced or has changed length. Equal items are mapped to 
+        the index of the first one as with list.index.
+
+        """
+        items = getattr(self, listname)
+        if self._indexmaps is None:
+            self._indexmaps = {}
+        cached = self._indexmaps.get(listname)
+        if cached is None or cached[0] is not items or \
+                cached[1] != len(items):
+            indexmap = {}
+            for index, item in enumerate(items):
+                indexmap.setdefault(item, index)
+            cached = self._indexmaps[listname] = [items, len(items), indexmap]
+        return cached[2]
+
+    def _lookup_index(self, listname, item):
+        """Return index of an item in the nodes or branches list or None
+
+        The lookup is done in constant time using the index map. The map
+        is rebuilt if it was invalidated by an in-place change of the list.
+        Short lists, e.g. in leaf elements, are searched without a map.
+        """
+        items = getattr(self, listname)
+        if len(items) < self._indexmap_minsize and \
+                (self._indexmaps is None or listname not in self._indexmaps):
+            for index, other in enumerate(items):
+                if other == item:
+                    return index
+            return None
+
+        index = self._indexmap(listname).get(item)
+        if index is not None and not getattr(self, listname)[index] == item:
+            del self._indexmaps[listname]
+            index = self._indexmap(listname).get(item)
+        return index
+
+    def _append_index(self, listname, item):
+        """Update index map after appending an item to the list"""
+        items = getattr(self, listname)
+        cached = self._indexmaps and self._indexmaps.get(listname)
+        if cached and cached[0] is items and \
+                cached[1] == len(items) - 1:
+            cached[2].setdefault(item, len(items) - 1)
+            cached[1] += 1
 
     def get_terminal_branch(self, terminalname):
         """Find the branch that is connected to the given terminal
@@ -306,10 +420,13 @@ class Circuit(object):
         if refnode and not isinstance(refnode, Node):
             refnode = Node(str(refnode))
 
-        if node in self.nodes:
-            index = self.nodes.index(node)
+        index = self._lookup_index('nodes', node)
+        if index is not None:
             if refnode != None:
-                irefnode = self.nodes.index(refnode)
+                irefnode = self._lookup_index('nodes', refnode)
+                if irefnode is None:
+                    raise ValueError('Node %s is not in circuit node list'%
+                                     str(refnode))
                 if index == irefnode:
                     return None
                 if index > irefnode:
@@ -321,8 +438,9 @@ class Circuit(object):
 
     def get_branch_index(self, branch):
         """Get row in the x vector of a branch instance"""
-        if branch in self.branches:
-            return len(self.nodes) + self.branches.index(branch)
+        index = self._lookup_index('branches', branch)
+        if index is not None:
+            return len(self.nodes) + index
         else:
             raise ValueError('Branch %s is not present in circuit (%s)'%
                              (str(branch), str(self.branches)))
@@ -361,12 +479,12 @@ class Circuit(object):
 
         """
 
-        if self.__class__.terminals is self.terminals:
-            self.terminals = list(self.terminals)
-
         for terminal in terminals:
             # add terminal to terminal list if it is not included
             if terminal not in self.terminals:
+                ## Make a copy of terminal list so the class is unchanged
+                if self.__class__.terminals is self.terminals:
+                    self.terminals = list(self.terminals)
                 self.terminals.append(terminal)
 
             ## If no node with terminal name exists create node
@@ -377,9 +495,10 @@ class Circuit(object):
 
             ## move node to position k in nodes as it is
             ## now a terminal node
-            if not self.nodes.index(node) < self._nterminalnodes:
+            if not self._lookup_index('nodes', node) < self._nterminalnodes:
                 self.nodes.remove(node)
                 self.nodes.insert(self._nterminalnodes-1, node)
+                self._invalidate_indices()
   
     def connect_terminals(self, **kvargs):
         """Connect nodes to terminals by using keyword arguments
@@ -402,6 +521,8 @@ class Circuit(object):
             
             if node not in self.nodes:
                 self.nodes.insert(self._nterminalnodes, node)
+
+            self._invalidate_indices()
             
             self.nodenames[terminal] = node            
             
@@ -500,9 +621,73 @@ class Circuit(object):
         """
         return self.toolkit.zeros((self.n, self.n))
 
-    def next_event(self, t):
-        """Returns the time of the next event given the current time t"""
-        return inf
+    def eval_all(self, x, t=0.0, epar=defaultepar, analysis=None, 
+                 want=('i', 'q', 'G', 'C', 'u')):
+        """Evaluate several of the i, q, G, C and u methods at once
+
+        Returns a dictionary keyed by the names in *want*. 
+
+        Elements can override this method to share intermediate results 
+        between the quantities. Subclasses of such elements that override 
+        any of the i, q, G, C or u methods must then also override eval_all.
+
+        >>> from elements import R
+        >>> r = R(r=1e3)
+        >>> r.eval_all(numeric.array([1., 0.]), want=('i',))
+        {'i': array([ 0.001, -0.001])}
+
+        """
+        result = {}
+        for name in want:
+            if name == 'u':
+                result[name] = self.u(t, epar, analysis)
+            else:
+                result[name] = getattr(self, name)(x, epar)
+        return result
+
+    def limit(self, xnew, xold, epar=defaultepar):
+        """Limit the Newton update of the x-vector of the element
+
+        Elements with exponential characteristics can override this method 
+        to limit the change of their controlling voltages between Newton 
+        iterations, see elements.pnjlim. The limited x-vector is returned 
+        and should lie on the line from *xold* to *xnew*.
+
+        The default is to not limit the update.
+        """
+        return xnew
+
+    def next_event(self, t, discontinuous=False):
+        """Returns the time of the next event given the current time t
+
+        If *discontinuous* is True only events where the sources are not
+        smooth, such as the corners of a pulse, are returned.
+        """
+        return self.toolkit.inf
+
+    def compile(self):
+        """Return a flattened representation of the circuit for analyses
+
+        A leaf circuit is already flat so the circuit itself is returned
+        """
+        return self
+
+    def hashkey(self):
+        """Return a hashable key of the netlist and parameter values
+
+        Circuits with equal keys are assumed to have the same equations. 
+        The key of a leaf circuit is made of its class, the size of the 
+        x-vector and the evaluated instance parameters. Subclasses that 
+        keep state outside of the instance parameters must extend the key.
+
+        >>> from elements import *
+        >>> R(1, gnd, r=1e3).hashkey() == R(2, gnd, r=1e3).hashkey()
+        True
+        >>> R(1, gnd, r=1e3).hashkey() == R(1, gnd, r=2e3).hashkey()
+        False
+
+        """
+        return (self.__class__, self.n, hashable_params(self.iparv))
     
     def name_state_vector(self, x, analysis=''):
         """Return a dictionary of the x-vector keyed by node and branch names
@@ -715,11 +900,11 @@ class Circuit(object):
         """Calculate numeric values of instance parameters"""
         
         substvalues = tuple(p for p in (globalparams, parent_ipar) if p)
-            
-        newipar = self.ipar.eval_expressions(substvalues, 
-                                             ignore_errors=ignore_errors)
 
-        self.iparv.update_values(newipar)
+        ## Only the expressions that depend on changed parameters are 
+        ## evaluated and iparv is only updated if a value has changed
+        self.ipar.update_evaluated(self.iparv, substvalues, 
+                                   ignore_errors=ignore_errors)
 
     def __repr__(self):
         return self.__class__.__name__ + \
@@ -758,6 +943,82 @@ class Circuit(object):
         """Return number of terminal nodes"""
         return len(self.terminals)
 
+def stamp_indices(nodemap):
+    """Return scatter indices of an element with the given node map
+
+    The result is a tuple (nodemap, rows, cols) of integer arrays where rows 
+    and cols are the row and column indices in the parent matrix of the 
+    entries of a flattened element matrix.
+
+    >>> stamp_indices([2, 0])
+    (array([2, 0]), array([2, 2, 0, 0]), array([2, 0, 2, 0]))
+
+    """
+    nodemap = np.array(nodemap, dtype=int)
+    k = len(nodemap)
+    return nodemap, np.repeat(nodemap, k), np.tile(nodemap, k)
+
+def hashable(value):
+    """Return value or a hashable substitute if value is not hashable"""
+    try:
+        hash(value)
+    except TypeError:
+        if isinstance(value, np.ndarray):
+            return (value.dtype.str, value.shape, value.tostring())
+        return repr(value)
+    return value
+
+def hashable_params(paramdict):
+    """Return a hashable tuple of the names and values of a paramdict"""
+    return tuple((name, hashable(value)) for name, value in paramdict.items())
+
+class StampPattern(object):
+    """Fixed sparsity pattern of a matrix assembled from element stamps
+
+    The pattern is created once from the row and column indices of all stamp
+    entries. The matrix can then be assembled from the stamp values in O(nnz)
+    time as duplicate entries are mapped to precalculated slots in the
+    CSR data array.
+
+    >>> pattern = StampPattern(np.array([0, 1, 0]), np.array([0, 1, 0]), (2,2))
+    >>> pattern.assemble(np.array([1., 2., 3.])).toarray()
+    array([[ 4.,  0.],
+           [ 0.,  2.]])
+
+    """
+    def __init__(self, rows, cols, shape):
+        self.rows = rows
+        self.cols = cols
+        self.shape = shape
+
+        nrows, ncols = shape
+        entries, self.slots = np.unique(rows * ncols + cols, 
+                                        return_inverse=True)
+        self.nnz = len(entries)
+        self.indices = entries % max(ncols, 1)
+        rowcount = np.bincount(entries // max(ncols, 1), 
+                               minlength=max(nrows, 1))[:nrows]
+        self.indptr = np.concatenate(([0], np.cumsum(rowcount)))
+
+    def matches(self, rows, cols):
+        """Return True if the pattern was created from the given indices"""
+        return len(rows) == len(self.rows) and \
+            np.array_equal(rows, self.rows) and np.array_equal(cols, self.cols)
+
+    def assemble(self, data):
+        """Return CSR matrix with the sum of the stamp values"""
+        if self.nnz == 0:
+            return scipy.sparse.csr_matrix(self.shape)
+
+        if np.iscomplexobj(data):
+            values = np.bincount(self.slots, data.real, self.nnz) + \
+                1j * np.bincount(self.slots, data.imag, self.nnz)
+        else:
+            values = np.bincount(self.slots, data, self.nnz)
+
+        return scipy.sparse.csr_matrix((values, self.indices, self.indptr),
+                                       shape=self.shape)
+
 class SubCircuit(Circuit):
     """
     SubCircuit is container for circuit instances
@@ -768,7 +1029,9 @@ class SubCircuit(Circuit):
 
         *elementnodemap*
           list of translation lists which translate between node indices of the
-          elements and node indices of the parent
+          elements and node indices of the parent. The lists are updated
+          lazily, only the lists of instances whose node or branch indices 
+          have changed are recalculated when the attribute is accessed.
 
         *term_node_map* 
           dictionary of instance terminal to node object maps keyed by the 
@@ -777,15 +1040,30 @@ class SubCircuit(Circuit):
 
     """
     elements = {}
-    elementnodemap = {}
     term_node_map = {}
+    _elementnodemap = {}
+    _stalenodemaps = frozenset()
+    _branchinstances = frozenset()
+    _compiled = None
 
     def __init__(self, *args, **kvargs):
         super(SubCircuit, self).__init__(*args, **kvargs)
         self.elements = {}
         self.elementnodemap = {}
         self.term_node_map = {}
-        self._mapmatrix = {}
+        self._branchinstances = set()
+        self._compiled = None
+
+    @property
+    def elementnodemap(self):
+        if self._stalenodemaps:
+            self.update_node_map(self._stalenodemaps)
+        return self._elementnodemap
+
+    @elementnodemap.setter
+    def elementnodemap(self, elementnodemap):
+        self._elementnodemap = elementnodemap
+        self._stalenodemaps = set()
 
     def __eq__(self, a):
         return super(SubCircuit, self).__eq__(a) and \
@@ -800,6 +1078,7 @@ class SubCircuit(Circuit):
             newc.elements[instance_name] = copy(self.elements[instance_name])
         newc.elementnodemap = copy(self.elementnodemap)
         newc.term_node_map = copy(self.term_node_map)
+        newc._branchinstances = set(self._branchinstances)
         
         newc.update_node_map()
 
@@ -869,6 +1148,8 @@ class SubCircuit(Circuit):
         if instancename in self.elements:
             del self[instancename]
 
+        nnodes = len(self.nodes)
+
         self.elements[instancename] = instance
 
         ## Add local nodes and branches from new instance
@@ -894,12 +1175,40 @@ class SubCircuit(Circuit):
         newbranches = self._instance_branches(instance, instancename)
         self.append_branches(*newbranches)
 
-        ## Update circuit node - instance map
-        self.update_node_map()
+        ## Mark node maps for update. New nodes shift the indices of all 
+        ## branches so instances with branches must be updated as well
+        self._stalenodemaps.add(instancename)
+        if len(self.nodes) != nnodes:
+            self._stalenodemaps.update(self._branchinstances)
+        if instance.branches:
+            self._branchinstances.add(instancename)
 
         ## update iparv
         instance.update_iparv(self.iparv, ignore_errors=True)
 
+    def add_instances(self, instances):
+        """Add several instances to the circuit
+
+        The *instances* argument is a dictionary or an iterable of 
+        (instancename, instance) pairs. The terminals are connected as when
+        the instances are added with the [] operator. The node maps are 
+        calculated once after all instances have been added.
+
+        >>> from elements import *
+        >>> c = SubCircuit()
+        >>> c.add_instances(('R%d'%k, R(k, k+1)) for k in range(3))
+        >>> c.elementnodemap['R2']
+        [2, 3]
+
+        """
+        if isinstance(instances, dict):
+            instances = instances.items()
+
+        for instancename, element in instances:
+            self[instancename] = element
+
+        self.update_node_map(self._stalenodemaps)
+
     def __setitem__(self, instancename, element):
         """Adds an instance to the circuit"""
 
@@ -940,9 +1249,12 @@ class SubCircuit(Circuit):
         for branch in self._instance_branches(element, instancename):
             self.branches.remove(branch)
 
-        del self.term_node_map[instancename]
+        ## The indices of the remaining nodes and branches have changed
+        self._invalidate_indices()
 
-        self.update_node_map()
+        del self.term_node_map[instancename]
+        self._branchinstances.discard(instancename)
+        self._stalenodemaps.add(instancename)
 
     def __getitem__(self, instancename):
         """Get local or hierarchical instance by name"""
@@ -1055,13 +1367,29 @@ class SubCircuit(Circuit):
             if name != None:
                 return instname + '.' + name
         
-    def update_node_map(self):
-        """Update the elementnodemap attribute"""
+    def _invalidate_indices(self):
+        super(SubCircuit, self)._invalidate_indices()
+        self._stalenodemaps = set(self.elements)
 
-        self.elementnodemap = {}
-        self._rep_nodemap_list = {}
-        
-        for instance_name, element in self.elements.items():
+    def update_node_map(self, instancenames=None):
+        """Update the elementnodemap attribute
+
+        If *instancenames* is given only the node maps of those instances are
+        recalculated. A new dictionary is always created so compiled 
+        circuits can detect the change.
+        """
+        if instancenames is None:
+            instancenames = self.elements.keys()
+            elementnodemap = {}
+        else:
+            elementnodemap = dict(self._elementnodemap)
+
+        for instance_name in instancenames:
+            if instance_name not in self.elements:
+                elementnodemap.pop(instance_name, None)
+                continue
+
+            element = self.elements[instance_name]
             nodemap = self.term_node_map[instance_name]
             element_nodes = [nodemap[terminal] for terminal in element.terminals]
 
@@ -1071,22 +1399,12 @@ class SubCircuit(Circuit):
             element_branches = self._instance_branches(element, instance_name)
 
             nodemap = \
-                [self.nodes.index(node) for node in element_nodes] + \
-                [self.branches.index(branch) + len(self.nodes) 
-                 for branch in element_branches]
+                [self.get_node_index(node) for node in element_nodes] + \
+                [self.get_branch_index(branch) for branch in element_branches]
 
-            self.elementnodemap[instance_name] = nodemap
+            elementnodemap[instance_name] = nodemap
 
-            ## Create mapping matrix
-            if len(nodemap) > 0:
-                mapmatrix = self.toolkit.zeros((self.n, len(nodemap)),
-                                               dtype = np.integer)
-            
-                for inst_node_index, node_index in enumerate(nodemap):
-                    mapmatrix[node_index, inst_node_index] = 1
-                self._mapmatrix[instance_name] = mapmatrix
-            else:
-                self._nodemap = None
+        self.elementnodemap = elementnodemap
 
     def update_iparv(self, parent_ipar=None, globalparams=None, 
                      ignore_errors = False):
@@ -1099,35 +1417,88 @@ class SubCircuit(Circuit):
             element.update_iparv(self.iparv, globalparams,
                                  ignore_errors=ignore_errors)
         
-    def G(self, x, epar=defaultepar):
-        return self._add_element_submatrices('G', x, (epar,))
+    ## The matrices and vectors are assembled by the compiled circuit which
+    ## keeps the stamps of the linear elements between calls
 
-    def C(self, x, epar=defaultepar):
-        return self._add_element_submatrices('C', x, (epar,))
+    def eval_all(self, x, t=0.0, epar=defaultepar, analysis=None, 
+                 want=('i', 'q', 'G', 'C', 'u'), sparse=None):
+        """Evaluate several of the i, q, G, C and u methods at once
+
+        The elements are visited once and the result is returned as a 
+        dictionary keyed by the names in *want*.
+
+        >>> from elements import *
+        >>> c = SubCircuit()
+        >>> c['D'] = Diode(1, gnd)
+        >>> c['R'] = R(1, gnd, r=1e3)
+        >>> result = c.eval_all(numeric.array([0.5, 0]), want=('i', 'G'))
+        >>> np.allclose(result['G'], c.G(numeric.array([0.5, 0])))
+        True
+        
+        """
+        if not self._isflattenable():
+            return Circuit.eval_all(self, x, t, epar, analysis, want)
+
+        return self._compile().eval_all(x, t, epar, analysis, want, 
+                                        sparse=sparse)
+
+    def G(self, x, epar=defaultepar, sparse=None):
+        """Calculate the G (trans)conductance matrix given the x-vector
+
+        If *sparse* is True the matrix is returned as a scipy.sparse CSR matrix.
+        The default is taken from the sparse attribute of the toolkit.
+
+        """
+        return self._compile().G(x, epar, sparse=sparse)
+
+    def C(self, x, epar=defaultepar, sparse=None):
+        """Calculate the C (transcapacitance) matrix given the x-vector
+
+        If *sparse* is True the matrix is returned as a scipy.sparse CSR matrix.
+        The default is taken from the sparse attribute of the toolkit.
+
+        """
+        return self._compile().C(x, epar, sparse=sparse)
 
     def u(self, t=0.0, epar=defaultepar, analysis=None):
-        dtype = None
-        if analysis == 'ac':
-            dtype = self.toolkit.ac_u_dtype
+        return self._compile().u(t, epar, analysis)
 
-        return self._add_element_subvectors('u', None, (t,epar,analysis), 
-                                            dtype=dtype)
+    def next_event(self, t, discontinuous=False):
+        """Returns the time of the first next event of all elements
+
+        >>> from elements import *
+        >>> sub = SubCircuit()
+        >>> sub['vs'] = VPulse(1, gnd, v2=1, td=1e-6, tr=1e-9, pw=1e-6)
+        >>> sub['R'] = R(1, gnd)
+        >>> c = SubCircuit()
+        >>> c['I1'] = sub
+        >>> print c.next_event(0.5e-6)
+        1e-06
+
+        """
+        if self._isflattenable():
+            return self._compile().next_event(t, discontinuous)
+        return min([self.toolkit.inf] + 
+                   [element.next_event(t, discontinuous) 
+                    for element in self.elements.values()])
 
     def i(self, x, epar=defaultepar):
-        return self._add_element_subvectors('i', x, (epar,))
+        return self._compile().i(x, epar)
 
     #This seemed to be missing
     def q(self, x, epar=defaultepar):
-        return self._add_element_subvectors('q', x, (epar,))
+        return self._compile().q(x, epar)
 
-    def CY(self, x, w, epar=defaultepar):
+    def CY(self, x, w, epar=defaultepar, sparse=None):
         """Calculate composite noise source correlation matrix
 
         The noise sources in one element are assumed to be uncorrelated 
         with the noise sources in the other elements.
 
+        If *sparse* is True the matrix is returned as a scipy.sparse CSR matrix.
+
         """
-        return self._add_element_submatrices('CY', x, (w, epar,))
+        return self._compile().CY(x, w, epar, sparse=sparse)
 
     def save_current(self, terminal):
         """Returns a circuit where the given terminal current is saved
@@ -1193,56 +1564,126 @@ class SubCircuit(Circuit):
         for element in self.elements.values():
             element.update_iparv(self.iparv, ignore_errors=True)
         
-    def _add_element_submatrices(self, methodname, x, args):
-        dot = self.toolkit.dot
-        n = self.n
-        lhs = self.toolkit.zeros((n,n))
+    def find_class_instances(self, instance_class):
+        instances = []        
+        for instanceName, element in self.elements.items():
+            if isinstance(element, instance_class):
+                instances.append(instanceName)
+            elif isinstance(element, SubCircuit):
+                for instance in element.find_class_instances(instance_class):
+                    instances.append(instanceName + '.' + instance)
+        return instances
 
-        for instance, element in self.elements.items():
-            nodemap = self.elementnodemap[instance]
+    def compile(self):
+        """Return a CompiledCircuit object of the circuit
 
-            if x != None:
-                subx = x[nodemap]
-                try:
-                    rhs = getattr(element, methodname)(subx, *args)
-                except Exception, e:
-                    raise e.__class__(str(e) + ' at element ' + str(element) 
-                                      + ', args='+str(args))
-            else:
-                rhs = getattr(element, methodname)(*((None,) + tuple(args)))
-                
-            T = self._mapmatrix[instance]
-        
-            lhs += dot(dot(T, rhs), T.T)
+        The compiled circuit is kept and returned again by later calls until 
+        the netlist of the circuit or any of its subcircuits is changed.
+        Subclasses that define their own G, C, u, i, q or CY methods are not
+        compiled and the circuit itself is returned.
 
-        return lhs
+        >>> from elements import *
+        >>> c = SubCircuit()
+        >>> c['R1'] = R(1, gnd, r=1e3)
+        >>> c.compile() is c.compile()
+        True
+        >>> c['R2'] = R(1, gnd, r=1e3)
+        >>> c.compile().G(np.zeros(c.n))
+        array([[ 0.002, -0.002],
+               [-0.002,  0.002]])
 
-    def _add_element_subvectors(self, methodname, x, args, dtype=None):
-        n = self.n
-        lhs = self.toolkit.zeros(n, dtype=dtype)
+        """
+        if not self._isflattenable():
+            return self
+        return self._compile()
+
+    def _compile(self):
+        if self._compiled is None or not self._compiled.isvalid():
+            if self._compiled is not None:
+                self._compiled.release()
+            self._compiled = CompiledCircuit(self)
+        return self._compiled
+
+    def _xparameterdicts(self):
+        for paramdict in super(SubCircuit, self)._xparameterdicts():
+            yield paramdict
+        for element in self.elements.values():
+            for paramdict in element._xparameterdicts():
+                yield paramdict
+
+    def xflatleafs(self, nodemap=None, instancename='', instances=None):
+        """Iterator over all leaf elements with their global node maps
+
+        The iterator yields tuples of (hierarchical instance name, element, 
+        nodemap) where nodemap are the indices of the element x-vector 
+        in the x-vector of the circuit. Subcircuits that define their own
+        G, C, u, i, q or CY methods are treated as leaf elements.
+
+        The optional *instances* argument restricts the iteration to the
+        given instance names of the top level.
 
-        for instance, element in self.elements.items():
-            if x != None:
-                subx = x[self.elementnodemap[instance]]
-                rhs = getattr(element, methodname)(subx, *args)
+        """
+        if instances is None:
+            instances = self.elements.keys()
+
+        for name in instances:
+            e = self.elements[name]
+            subnodemap = np.array(self.elementnodemap[name], dtype=int)
+            if nodemap is not None:
+                subnodemap = nodemap[subnodemap]
+            if isinstance(e, SubCircuit) and e._isflattenable():
+                for leaf in e.xflatleafs(subnodemap, instjoin(instancename, 
+                                                             name)):
+                    yield leaf
             else:
-                rhs = getattr(element, methodname)(*args)
+                yield instjoin(instancename, name), e, subnodemap
 
-            T = self._mapmatrix[instance]
+    def hashkey(self):
+        """Return a hashable key of the netlist and parameter values
 
-            lhs += self.toolkit.dot(T, rhs)
+        The key of a subcircuit also contains the keys and node indices of 
+        all leaf elements.
 
-        return lhs
+        >>> from elements import *
+        >>> c1, c2 = SubCircuit(), SubCircuit()
+        >>> c1['R1'] = R(1, gnd, r=1e3)
+        >>> c2['R1'] = R(1, gnd, r=1e3)
+        >>> c1.hashkey() == c2.hashkey()
+        True
+        >>> c2['R1'].ipar.r = 2e3
+        >>> c1.hashkey() == c2.hashkey()
+        False
 
-    def find_class_instances(self, instance_class):
-        instances = []        
-        for instanceName, element in self.elements.items():
-            if isinstance(element, instance_class):
-                instances.append(instanceName)
-            elif isinstance(element, SubCircuit):
-                for instance in element.find_class_instances(instance_class):
-                    instances.append(instanceName + '.' + instance)
-        return instances
+        """
+        leafs = sorted((name, element.hashkey(), tuple(nodemap))
+                       for name, element, nodemap in self.xflatleafs())
+        return super(SubCircuit, self).hashkey() + (tuple(leafs),)
+
+    def overlay(self):
+        """Return a copy-on-write clone of the circuit
+
+        See CircuitOverlay.
+
+        >>> from elements import *
+        >>> c = SubCircuit()
+        >>> c['R1'] = R(1, gnd, r=1e3)
+        >>> c2 = c.overlay()
+        >>> c2['R2'] = R(1, gnd, r=1e3)
+        >>> c2.G(np.zeros(c2.n))
+        array([[ 0.002, -0.002],
+               [-0.002,  0.002]])
+        >>> c.elements.keys()
+        ['R1']
+
+        """
+        return CircuitOverlay(self)
+
+    def _isflattenable(self):
+        """Return True if the assembly methods are those of SubCircuit"""
+        cls = self.__class__
+        return all(getattr(cls, method).im_func is 
+                   getattr(SubCircuit, method).im_func
+                   for method in ('G', 'C', 'u', 'i', 'q', 'CY'))
 
     @property
     def xflatelements(self):
@@ -1259,6 +1700,946 @@ class SubCircuit(Circuit):
         return Branch(self.get_node(instance + '.' + branch.plus.name),
                       self.get_node(instance + '.' + branch.minus.name))
                     
+def batchmethod(elementclass, methodname):
+    """Return the batch version of an element method or None
+
+    A batch method evaluates a method of all instances of an element class 
+    in one call. The matrix and vector methods take the x-vectors of the 
+    instances stacked as rows of an array and a dictionary of arrays of 
+    instance parameter values, and return the stacked results::
+
+        G_batch(X, params, epar) -> array of shape (m, n, n)
+        C_batch(X, params, epar) -> array of shape (m, n, n)
+        i_batch(X, params, epar) -> array of shape (m, n)
+        q_batch(X, params, epar) -> array of shape (m, n)
+        u_batch(t, params, epar, analysis) -> array of shape (m, n)
+
+    The batch method is only used if it is defined in the same class as
+    the method itself so that subclasses that override the method don't 
+    inherit an invalid batch method. Subclasses can also disable an 
+    inherited batch method by setting it to None.
+
+    When the G and C methods are inherited from Circuit the batch versions 
+    return zero matrices, and the i and q methods are calculated from G and
+    C as i(x) = G(x)*x and q(x) = C(x)*x.
+
+    >>> from elements import R, IS, Diode
+    >>> batchmethod(R, 'G') == R.G_batch
+    True
+    >>> batchmethod(IS, 'G')(np.zeros((3,2)), {}).shape
+    (3, 2, 2)
+    >>> batchmethod(Diode, 'q')(np.zeros((3,2)), {'IS': np.ones(3)})
+    array([[ 0.,  0.],
+           [ 0.,  0.],
+           [ 0.,  0.]])
+    
+    """
+    batch = getattr(elementclass, methodname + '_batch', None)
+    if batch is not None and \
+            _definingclass(elementclass, methodname) is \
+            _definingclass(elementclass, methodname + '_batch'):
+        return batch
+    
+    if _definingclass(elementclass, methodname) is Circuit:
+        if methodname in ('G', 'C'):
+            def batch(X, params, epar=defaultepar):
+                m, n = X.shape
+                return np.zeros((m, n, n))
+            return batch
+        elif methodname in ('i', 'q'):
+            matrixbatch = batchmethod(elementclass, 
+                                      {'i': 'G', 'q': 'C'}[methodname])
+            if matrixbatch is not None:
+                def batch(X, params, epar=defaultepar):
+                    return np.einsum('mij,mj->mi', 
+                                     matrixbatch(X, params, epar), X)
+                return batch
+
+def _definingclass(cls, attribute):
+    """Return the class in the method resolution order that sets attribute"""
+    for basecls in cls.__mro__:
+        if attribute in basecls.__dict__:
+            return basecls
+
+def _limit_ratio(dxlimited, dx):
+    """Return the smallest ratio between limited and unlimited updates"""
+    dxlimited, dx = np.ravel(dxlimited), np.ravel(dx)
+    nonzero = dx != 0
+    if not np.any(nonzero):
+        return 1.
+    return min(max(np.min(dxlimited[nonzero] / dx[nonzero]), 0.), 1.)
+
+class ElementGroup(object):
+    """Leaf elements of the same class in a compiled circuit
+
+    **Attributes**
+        *elementclass*
+          Class of the elements
+
+        *instances*
+          list of hierarchical instance names
+
+        *elements*
+          list of element objects
+
+        *nodemaps*
+          list of index vectors that maps the x-vector of each element
+          to the global x-vector
+
+        *linear*
+          True if i(x) and q(x) of all elements are linear functions 
+
+    """
+    def __init__(self, elementclass):
+        self.elementclass = elementclass
+        self.instances = []
+        self.elements = []
+        self.nodemaps = []
+        self._batchmethods = {}
+        self._params = None
+        self._nodemaparray = None
+
+    def append(self, instance, element, nodemap):
+        self.instances.append(instance)
+        self.elements.append(element)
+        self.nodemaps.append(nodemap)
+        self._nodemaparray = None
+
+    @property
+    def linear(self):
+        return all(element.linear for element in self.elements)
+
+    @property
+    def nodemaparray(self):
+        """Node maps of the elements as rows of an array or None if the 
+        elements have different number of nodes and branches"""
+        if self._nodemaparray is None and \
+                len(set(len(nodemap) for nodemap in self.nodemaps)) == 1:
+            self._nodemaparray = np.array(self.nodemaps, dtype=int)
+        return self._nodemaparray
+
+    @property
+    def params(self):
+        """Dictionary of arrays of numeric instance parameter values
+
+        The value is None if any parameter value is not numeric
+        """
+        if self._params is None:
+            params = {}
+            for param in self.elementclass.instparams:
+                values = np.array([element.iparv.get(param.name) 
+                                   for element in self.elements])
+                if values.dtype.kind not in 'biufc':
+                    return None
+                params[param.name] = values
+            self._params = params
+        return self._params
+
+    def parameters_changed(self):
+        self._params = None
+
+    def batchmethod(self, methodname):
+        """Return batch method of the element class or None
+
+        See the batchmethod function
+        """
+        if methodname not in self._batchmethods:
+            self._batchmethods[methodname] = \
+                batchmethod(self.elementclass, methodname)
+        return self._batchmethods[methodname]
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __repr__(self):
+        return 'ElementGroup(%s, %d)'%(self.elementclass.__name__, len(self))
+
+class CompiledCircuit(object):
+    """Flat representation of a circuit hierarchy
+
+    The leaf elements of the hierarchy are grouped by class and the 
+    index vectors that scatter their matrices and vectors into the 
+    matrices and vectors of the top circuit are concatenated into
+    contiguous arrays. The G, C, u, i, q and CY methods evaluate the 
+    elements in a single flat loop without traversing the hierarchy.
+
+    Element classes that implement batch methods (see batchmethod) are 
+    evaluated with one call for all instances in the group when the toolkit
+    is numeric.
+
+    The G and C stamps of linear elements do not depend on x and are 
+    calculated once and kept until an instance parameter in the hierarchy 
+    or the values of the environment parameters change. The same applies
+    to the u vector of the DC and AC analyses.
+
+    The G and C stamps of a nonlinear element can also be reused, see
+    the bypass argument of eval_all.
+
+    A compiled circuit is created by the compile method of the circuit and
+    is invalid when the netlist of any circuit in the hierarchy changes.
+
+    >>> from elements import *
+    >>> c = SubCircuit()
+    >>> n1 = c.add_node('n1')
+    >>> c['vs'] = VS(n1, gnd, v=1.5)
+    >>> c['R'] = R(n1, gnd, r=1e3)
+    >>> cc = c.compile()
+    >>> cc.groups
+    [ElementGroup(R, 1), ElementGroup(VS, 1)]
+    >>> cc.u(0, analysis='dc')
+    array([ 0. ,  0. , -1.5])
+
+    """
+    def __init__(self, circuit, instances=None):
+        self.circuit = circuit
+        self.toolkit = circuit.toolkit
+        self.n = circuit.n
+
+        ## Group leaf elements by class
+        groups = {}
+        for instance, element, nodemap in \
+                circuit.xflatleafs(instances=instances):
+            cls = element.__class__
+            if cls not in groups:
+                groups[cls] = ElementGroup(cls)
+            groups[cls].append(instance, element, nodemap)
+        
+        self.groups = sorted(groups.values(), 
+                             key = lambda group: group.elementclass.__name__)
+        for group in self.groups:
+            order = np.argsort(group.instances)
+            for attr in 'instances', 'elements', 'nodemaps':
+                setattr(group, attr, [getattr(group, attr)[i] for i in order])
+
+        self.lineargroups = [group for group in self.groups if group.linear]
+        self.nonlineargroups = [group for group in self.groups 
+                                if not group.linear]
+        self.limitgroups = [group for group in self.groups
+                            if _definingclass(group.elementclass, 'limit') 
+                            is not Circuit]
+        self.eventelements = [element for group in self.groups 
+                              if _definingclass(group.elementclass, 
+                                                'next_event') is not Circuit
+                              for element in group.elements]
+
+        ## Global index vectors of all and of nonlinear elements
+        self._indices = self._index_vectors(self.groups)
+        self._linearindices = self._index_vectors(self.lineargroups)
+        self._nonlinearindices = self._index_vectors(self.nonlineargroups)
+        self._stamppatterns = {}
+
+        ## Record the node maps of all subcircuits so changes in the 
+        ## netlists can be detected
+        self._structure = [(subcircuit, subcircuit.elementnodemap)
+                           for subcircuit in self._xsubcircuits(circuit,
+                                                                instances)]
+
+        ## Constant stamps of linear elements
+        self._constant = {}
+        self._epar = None
+
+        ## Last evaluated x-vectors and matrices of nonlinear groups for 
+        ## bypass and the number of bypassed element evaluations
+        self._bypasscache = {}
+        self.nbypass = 0
+
+        ## Subscribe to instance parameter changes
+        self._observed = [element.iparv for group in self.groups
+                          for element in group.elements] + \
+                         [subcircuit.iparv for subcircuit, nodemap 
+                          in self._structure]
+        for paramdict in self._observed:
+            paramdict.attach(self, updatemethod='_parameters_changed')
+
+    def isvalid(self):
+        """Return False if the netlist has changed after compilation"""
+        return self.n == self.circuit.n and \
+            all(subcircuit.elementnodemap is nodemap 
+                for subcircuit, nodemap in self._structure)
+
+    @property
+    def linear(self):
+        """True if i(x) and q(x) of all elements are linear"""
+        return len(self.nonlineargroups) == 0
+
+    def release(self):
+        """Detach the compiled circuit from the parameters of the circuit"""
+        for paramdict in self._observed:
+            paramdict.detach(self, updatemethod='_parameters_changed')
+        self._observed = []
+
+    def eval_all(self, x, t=0.0, epar=defaultepar, analysis=None,
+                 want=('i', 'q', 'G', 'C', 'u'), sparse=None, bypass=None):
+        """Evaluate several of i, q, G, C and u in one pass over the elements
+
+        Returns a dictionary keyed by the names in *want*. The elements 
+        are evaluated with their eval_all method, or the eval_all_batch 
+        class method, so device models can share intermediate results 
+        between the quantities.
+
+        If *bypass* is given the G and C stamps of a nonlinear element 
+        are reused if no element of its x-vector has changed more than 
+        *bypass* since they were calculated. The i and q vectors are always 
+        evaluated.
+
+        """
+        if sparse is None:
+            sparse = getattr(self.toolkit, 'sparse', False)
+
+        result = {}
+
+        if 'u' in want:
+            result['u'] = self._u(t, epar, analysis)
+
+        matrixnames = [name for name in want if name in ('G', 'C')]
+        vectornames = [name for name in want if name in ('i', 'q')]
+
+        if len(matrixnames) > 0:
+            self._check_epar(epar)
+
+        ## Only the nonlinear elements contribute to the matrices as the 
+        ## stamps of the linear elements are constant
+        values = dict((name, []) for name in matrixnames + vectornames)
+        for group in self.groups:
+            if group.linear:
+                names = vectornames
+            else:
+                names = vectornames + matrixnames
+
+            if len(names) == 0:
+                continue
+
+            if bypass is not None and not group.linear and \
+                    len(matrixnames) > 0:
+                groupvalues = self._evaluate_group_bypass(
+                    group, vectornames, matrixnames, x, epar, bypass)
+            else:
+                groupvalues = self._evaluate_group(group, names, x, epar)
+
+            for name, value in groupvalues.items():
+                values[name].append(value)
+
+        for name in vectornames:
+            lhs = self.toolkit.zeros(self.n)
+            if len(values[name]) > 0:
+                np.add.at(lhs, self._indices[0], np.concatenate(values[name]))
+            result[name] = lhs
+
+        for name in matrixnames:
+            key = name, sparse
+            if key not in self._constant:
+                self._constant[key] = self._constant_stamps(name, (epar,), 
+                                                            sparse)
+            if len(values[name]) > 0:
+                data = np.concatenate(values[name])
+            else:
+                data = np.zeros(0)
+            nodemaps, rows, cols = self._nonlinearindices
+
+            if sparse:
+                data = np.concatenate((self._constant[key], data))
+                rows = np.concatenate((self._linearindices[1], rows))
+                cols = np.concatenate((self._linearindices[2], cols))
+                result[name] = \
+                    self._stamppattern(name, rows, cols).assemble(data)
+            else:
+                lhs = self._constant[key].copy()
+                np.add.at(lhs, (rows, cols), data)
+                result[name] = lhs
+
+        return result
+
+    def G(self, x, epar=defaultepar, sparse=None):
+        """Calculate the G (trans)conductance matrix given the x-vector"""
+        return self.eval_all(x, epar=epar, want=('G',), sparse=sparse)['G']
+
+    def C(self, x, epar=defaultepar, sparse=None):
+        """Calculate the C (transcapacitance) matrix given the x-vector"""
+        return self.eval_all(x, epar=epar, want=('C',), sparse=sparse)['C']
+
+    def u(self, t=0.0, epar=defaultepar, analysis=None):
+        return self.eval_all(None, t, epar, analysis, want=('u',))['u']
+
+    def i(self, x, epar=defaultepar):
+        return self.eval_all(x, epar=epar, want=('i',))['i']
+
+    def q(self, x, epar=defaultepar):
+        return self.eval_all(x, epar=epar, want=('q',))['q']
+
+    def CY(self, x, w, epar=defaultepar, sparse=None):
+        """Calculate composite noise source correlation matrix"""
+        if sparse is None:
+            sparse = getattr(self.toolkit, 'sparse', False)
+
+        data = self._evaluate(self.groups, 'CY', x, (w, epar))
+        nodemaps, rows, cols = self._indices
+
+        if sparse:
+            return self._stamppattern('CY', rows, cols).assemble(data)
+        
+        lhs = self.toolkit.zeros((self.n, self.n))
+        np.add.at(lhs, (rows, cols), data)
+        return lhs
+
+    def next_event(self, t, discontinuous=False):
+        """Return the time of the first next event of the elements"""
+        return min([self.toolkit.inf] + 
+                   [element.next_event(t, discontinuous) 
+                    for element in self.eventelements])
+
+    def limit(self, xnew, xold, epar=defaultepar):
+        """Limit a Newton update of the x-vector with the element limit 
+        methods
+
+        Each element limits the update of its own x-vector and the update 
+        of the whole x-vector is scaled by the smallest ratio between the 
+        limited and unlimited updates of the elements. Returns the limited 
+        x-vector.
+
+        >>> from elements import *
+        >>> c = SubCircuit()
+        >>> n1 = c.add_node('n1')
+        >>> c['D'] = Diode(n1, gnd)
+        >>> xnew, xold = np.array([10., 0.]), np.array([0.7, 0.])
+        >>> print np.around(c.compile().limit(xnew, xold), 4)
+        [ 0.8522  0.    ]
+
+        """
+        if self.toolkit.symbolic or len(self.limitgroups) == 0:
+            return xnew
+
+        dx = xnew - xold
+        scale = 1.
+        for group in self.limitgroups:
+            batch = group.batchmethod('limit')
+            if batch is not None and group.params is not None and \
+                    group.nodemaparray is not None:
+                nodemaps = group.nodemaparray
+                limited = batch(xnew[nodemaps], xold[nodemaps], 
+                                group.params, epar)
+                scale = min(scale, _limit_ratio(limited - xold[nodemaps],
+                                                dx[nodemaps]))
+                continue
+
+            for element, nodemap in zip(group.elements, group.nodemaps):
+                limited = element.limit(xnew[nodemap], xold[nodemap], epar)
+                scale = min(scale, _limit_ratio(limited - xold[nodemap],
+                                                dx[nodemap]))
+
+        if scale < 1:
+            return xold + scale * dx
+        return xnew
+
+    def _u(self, t, epar, analysis):
+        dtype = None
+        if analysis == 'ac':
+            dtype = self.toolkit.ac_u_dtype
+
+        if analysis not in constant_u_analyses:
+            return self._vector('u', None, (t, epar, analysis), dtype=dtype)
+
+        self._check_epar(epar)
+        key = 'u', analysis
+        if key not in self._constant or self._constant[key][0] != t:
+            self._constant[key] = \
+                t, self._vector('u', None, (t, epar, analysis), dtype=dtype)
+
+        return self._constant[key][1].copy()
+
+    def _parameters_changed(self, subject):
+        self._constant = {}
+        self._bypasscache = {}
+        for group in self.groups:
+            group.parameters_changed()
+
+    def _evaluate_group(self, group, names, x, epar, select=None):
+        """Evaluate the quantities in names of the elements in a group
+
+        Only the elements where the boolean array *select* is True are
+        evaluated if it is given.
+
+        Returns a dictionary of the concatenated and flattened results
+        """
+        result = self._evaluate_group_batch(group, names, x, epar, select)
+        if result is not None:
+            return result
+
+        if select is None:
+            select = np.ones(len(group), dtype=bool)
+
+        values = dict((name, [np.zeros(0)]) for name in names)
+        for instance, element, nodemap, selected in zip(group.instances, 
+                                                        group.elements,
+                                                        group.nodemaps,
+                                                        select):
+            if not selected:
+                continue
+
+            if x is not None:
+                subx = x[nodemap]
+            else:
+                subx = None
+
+            try:
+                elementvalues = element.eval_all(subx, epar=epar, want=names)
+            except Exception, e:
+                raise e.__class__(str(e) + ' at element ' + instance)
+
+            for name in names:
+                rhs = elementvalues[name]
+                if scipy.sparse.issparse(rhs):
+                    rhs = rhs.toarray()
+                values[name].append(np.asarray(rhs).ravel())
+
+        return dict((name, np.concatenate(values[name])) for name in names)
+
+    def _evaluate_group_batch(self, group, names, x, epar, select=None):
+        """Evaluate group with the batch methods of the element class
+
+        Returns None if batch evaluation is not possible
+        """
+        if self.toolkit.symbolic or x is None or group.params is None or \
+                group.nodemaparray is None:
+            return None
+
+        X = x[group.nodemaparray]
+        params = group.params
+        if select is not None:
+            X = X[select]
+            params = dict((name, value[select]) 
+                          for name, value in params.items())
+
+        try:
+            eval_all_batch = group.batchmethod('eval_all')
+            if eval_all_batch is not None:
+                result = eval_all_batch(X, params, epar, want=names)
+            else:
+                batches = [group.batchmethod(name) for name in names]
+                if None in batches:
+                    return None
+                result = dict((name, batch(X, params, epar)) 
+                              for name, batch in zip(names, batches))
+        except Exception, e:
+            raise e.__class__(str(e) + ' at element group ' + repr(group))
+
+        return dict((name, np.asarray(result[name]).ravel()) 
+                    for name in names)
+
+    def _evaluate_group_bypass(self, group, vectornames, matrixnames, x, epar,
+                               tol):
+        """Evaluate the elements of a nonlinear group and reuse the 
+        matrices of the elements whose x-vectors have changed less than tol
+        """
+        names = vectornames + matrixnames
+        nodemaps = group.nodemaparray
+        cache = self._bypasscache.get(group)
+
+        if x is None or nodemaps is None or self.toolkit.symbolic:
+            return self._evaluate_group(group, names, x, epar)
+
+        X = x[nodemaps]
+        m = len(group)
+
+        if cache is None or not set(matrixnames) <= set(cache[1]):
+            values = self._evaluate_group(group, names, x, epar)
+            self._bypasscache[group] = \
+                (X, dict((name, values[name].reshape(m, -1)) 
+                         for name in matrixnames))
+            return values
+
+        Xlast, matrices = cache
+        active = np.any(abs(X - Xlast) > tol, axis=1)
+        self.nbypass += m - np.count_nonzero(active)
+
+        ## Vectors of bypassed elements, and everything of the others
+        values = self._evaluate_group(group, names, x, epar, active)
+        if not np.all(active) and len(vectornames) > 0:
+            bypassed = self._evaluate_group(group, vectornames, x, epar, 
+                                            ~active)
+        else:
+            bypassed = {}
+
+        k = X.shape[1]
+        result = {}
+        for name in names:
+            if name in matrices:
+                out = matrices[name]
+            else:
+                out = np.zeros((m, k))
+                if name in bypassed:
+                    out[~active] = bypassed[name].reshape(-1, k)
+            out[active] = values[name].reshape(-1, out.shape[1])
+            result[name] = out.ravel()
+
+        Xlast[active] = X[active]
+        return result
+
+    def _evaluate(self, groups, methodname, x, args):
+        """Return the concatenated and flattened results of a method"""
+        values = []
+        for group in groups:
+            rhs = self._evaluate_batch(group, methodname, x, args)
+            if rhs is not None:
+                values.append(rhs.ravel())
+                continue
+
+            for instance, element, nodemap in zip(group.instances, 
+                                                  group.elements,
+                                                  group.nodemaps):
+                try:
+                    if methodname == 'u':
+                        rhs = element.u(*args)
+                    elif x is not None:
+                        rhs = getattr(element, methodname)(x[nodemap], *args)
+                    else:
+                        rhs = getattr(element, methodname)(None, *args)
+                except Exception, e:
+                    raise e.__class__(str(e) + ' at element ' + instance + 
+                                      ', args='+str(args))
+
+                if scipy.sparse.issparse(rhs):
+                    rhs = rhs.toarray()
+                values.append(np.asarray(rhs).ravel())
+
+        if len(values) == 0:
+            return np.zeros(0)
+        return np.concatenate(values)
+
+    def _evaluate_batch(self, group, methodname, x, args):
+        """Evaluate a method of a group with the batch method of the element
+        class
+
+        Returns None if batch evaluation is not possible
+        """
+        if self.toolkit.symbolic:
+            return None
+
+        batch = group.batchmethod(methodname)
+        if batch is None or group.params is None or \
+                group.nodemaparray is None:
+            return None
+
+        try:
+            if methodname == 'u':
+                return batch(args[0], group.params, *args[1:])
+            elif x is not None:
+                return batch(x[group.nodemaparray], group.params, *args)
+        except Exception, e:
+            raise e.__class__(str(e) + ' at element group ' + repr(group) + 
+                              ', args='+str(args))
+
+    def _vector(self, methodname, x, args, dtype=None):
+        lhs = self.toolkit.zeros(self.n, dtype=dtype)
+
+        np.add.at(lhs, self._indices[0], 
+                  self._evaluate(self.groups, methodname, x, args))
+
+        return lhs
+
+    def _check_epar(self, epar):
+        """Clear the constant stamps if the environment parameters changed
+
+        The constant stamps are stored for one set of environment parameter
+        values at a time
+        """
+        eparvalues = (epar, tuple(epar.items()))
+        if self._epar != eparvalues:
+            self._constant = {}
+            self._bypasscache = {}
+            self._epar = eparvalues
+
+    def _stamppattern(self, methodname, rows, cols):
+        pattern = self._stamppatterns.get(methodname)
+        if pattern is None or not pattern.matches(rows, cols):
+            pattern = StampPattern(rows, cols, (self.n, self.n))
+            self._stamppatterns[methodname] = pattern
+        return pattern
+
+    def _constant_stamps(self, methodname, args, sparse):
+        """Calculate stamps of the linear elements 
+
+        For sparse matrices the flattened stamp values are returned, 
+        otherwise the stamps are added to a dense matrix
+        """
+        x = self.toolkit.zeros(self.n)
+        data = self._evaluate(self.lineargroups, methodname, x, args)
+        if sparse:
+            return data
+        nodemaps, rows, cols = self._linearindices
+        lhs = self.toolkit.zeros((self.n, self.n))
+        np.add.at(lhs, (rows, cols), data)
+        return lhs
+
+    @staticmethod
+    def _index_vectors(groups):
+        """Concatenate the stamp indices of the elements in the groups"""
+        indices = [stamp_indices(nodemap) for group in groups 
+                   for nodemap in group.nodemaps]
+        if len(indices) == 0:
+            return (np.zeros(0, dtype=int),) * 3
+        return tuple(np.concatenate(a) for a in zip(*indices))
+
+    @staticmethod
+    def _xsubcircuits(circuit, instances=None):
+        """Iterator over all flattened subcircuits of the hierarchy"""
+        yield circuit
+        if instances is None:
+            instances = circuit.elements.keys()
+        for name in instances:
+            element = circuit.elements[name]
+            if isinstance(element, SubCircuit) and element._isflattenable():
+                for subcircuit in CompiledCircuit._xsubcircuits(element):
+                    yield subcircuit
+
+class CircuitOverlay(SubCircuit):
+    """Copy-on-write clone of a circuit
+
+    The overlay shares the element objects, the node maps and the compiled
+    representation with the base circuit and only records which instances
+    are added to or removed from the overlay. The matrices and vectors of 
+    the overlay are assembled from the compiled base circuit plus the added
+    instances, so adding for example a test source costs in proportion to 
+    the change and not to the size of the circuit. When instances are 
+    removed the base circuit is compiled again without them.
+
+    As the elements are shared an instance should be replaced by a new 
+    instance rather than modified in place. The base circuit must not be 
+    changed while the overlay is in use. A copy of an overlay is a new 
+    overlay on top of it.
+
+    **Attributes**
+        *base*
+          the circuit the overlay was created from
+
+        *added*
+          set of names of the instances added to the overlay
+
+        *removed*
+          set of names of the instances of the base circuit that are 
+          removed or replaced in the overlay
+
+    """
+    def __init__(self, base):
+        super(CircuitOverlay, self).__init__(toolkit=base.toolkit)
+        self.base = base
+        self.added = set()
+        self.removed = set()
+
+        self.terminals = list(base.terminals)
+        self.nodes = list(base.nodes)
+        self.nodenames = dict(base.nodenames)
+        self.branches = list(base.branches)
+        self.elements = dict(base.elements)
+        self.term_node_map = dict(base.term_node_map)
+        self.elementnodemap = base.elementnodemap
+        self._branchinstances = set(base._branchinstances)
+
+        ## Instance parameters of the elements are evaluated in the base
+        self.ipar = base.ipar
+        self.iparv = base.iparv
+
+        ## Start from the index maps of the base circuit
+        self._indexmaps = {}
+        for listname in 'nodes', 'branches':
+            items = getattr(self, listname)
+            self._indexmaps[listname] = \
+                [items, len(items), dict(base._indexmap(listname))]
+
+        ## True as long as nodes and branches have only been appended
+        self._appendonly = True
+
+    def __copy__(self):
+        return self.overlay()
+
+    def add_instance(self, instancename, instance, **connection):
+        super(CircuitOverlay, self).add_instance(instancename, instance, 
+                                                 **connection)
+        self.added.add(instancename)
+
+    def __delitem__(self, instancename):
+        super(CircuitOverlay, self).__delitem__(instancename)
+        if instancename in self.added:
+            self.added.remove(instancename)
+        else:
+            self.removed.add(instancename)
+
+    def _invalidate_indices(self):
+        super(CircuitOverlay, self)._invalidate_indices()
+        self._appendonly = False
+
+    def _base_indexmap(self):
+        """Return the indices in the x-vector of the overlay of the elements
+        in the x-vector of the base circuit, -1 for removed nodes and branches
+        """
+        base = self.base
+        if self._appendonly:
+            return np.concatenate((np.arange(len(base.nodes)),
+                                   len(self.nodes) + 
+                                   np.arange(len(base.branches))))
+
+        indexmap = -np.ones(base.n, dtype=int)
+        for index, node in enumerate(base.nodes):
+            overlayindex = self._lookup_index('nodes', node)
+            if overlayindex is not None:
+                indexmap[index] = overlayindex
+
+        ## Branches are not unique, e.g. parallel voltage sources, so they
+        ## are mapped through the instances they belong to
+        for name in base._branchinstances:
+            if name in self.elements and name not in self.added:
+                nbranches = len(base.elements[name].branches)
+                basemap = base.elementnodemap[name]
+                overlaymap = self.elementnodemap[name]
+                indexmap[basemap[len(basemap) - nbranches:]] = \
+                    overlaymap[len(overlaymap) - nbranches:]
+        return indexmap
+
+    def _compile(self):
+        if self._compiled is None or not self._compiled.isvalid():
+            if self._compiled is not None:
+                self._compiled.release()
+            self._compiled = CompiledOverlay(self)
+        return self._compiled
+
+class CompiledOverlay(CompiledCircuit):
+    """Compiled representation of a CircuitOverlay
+
+    The values of the compiled base circuit are mapped to the indices of
+    the overlay and the values of the added instances are added. The 
+    removed instances are left out of a separate compilation of the base 
+    circuit rather than subtracted, which would lose precision and give 
+    NaN for infinite values.
+
+    """
+    def __init__(self, overlay):
+        self.circuit = overlay
+        self.toolkit = overlay.toolkit
+        self.n = overlay.n
+
+        base = overlay.base
+        self._ownbase = len(overlay.removed) > 0
+        if self._ownbase:
+            self.base = CompiledCircuit(base, instances=
+                [name for name in base.elements 
+                 if name not in overlay.removed])
+        else:
+            self.base = base.compile()
+        self._basen = base.n
+        self.indexmap = overlay._base_indexmap()
+        self._keep = self.indexmap >= 0
+
+        ## When nodes and branches have only been appended the base nodes
+        ## and branches are mapped as two contiguous blocks
+        if overlay._appendonly:
+            nnodes = len(base.nodes)
+            self._blocks = [(slice(0, nnodes), slice(0, nnodes)),
+                            (slice(nnodes, base.n), 
+                             slice(len(overlay.nodes), 
+                                   len(overlay.nodes) + base.n - nnodes))]
+        else:
+            self._blocks = None
+
+        self.added = CompiledCircuit(overlay, instances=overlay.added)
+
+    def isvalid(self):
+        base = self.circuit.base
+        return self.n == self.circuit.n and self._basen == base.n and \
+            self.added.isvalid() and self.base.isvalid()
+
+    @property
+    def linear(self):
+        return self.base.linear and self.added.linear
+
+    def release(self):
+        self.added.release()
+        if self._ownbase:
+            self.base.release()
+
+    def _base_x(self, x):
+        """Map x-vector of the overlay to the base circuit"""
+        if x is None:
+            return None
+        ## Removed nodes and branches are mapped to a zero
+        return np.concatenate((x, np.zeros(1, dtype=x.dtype)))[self.indexmap]
+
+    def _to_overlay(self, value, out=None):
+        """Map vector or matrix of the base circuit to the overlay and add
+        it to *out* if given"""
+        keep, indices = self._keep, self.indexmap[self._keep]
+        if scipy.sparse.issparse(value):
+            value = value.tocoo()
+            selected = keep[value.row] & keep[value.col]
+            mapped = scipy.sparse.csr_matrix(
+                (value.data[selected], 
+                 (self.indexmap[value.row[selected]], 
+                  self.indexmap[value.col[selected]])),
+                shape=(self.n, self.n))
+            if out is None:
+                return mapped
+            return out + mapped
+
+        value = np.asarray(value)
+        if out is None:
+            out = np.zeros((self.n,) * value.ndim, dtype=value.dtype)
+        elif scipy.sparse.issparse(out) or \
+                np.result_type(out, value) != out.dtype:
+            return out + self._to_overlay(value)
+
+        if self._blocks is not None:
+            for basei, i in self._blocks:
+                if value.ndim == 1:
+                    out[i] += value[basei]
+                else:
+                    for basej, j in self._blocks:
+                        out[i, j] += value[basei, basej]
+        elif value.ndim == 1:
+            out[indices] += value[keep]
+        else:
+            out[np.ix_(indices, indices)] += value[np.ix_(keep, keep)]
+        return out
+
+    def _evaluate_base(self, compiled, x, t, epar, analysis, want, sparse,
+                       bypass):
+        if isinstance(compiled, CompiledCircuit):
+            return compiled.eval_all(x, t, epar, analysis, want, sparse, 
+                                     bypass)
+        return compiled.eval_all(x, t, epar, analysis, want)
+
+    def eval_all(self, x, t=0.0, epar=defaultepar, analysis=None,
+                 want=('i', 'q', 'G', 'C', 'u'), sparse=None, bypass=None):
+        xbase = self._base_x(x)
+        base = self._evaluate_base(self.base, xbase, t, epar, analysis, want,
+                                   sparse, bypass)
+        result = self.added.eval_all(x, t, epar, analysis, want, sparse, 
+                                     bypass)
+        for name in want:
+            result[name] = self._to_overlay(base[name], out=result[name])
+
+        return result
+
+    def CY(self, x, w, epar=defaultepar, sparse=None):
+        xbase = self._base_x(x)
+        if isinstance(self.base, CompiledCircuit):
+            value = self.base.CY(xbase, w, epar, sparse=sparse)
+        else:
+            value = self.base.CY(xbase, w, epar)
+        return self._to_overlay(value, 
+                                out=self.added.CY(x, w, epar, sparse=sparse))
+
+    def next_event(self, t, discontinuous=False):
+        return min(self.added.next_event(t, discontinuous), 
+                   self.base.next_event(t, discontinuous))
+
+    def limit(self, xnew, xold, epar=defaultepar):
+        xbasenew, xbaseold = self._base_x(xnew), self._base_x(xold)
+        scale = min(_limit_ratio(self.added.limit(xnew, xold, epar) - xold,
+                                 xnew - xold),
+                    _limit_ratio(self.base.limit(xbasenew, xbaseold, epar) -
+                                 xbaseold, xbasenew - xbaseold))
+        if scale < 1:
+            return xold + scale * (xnew - xold)
+        return xnew
+
 class ProbeWrapper(SubCircuit):
     """Circuit wrapper that adds voltage sources for current probing"""
     def __init__(self, circuit, terminals = ()):
@@ -1308,12 +2689,16 @@ class CircuitProxy(Circuit):
         self.nodenames = circuit.nodenames
         self.branches = circuit.branches
         self.iparv = circuit.iparv
+        self.linear = circuit.linear
         
         ## Find out how this instance was connected to its parent
         ## and set terminalhook accordingly
         if isinstance(parent, SubCircuit) and instance_name != None:
             self.terminalhook = parent.term_node_map[instance_name]
 
+    def hashkey(self):
+        return super(CircuitProxy, self).hashkey() + (self.device.hashkey(),)
+
     def G(self, x, epar=defaultepar): return self.device.G(x,epar)
     def C(self, x, epar=defaultepar): return self.device.C(x,epar)
     def u(self, t=0.0, epar=defaultepar, analysis=None): 
@@ -1336,6 +2721,7 @@ def instjoin(*instnames):
 class IProbe(Circuit):
     """Zero voltage independent voltage source used for current probing"""
     terminals = ['plus', 'minus']
+    linear = True
 
     def __init__(self, plus, minus, **kvargs):
         Circuit.__init__(self, plus, minus, **kvargs)
@@ -1,8 +1,14 @@
 import logging
+import multiprocessing
+import multiprocessing.util
+import time
+import weakref
 
 import numpy as np
 
 from analysis import *
+from pycircuit.circuit.circuit import CompiledCircuit
+from pycircuit.circuit.opstore import topology_digest
 
 class DC(Analysis):
     """DC analyis class
@@ -39,6 +45,14 @@ class DC(Analysis):
     >>> print np.around(res.v('net2'), 2)
     0.7
 
+    The convergence strategies are tried in the order given by the 
+    *strategies* parameter. The iterate with the smallest residual of a 
+    failed strategy is used as starting point of the next one.
+
+    >>> dc = DC(c, strategies=['ptran'])
+    >>> print np.around(dc.solve().v('net2'), 2)
+    0.7
+
     """
     parameters = [Parameter(name='reltol', desc='Relative tolerance', unit='', 
                             default=1e-4),
@@ -51,6 +65,41 @@ class DC(Analysis):
                   Parameter(name='maxiter', 
                             desc='Maximum number of iterations', unit='', 
                             default=100),
+                  Parameter(name='chord', 
+                            desc='Reuse the Jacobian factorization between '
+                            'Newton iterations and bypass unchanged devices',
+                            unit='', default=False),
+                  Parameter(name='bypasstol', 
+                            desc='Largest change of the x-vector of a device '
+                            'whose G matrix is reused in chord mode', 
+                            unit='V', default=1e-6),
+                  Parameter(name='strategies', 
+                            desc='Convergence strategies to try in order, '
+                            'simple, gmin, source or ptran', 
+                            unit='', 
+                            default=('simple', 'gmin', 'source', 'ptran')),
+                  Parameter(name='ptrancap', 
+                            desc='Node capacitance of pseudo-transient '
+                            'continuation', unit='F', default=1e-12),
+                  Parameter(name='ptranstep', 
+                            desc='Initial pseudo-transient time step', 
+                            unit='s', default=1e-9),
+                  Parameter(name='ptransteps', 
+                            desc='Maximum number of pseudo-transient steps', 
+                            unit='', default=200),
+                  Parameter(name='store', 
+                            desc='OperatingPointStore of starting points '
+                            'and solutions', unit='', default=None),
+                  Parameter(name='parallel', 
+                            desc='Race the strategies after the first one '
+                            'in a process pool', unit='', default=False),
+                  Parameter(name='processes', 
+                            desc='Number of processes when racing '
+                            'strategies, default is one per strategy', 
+                            unit='', default=None),
+                  Parameter(name='timeout', 
+                            desc='Longest time to wait for the raced '
+                            'strategies', unit='s', default=600),
                   Parameter(name='epar', desc='Environment parameters',
                             default=defaultepar)
                   ]
@@ -60,52 +109,229 @@ class DC(Analysis):
         super(DC, self).__init__(cir, toolkit=toolkit, **kvargs)
         
         self.irefnode = self.cir.get_node_index(refnode)
+
+        ## Linear solver that is shared by all Newton iterations
+        self.solver = self.create_solver()
+
+        ## Newton iterations of the last call to fsolve and of all 
+        ## algorithms of the last solve
+        self.infodict = {}
+        self.niter = 0
+
+        ## Name of the strategy that converged in the last solve
+        self.strategy = None
+
+        ## Process pool and cancellation event of parallel strategies
+        self._pool = None
+        self._poolkey = None
+        self._poolfinalizer = None
+        self._cancel = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_pool=None, _poolkey=None, _poolfinalizer=None, 
+                     _cancel=None)
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Terminate the worker processes of parallel strategies
+
+        The workers are also terminated when the analysis is garbage 
+        collected or at the end of a with statement.
+        """
+        if self._pool is not None:
+            self._poolfinalizer()
+            self._pool.join()
+            self._pool = None
+            self._poolkey = None
+            self._poolfinalizer = None
         
-    def solve(self):
-        ## Refer the voltages to the reference node by removing
-        ## the rows and columns that corresponds to this node
+    def solve(self, x0=None):
+        """Solve the operating point starting from the initial guess x0
 
-        convergence_helpers = [self._simple, self._homotopy_gmin, 
-                               self._homotopy_source, 
-                               None]
+        The default initial guess is the closest state of the store 
+        parameter if given, otherwise zero for all nodes and branches. 
+        The solution is saved in the store.
+        """
+        store = self.par.store
+        if x0 is None and store is not None:
+            x0 = store.load(self.cir, 'dc')
+        if x0 is None:
+            x0 = self.toolkit.zeros(self.cir.n)
 
-        x0 = self.toolkit.zeros(self.cir.n) # Would be good with a better initial guess
+        ## Total number of Newton iterations of all algorithms
+        self.niter = 0
 
-        for algorithm in convergence_helpers:
-            if algorithm == None:
-                raise last_e
-            else:
-                if algorithm.__doc__:
-                    logging.info('Trying ' + algorithm.__doc__)
-                try:
-                    x = algorithm(x0)
-                except (NoConvergenceError, SingularMatrix), last_e:
-                    logging.warning('Problems encoutered: ' + str(last_e))
-                else:
-                    break
+        x = self._solve(x0)
+
+        if store is not None:
+            store.save(self.cir, x, 'dc')
 
         self.result = CircuitResult(self.cir, x)
 
         return self.result
 
+    def _solve(self, x0):
+        """Try the convergence strategies in turn and return the solution
+
+        A failed strategy that got closer to the solution than the 
+        starting point hands over its best iterate to the next strategy.
+        With the parallel parameter set the strategies after the first one
+        are started at the same time in a process pool.
+        """
+        strategies = self._strategies()
+
+        for name in self.par.strategies:
+            if name not in strategies:
+                raise ValueError('Unknown DC strategy %s' % name)
+
+        if len(self.par.strategies) == 0:
+            raise ValueError('No DC strategies given')
+
+        cir = self.cir.compile()
+        residual0 = None
+
+        for k, name in enumerate(self.par.strategies):
+            if self.par.parallel and k == 1 and \
+                    len(self.par.strategies) > 2:
+                return self._race(self.par.strategies[1:], x0)
+
+            algorithm = strategies[name]
+            if algorithm.__doc__:
+                logging.info('Trying ' + algorithm.__doc__)
+            try:
+                x = algorithm(x0)
+                self.strategy = name
+                return x
+            except (NoConvergenceError, SingularMatrix), last_e:
+                logging.warning('Problems encoutered: ' + str(last_e))
+
+            xbest = getattr(last_e, 'x', None)
+            if xbest is not None:
+                if residual0 is None:
+                    residual0 = self._residual(cir, x0)
+                residual = self._residual(cir, xbest)
+                if residual < residual0:
+                    x0, residual0 = xbest, residual
+
+        raise last_e
+
+    def _strategies(self):
+        return {'simple': self._simple, 
+                'gmin': self._homotopy_gmin, 
+                'source': self._homotopy_source,
+                'ptran': self._pseudo_transient}
+
+    def _race(self, names, x0):
+        """Start the strategies in a process pool and return the first 
+        solution
+
+        The other strategies are cancelled when one has converged. The pool
+        is kept for later solves as long as the circuit topology is 
+        unchanged, new parameter values of the circuit and the analysis 
+        are sent to the workers.
+        """
+        key = topology_digest(self.cir)
+        if self._pool is None or key != self._poolkey:
+            self.close()
+            ## The workers get a copy of the analysis and circuit when 
+            ## they are started. The pool only keeps a weak reference so 
+            ## the analysis can be garbage collected.
+            self._cancel = multiprocessing.Event()
+            self._pool = multiprocessing.Pool(
+                self.par.processes or len(names), 
+                initializer=_init_worker, 
+                initargs=(weakref.ref(self), self._cancel))
+            self._poolkey = key
+            self._poolfinalizer = multiprocessing.util.Finalize(
+                self, self._pool.terminate)
+
+        ## The parameters are sent with every task as they may have 
+        ## changed since the workers were started
+        values = ([dict(paramdict.items()) 
+                   for paramdict in _instance_parameters(self.cir)],
+                  dict(self.epar.items()),
+                  dict((name, value) for name, value in self.par.items()
+                       if name != 'epar'))
+
+        self._cancel.clear()
+        tasks = dict((self._pool.apply_async(_race_worker, 
+                                             (name, x0, values)), name)
+                     for name in names)
+
+        x = None
+        deadline = time.time() + self.par.timeout
+        pending = list(tasks)
+        try:
+            while pending and x is None:
+                finished = [task for task in pending if task.ready()]
+                if len(finished) == 0:
+                    if time.time() > deadline:
+                        raise NoConvergenceError(
+                            'Timeout waiting for strategies %s' % 
+                            ', '.join(tasks[task] for task in pending))
+                    pending[0].wait(0.01)
+                    continue
+
+                for task in finished:
+                    pending.remove(task)
+                    try:
+                        name, xresult, niter, error = task.get()
+                    except Exception, e:
+                        ## The task failed in the pool, for example when 
+                        ## the result could not be pickled
+                        name, xresult, niter, error = \
+                            tasks[task], None, 0, str(e)
+                    self.niter += niter
+                    if error is None:
+                        logging.info('Strategy %s converged first' % name)
+                        x, self.strategy = xresult, name
+                        break
+                    logging.warning('Problems encoutered: ' + error)
+        finally:
+            ## Let the remaining tasks stop so the pool is idle
+            self._cancel.set()
+            for task in pending:
+                task.wait(max(deadline - time.time(), 0))
+            if all(task.ready() for task in pending):
+                self._cancel.clear()
+            else:
+                ## A worker that died never finishes its task
+                self.close()
+
+        if x is None:
+            raise NoConvergenceError('No strategy of %s converged' % 
+                                     ', '.join(names))
+        return x
+
     def _simple(self, x0):
         """Simple Newton's method"""
-        def func(x):
-            return self.cir.i(x) + self.cir.u(0,analysis='dc'), self.cir.G(x)
+        cir = self.cir.compile()
+        def func(x, jacobian=True):
+            return self._evaluate(cir, x, jacobian)
 
         return self._newton(func, x0)
 
     def _homotopy_gmin(self, x0):
         """Newton's method with gmin stepping"""
+        cir = self.cir.compile()
         x = x0
         for gmin in (1, 1e-1, 1e-2, 0):
             n_nodes = len(self.cir.nodes)
             Ggmin = self.toolkit.zeros((self.cir.n, self.cir.n))
             Ggmin[0:n_nodes, 0:n_nodes] = gmin * self.toolkit.eye(n_nodes)
 
-            def func(x):
-                return self.cir.i(x) + self.cir.u(0,analysis='dc'), \
-                       self.cir.G(x) + Ggmin
+            def func(x, jacobian=True):
+                f, G = self._evaluate(cir, x, jacobian)
+                if G is None:
+                    return f, None
+                return f, G + Ggmin
 
             x, x0 = self._newton(func, x0), x
 
@@ -113,16 +339,99 @@ class DC(Analysis):
 
     def _homotopy_source(self, x0):
         """Newton's method with source stepping"""
+        cir = self.cir.compile()
         x = x0
         for lambda_ in (0, 1e-2, 1e-1, 1):
-            def func(x):
-                f = self.cir.i(x) + lambda_ * self.cir.u(0,analysis='dc')
-                dFdx = self.cir.G(x)
+            def func(x, jacobian=True):
+                f = cir.i(x, self.epar) + \
+                    lambda_ * cir.u(0, self.epar, analysis='dc')
+                if not jacobian:
+                    return f, None
+                dFdx = cir.G(x, self.epar)
                 return f, dFdx            
             x, x0 = self._newton(func, x0), x
 
         return x
 
+    def _pseudo_transient(self, x0):
+        """Newton's method with pseudo-transient continuation"""
+        cir = self.cir.compile()
+
+        ## Artificial capacitance from every node to ground
+        n_nodes = len(self.cir.nodes)
+        Cnodes = self.toolkit.zeros((self.cir.n, self.cir.n))
+        Cnodes[0:n_nodes, 0:n_nodes] = \
+            self.par.ptrancap * self.toolkit.eye(n_nodes)
+
+        h = self.par.ptranstep
+        x = x0
+        fnorm = self._residual(cir, x)
+        for step in xrange(self.par.ptransteps):
+            xprev = x
+            Ch = Cnodes / h
+            def func(x, jacobian=True):
+                f, G = self._evaluate(cir, x, jacobian)
+                f = f + self.toolkit.dot(Ch, x - xprev)
+                if G is None:
+                    return f, None
+                return f, G + Ch
+
+            try:
+                x = self._newton(func, xprev)
+            except (NoConvergenceError, SingularMatrix):
+                x = xprev
+                h /= 4
+                continue
+
+            ## Switched evolution relaxation of the pseudo time step, the 
+            ## step is at least doubled when the Newton iterations converge
+            ## at once as the residual then only changes by round-off
+            fnormnew = self._residual(cir, x)
+            if fnormnew > 0:
+                factor = min(max(fnorm / fnormnew, 0.5), 10)
+            else:
+                factor = 10
+            if self.infodict['niter'] <= 2:
+                factor = max(factor, 2)
+            h *= factor
+            fnorm = fnormnew
+
+            ## Try to finish with the real circuit when the artificial 
+            ## conductance is negligible
+            if self.par.ptrancap / h < self.par.iabstol:
+                try:
+                    return self._simple(x)
+                except (NoConvergenceError, SingularMatrix):
+                    pass
+
+        e = NoConvergenceError('Pseudo-transient continuation did not '
+                               'converge in %d steps' % self.par.ptransteps)
+        e.x = x
+        raise e
+
+    def _residual(self, cir, x):
+        """Return the 2-norm of the residual at x without the reference 
+        node row"""
+        f, G = self._evaluate(cir, x, False)
+        f = self.toolkit.delete(f, self.irefnode, axis=0)
+        return self.toolkit.sqrt(self.toolkit.dot(f, f))
+
+    def _evaluate(self, cir, x, jacobian=True):
+        """Return i + u and G of the compiled circuit, G is None if not 
+        *jacobian*"""
+        if jacobian:
+            want = ('i', 'u', 'G')
+        else:
+            want = ('i', 'u')
+
+        kvargs = {}
+        if self.par.chord and isinstance(cir, CompiledCircuit):
+            kvargs['bypass'] = self.par.bypasstol
+
+        values = cir.eval_all(x, 0, self.epar, analysis='dc', want=want, 
+                              **kvargs)
+        return values['i'] + values['u'], values.get('G')
+
     def _newton(self, func, x0):
         ones_nodes = self.toolkit.ones(len(self.cir.nodes))
         ones_branches = self.toolkit.ones(len(self.cir.branches))
@@ -134,6 +443,13 @@ class DC(Analysis):
 
         (x0, abstol, xtol) = remove_row_col((x0, abstol, xtol), self.irefnode, self.toolkit)
 
+        if self._cancel is not None and self._cancel.is_set():
+            raise NoConvergenceError('Cancelled')
+
+        cir = self.cir.compile()
+        def limit(xnew, xold):
+            return cir.limit(xnew, xold, self.epar)
+
         try:
             result = fsolve(refnode_removed(func, self.irefnode,self.toolkit), 
                             x0, 
@@ -141,17 +457,216 @@ class DC(Analysis):
                             reltol = self.par.reltol,
                             abstol = abstol, xtol=xtol,
                             maxiter = self.par.maxiter,
-                            toolkit = self.toolkit)
+                            toolkit = self.toolkit,
+                            solver = self.solver,
+                            limit = refnode_removed_limit(limit, self.irefnode,
+                                                          self.toolkit),
+                            chord = self.par.chord)
         except self.toolkit.linearsolverError(), e:
             raise SingularMatrix(e.message)
 
         x, infodict, ier, mesg = result
 
+        self.infodict = infodict
+        self.niter += infodict['niter']
+
         if ier != 1:
-            raise NoConvergenceError(mesg)
+            e = NoConvergenceError(mesg)
+            e.x = self._insert_refnode(infodict['xbest'])
+            raise e
+
+        return self._insert_refnode(x)
+
+    def _insert_refnode(self, x):
+        """Insert reference node voltage"""
+        return self.toolkit.concatenate((x[:self.irefnode], 
+                                         self.toolkit.array([0.0]), 
+                                         x[self.irefnode:]))
+
+## Analysis of a worker process that races DC strategies
+_worker_analysis = None
+
+def _init_worker(analysisref, cancel):
+    global _worker_analysis
+    _worker_analysis = analysis = analysisref()
+    analysis._cancel = cancel
+
+def _instance_parameters(cir):
+    """Return instance parameters of all circuits of the hierarchy in 
+    a fixed order"""
+    paramdicts = [cir.ipar]
+    if isinstance(cir, SubCircuit):
+        for name in sorted(cir.elements):
+            paramdicts.extend(_instance_parameters(cir.elements[name]))
+    return paramdicts
+
+def _race_worker(name, x0, values):
+    """Run a DC strategy and return name, solution, iterations and error"""
+    analysis = _worker_analysis
+    analysis.niter = 0
+
+    ## Only changed values are set and notified to the circuit
+    ipars, epar, par = values
+    for paramdict, paramvalues in zip(_instance_parameters(analysis.cir), 
+                                      ipars):
+        paramdict.set(**paramvalues)
+    analysis.epar.set(**epar)
+    analysis.par.set(**par)
+
+    try:
+        x = analysis._strategies()[name](x0)
+    except Exception, e:
+        ## The result is always returned as the pool never calls the 
+        ## callback of a failed task
+        return name, None, analysis.niter, '%s: %s' % (name, e)
+    return name, x, analysis.niter, None
+
+class DCSweep(DC):
+    """DC sweep analysis
+
+    The operating point is solved for a sequence of values of an instance 
+    parameter, for example the voltage of a source, or of an environment 
+    parameter such as the temperature. The initial guess of each point is 
+    extrapolated from the solutions of the previous points (see the 
+    predictor parameter) so usually only one or two Newton iterations are 
+    needed per point.
+
+    When Newton's method fails the step to the point is halved and 
+    intermediate points are solved first, up to *maxdivide* times. If it 
+    converges in more than *stepiter* iterations the step to the next 
+    intermediate point is halved instead. The intermediate points are not 
+    included in the result.
+
+    >>> c = SubCircuit()
+    >>> c['vs'] = VS('in', gnd, v=0)
+    >>> c['R'] = R('in', 'out', r=1e3)
+    >>> c['D'] = Diode('out', gnd)
+    >>> sweep = DCSweep(c)
+    >>> res = sweep.solve(np.linspace(0, 5, 11), param='v', instance='vs')
+    >>> print np.around(res.v('out').y[::5], 3)
+    [ 0.     0.611  0.633]
+
+    The temperature is swept if no instance is given:
+
+    >>> c['vs'].ipar.v = 5
+    >>> res = sweep.solve([250, 300, 350], param='T')
+    >>> print np.around(res.v('out').y, 3)
+    [ 0.528  0.633  0.738]
+
+    """
+    parameters = [Parameter(name='predictor', 
+                            desc="Initial guess of each point, 'constant', "
+                            "'linear' or 'quadratic' extrapolation", unit='',
+                            default='quadratic'),
+                  Parameter(name='stepiter', 
+                            desc='Number of Newton iterations above which '
+                            'the sweep step is reduced', unit='', default=8),
+                  Parameter(name='maxdivide', 
+                            desc='Maximum number of times the step to a '
+                            'point is halved', unit='', default=10)
+                  ]
+
+    def __init__(self, cir, toolkit=None, refnode=gnd, **kvargs):
+        self.parameters = super(DCSweep, self).parameters + self.parameters
+        super(DCSweep, self).__init__(cir, toolkit=toolkit, refnode=refnode,
+                                      **kvargs)
+
+    def solve(self, values, param='T', instance=None):
+        """Sweep parameter *param* over *values*
+
+        If *instance* is given the parameter is an instance parameter of 
+        that (hierarchical) instance, otherwise an environment parameter or 
+        a parameter of the circuit. The parameter is restored afterwards.
+
+        Returns a CircuitResult with the swept parameter as x-axis.
+        """
+        if instance is not None:
+            paramdict = self.cir[instance].ipar
+            label = instjoin(instance, param)
+        elif param in self.epar:
+            ## Don't change the environment parameters of other analyses
+            self.epar = paramdict = self.epar.copy()
+            label = param
+        else:
+            paramdict = self.cir.ipar
+            label = param
+
+        oldvalue = paramdict.get(param)
+
+        self.niter = 0
+        history = []
+        X = []
+        try:
+            for value in values:
+                X.append(self._continue(paramdict, param, value, history))
+        finally:
+            paramdict.set(**{param: oldvalue})
+
+        self.result = CircuitResult(self.cir, x=self.toolkit.array(X).T, 
+                                    sweep_values=self.toolkit.array(values), 
+                                    sweep_label=label, 
+                                    sweep_unit=paramdict[param].unit or '')
+
+        return self.result
 
-        # Insert reference node voltage
-        return self.toolkit.concatenate((x[:self.irefnode], self.toolkit.array([0.0]), x[self.irefnode:]))
+    def _continue(self, paramdict, param, target, history):
+        """Solve the point at parameter value *target* continuing from the
+        accepted points in *history*"""
+        if len(history) == 0:
+            paramdict.set(**{param: target})
+            x = self._solve(self.toolkit.zeros(self.cir.n))
+            history.append((target, x))
+            return x
+
+        start = history[-1][0]
+        step = target - start
+        divisions = 0
+        while True:
+            value = start + step
+            paramdict.set(**{param: value})
+            x0 = self._predict(history, value)
+
+            niter = self.niter
+            try:
+                x = self._simple(x0)
+            except (NoConvergenceError, SingularMatrix), e:
+                if divisions < self.par.maxdivide:
+                    logging.info('Reducing sweep step at %s = %s'%
+                                 (param, str(value)))
+                    step /= 2.
+                    divisions += 1
+                    continue
+                x = self._solve(x0)
+
+            history.append((value, x))
+            del history[:-3]
+
+            if value == target:
+                return x
+
+            ## Increase the step again unless Newton's method was slow
+            start = value
+            if self.niter - niter > self.par.stepiter:
+                step /= 2.
+            else:
+                step *= 2
+            if abs(step) >= abs(target - start):
+                step = target - start
+
+    def _predict(self, history, value):
+        """Extrapolate the solution at parameter value from earlier points"""
+        order = {'constant': 0, 'linear': 1, 'quadratic': 2}[self.par.predictor]
+        points = history[-(order + 1):]
+
+        ## Lagrange polynomial through the points
+        x = 0
+        for i, (vi, xi) in enumerate(points):
+            weight = 1.
+            for j, (vj, xj) in enumerate(points):
+                if j != i:
+                    weight *= (value - vj) / float(vi - vj)
+            x = x + weight * xi
+        return x
 
 def refnode_removed(func, irefnode,toolkit):
     def new(x, *args, **kvargs):
@@ -160,6 +675,14 @@ def refnode_removed(func, irefnode,toolkit):
         return remove_row_col((f, J), irefnode, toolkit)
     return new
 
+def refnode_removed_limit(limit, irefnode, toolkit):
+    def new(xnew, xold):
+        xnew, xold = [toolkit.concatenate((x[:irefnode], toolkit.array([0.0]), 
+                                           x[irefnode:])) 
+                      for x in (xnew, xold)]
+        return remove_row_col((limit(xnew, xold),), irefnode, toolkit)[0]
+    return new
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -6,6 +6,16 @@ from __future__ import division
 from circuit import *
 import func
 
+## Stamp of a conductance between two terminals
+twoterminal_stamp = numeric.array([[1., -1.],
+                                   [-1., 1.]])
+
+## G matrix of an element with a voltage source branch between its two 
+## terminals
+vsource_stamp = numeric.array([[0., 0., 1.],
+                               [0., 0., -1.],
+                               [1., -1., 0.]])
+
 class R(Circuit):
     """Resistor element
 
@@ -26,6 +36,7 @@ class R(Circuit):
 
     """
     terminals = ('plus', 'minus')
+    linear = True
     instparams = [Parameter(name='r', desc='Resistance', unit='ohm', 
                             default=1e3),
                   Parameter(name='noisy', desc='No noise', unit='', 
@@ -39,6 +50,10 @@ class R(Circuit):
 
     def G(self, x, epar=defaultepar): return self._G
 
+    @classmethod
+    def G_batch(cls, X, params, epar=defaultepar):
+        return np.multiply.outer(1 / params['r'], twoterminal_stamp)
+
     def CY(self, x, w, epar=defaultepar):
         if self.iparv.noisy:
             iPSD = 4 * self.toolkit.kboltzmann * epar.T / self.iparv.r
@@ -61,6 +76,7 @@ class G(Circuit):
            [-0.001,  0.001]])
     """
     terminals = ('plus', 'minus')
+    linear = True
     instparams = [Parameter(name='g', desc='Conductance', unit='S', 
                             default=1e-3),
                   Parameter(name='noisy', desc='No noise', unit='', 
@@ -99,6 +115,7 @@ class C(Circuit):
     """
 
     terminals = ('plus', 'minus')
+    linear = True
     instparams = [Parameter(name='c', desc='Capacitance', 
                             unit='F', default=1e-12)]
 
@@ -109,6 +126,10 @@ class C(Circuit):
 
     def C(self, x, epar=defaultepar): return self._C
 
+    @classmethod
+    def C_batch(cls, X, params, epar=defaultepar):
+        return np.multiply.outer(params['c'], twoterminal_stamp)
+
 class L(Circuit):
     """Inductor
 
@@ -125,6 +146,7 @@ class L(Circuit):
            [  0.0000e+00,   0.0000e+00,  -1.0000e-09]])
    """
     terminals = ('plus', 'minus')
+    linear = True
     branches = (Branch(Node('plus'), Node('minus')),)
 
     instparams = [Parameter(name='L', desc='Inductance', 
@@ -142,6 +164,16 @@ class L(Circuit):
     def G(self, x, epar=defaultepar): return self._G
     def C(self, x, epar=defaultepar): return self._C
 
+    @classmethod
+    def G_batch(cls, X, params, epar=defaultepar):
+        return np.repeat(vsource_stamp[np.newaxis], len(X), axis=0)
+
+    @classmethod
+    def C_batch(cls, X, params, epar=defaultepar):
+        C = np.zeros((len(X), 3, 3))
+        C[:, -1, -1] = -params['L']
+        return C
+
 class VS(Circuit):
     """Independent DC voltage source
 
@@ -155,6 +187,7 @@ class VS(Circuit):
     
     """
     terminals = ('plus', 'minus')
+    linear = True
     branches = (Branch(Node('plus'), Node('minus')),)
     instparams = [Parameter(name='v', desc='Source DC voltage', 
                             unit='V', default=0),
@@ -174,6 +207,10 @@ class VS(Circuit):
 
     def G(self, x, epar=defaultepar): return self._G 
 
+    @classmethod
+    def G_batch(cls, X, params, epar=defaultepar):
+        return np.repeat(vsource_stamp[np.newaxis], len(X), axis=0)
+
     def u(self, t=0.0, epar=defaultepar, analysis=None):
         if analysis == 'ac':
             phase = self.iparv.phase * self.toolkit.pi / 180
@@ -185,6 +222,22 @@ class VS(Circuit):
         else:
             return self.toolkit.array([0, 0, 0])
 
+    @classmethod
+    def u_batch(cls, t, params, epar=defaultepar, analysis=None):
+        if analysis == 'ac':
+            phase = params['phase'] * np.pi / 180
+            v = params['vac'] * np.exp(1j*phase)
+        elif analysis in timedomain_analyses:
+            v = params['v'] + cls.function.f(t)
+        else:
+            v = np.zeros(len(params['v']))
+        u = np.zeros((len(v), 3), dtype=v.dtype)
+        u[:, 2] = -v
+        return u
+
+    def next_event(self, t, discontinuous=False):
+        return self.function.next_event(t, discontinuous)
+
     def CY(self, x, w, epar=defaultepar):
         CY = super(VS, self).CY(x, w)
         CY[2, 2] = self.iparv.noisePSD
@@ -213,6 +266,9 @@ class VSin(VS):
                   unit='1/s', default=0),
         Parameter(name='phase', desc='Phase in degrees', 
                   unit='deg', default=0)]
+    ## The time function is instance specific
+    u_batch = None
+
     def __init__(self, *args, **kvargs):
         super(VSin, self).__init__(*args, **kvargs)
         self.function = func.Sin(self.iparv.vo,
@@ -246,6 +302,7 @@ class IS(Circuit):
                             desc='Current noise power spectral density', 
                             unit='A^2/Hz', default=0.0)]
     terminals = ('plus', 'minus')
+    linear = True
     function = func.TimeFunction()
 
     def u(self, t=0.0, epar=defaultepar, analysis=None):
@@ -259,6 +316,20 @@ class IS(Circuit):
         else:
             return self.toolkit.array([0, 0])
 
+    @classmethod
+    def u_batch(cls, t, params, epar=defaultepar, analysis=None):
+        if analysis == 'ac':
+            phase = params['phase'] * np.pi / 180.
+            i = params['iac'] * np.exp(1j*phase)
+        elif analysis in timedomain_analyses:
+            i = params['i'] + cls.function.f(t)
+        else:
+            i = np.zeros(len(params['i']))
+        return np.column_stack((i, -i))
+
+    def next_event(self, t, discontinuous=False):
+        return self.function.next_event(t, discontinuous)
+
     def CY(self, x, w, epar=defaultepar):
         return  self.toolkit.array([[self.iparv.noisePSD, -self.iparv.noisePSD],
                                     [-self.iparv.noisePSD, self.iparv.noisePSD]])
@@ -281,6 +352,9 @@ class ISin(IS):
                   unit='1/s', default=0),
         Parameter(name='phase', desc='Phase in degrees', 
                   unit='deg', default=0)]
+    ## The time function is instance specific
+    u_batch = None
+
     def __init__(self, *args, **kvargs):
         super(ISin, self).__init__(*args, **kvargs)
         self.function = func.Sin(self.iparv.io,
@@ -312,6 +386,9 @@ class VPulse(VS):
         Parameter(name='per', desc='Period', 
                   unit='s', default=0)]
 
+    ## The time function is instance specific
+    u_batch = None
+
     def __init__(self, *args, **kvargs):
         super(VPulse, self).__init__(*args, **kvargs)
         self.function = func.Pulse(self.iparv.v1,
@@ -350,6 +427,7 @@ class VCVS(Circuit):
                             default=1)]
 
     terminals = ('inp', 'inn', 'outp', 'outn')
+    linear = True
     branches = (Branch(Node('outp'), Node('outn')),)
                
     def update(self, subject):
@@ -370,6 +448,17 @@ class VCVS(Circuit):
 
     def G(self, x, epar=defaultepar): return self._G
 
+    @classmethod
+    def G_batch(cls, X, params, epar=defaultepar):
+        G = np.zeros((len(X), 5, 5))
+        G[:, 2, 4] = 1
+        G[:, 3, 4] = -1
+        G[:, 4, 2] = -1
+        G[:, 4, 3] = 1
+        G[:, 4, 0] = params['g']
+        G[:, 4, 1] = -params['g']
+        return G
+
 
 class SVCVS(Circuit):
     """Voltage controlled voltage source with frequency dependent transfer
@@ -405,6 +494,7 @@ class SVCVS(Circuit):
                             unit=None, default='observable')]
 
     terminals = ('inp', 'inn', 'outp', 'outn')
+    linear = True
     branches = (Branch(Node('outp'), Node('outn')),)
 
     def __init__(self, *args, **kvargs):
@@ -532,6 +622,7 @@ class CCVS(Circuit):
                             default=1)]
 
     terminals = ('inp', 'inn', 'outp', 'outn')
+    linear = True
     branches = (Branch(Node('inp'), Node('inn')),Branch(Node('outp'), Node('outn')))
                
     def update(self, subject):
@@ -575,6 +666,7 @@ class VCCS(Circuit):
 
     """
     terminals = ('inp', 'inn', 'outp', 'outn')
+    linear = True
     instparams = [Parameter(name='gm', desc='Transconductance', 
                             unit='A/V', default=1e-3)]
     
@@ -593,6 +685,12 @@ class VCCS(Circuit):
 
     def G(self, x, epar=defaultepar): return self._G
 
+    @classmethod
+    def G_batch(cls, X, params, epar=defaultepar):
+        G = np.zeros((len(X), 4, 4))
+        G[:, 2:, :2] = np.multiply.outer(params['gm'], twoterminal_stamp)
+        return G
+
 class Nullor(Circuit):
     """Nullor
 
@@ -616,6 +714,7 @@ class Nullor(Circuit):
 
     """
     terminals = ('inp', 'inn', 'outp', 'outn')
+    linear = True
     branches = (Branch(Node('outp'), Node('outn')),)
 
     def update(self, subject):
@@ -656,6 +755,7 @@ class Transformer(Circuit):
     """
     instparams = [Parameter(name='n', desc='Winding ratio', unit='', default=1)]
     terminals = ('inp', 'inn', 'outp', 'outn')
+    linear = True
     branches = (Branch(Node('outp'), Node('outn')),)
 
     def update(self, subject):
@@ -694,6 +794,7 @@ class Gyrator(Circuit):
    """
 
     terminals = ('inp', 'inn', 'outp', 'outn')
+    linear = True
     instparams = [Parameter(name='gm', desc='Transconductance', 
                             unit='A/V', default=1e-3)]
     
@@ -718,6 +819,31 @@ class Gyrator(Circuit):
         
     def G(self, x, epar=defaultepar): return self._G
 
+def pnjlim(vnew, vold, vt, vcrit):
+    """Limit the update of a pn-junction voltage between Newton iterations
+
+    Forward voltages above *vcrit* that change by more than 2*vt are 
+    replaced by a logarithmic step so that the exponential junction 
+    current doesn't overflow (the pnjlim function of SPICE). The arguments 
+    can be arrays.
+
+    >>> print np.around(pnjlim(10., 0.7, 0.025, 0.6), 4)
+    0.848
+    >>> print pnjlim(0.71, 0.7, 0.025, 0.6)
+    0.71
+
+    """
+    vnew = np.asarray(vnew, dtype=float)
+    vold = np.asarray(vold, dtype=float)
+    
+    arg = 1 + (vnew - vold) / vt
+    forward = np.where(arg > 0, vold + vt * np.log(np.maximum(arg, 1e-300)), 
+                       vcrit)
+    reverse = vt * np.log(np.maximum(vnew, vt) / vt)
+
+    limit = (vnew > vcrit) & (abs(vnew - vold) > 2 * vt)
+    return np.where(limit, np.where(vold > 0, forward, reverse), vnew)[()]
+
 class Diode(Circuit):
     """ Nonlinear diode
     """
@@ -742,6 +868,78 @@ class Diode(Circuit):
         I = self.iparv.IS * (self.toolkit.exp(VD/VT)-1)
         return self.toolkit.array([I, -I])
 
+    @classmethod
+    def G_batch(cls, X, params, epar=defaultepar):
+        VD = X[:,0] - X[:,1]
+        VT = numeric.kboltzmann * epar.T / numeric.qelectron
+        g = params['IS'] * np.exp(VD/VT) / VT
+        return np.multiply.outer(g, twoterminal_stamp)
+
+    @classmethod
+    def i_batch(cls, X, params, epar=defaultepar):
+        VD = X[:,0] - X[:,1]
+        VT = numeric.kboltzmann * epar.T / numeric.qelectron
+        I = params['IS'] * (np.exp(VD/VT)-1)
+        return np.column_stack((I, -I))
+
+    def eval_all(self, x, t=0.0, epar=defaultepar, analysis=None, 
+                 want=('i', 'q', 'G', 'C', 'u')):
+        """Evaluate i and G using a common exponential"""
+        result = super(Diode, self).eval_all(x, t, epar, analysis,
+                                             [name for name in want 
+                                              if name not in ('i', 'G')])
+
+        if 'i' in want or 'G' in want:
+            VD = x[0]-x[1]
+            VT = self.toolkit.kboltzmann * epar.T / self.toolkit.qelectron
+            expVD = self.toolkit.exp(VD/VT)
+            if 'G' in want:
+                g = self.iparv.IS * expVD / VT
+                result['G'] = self.toolkit.array([[g, -g],
+                                                  [-g, g]])
+            if 'i' in want:
+                I = self.iparv.IS * (expVD - 1)
+                result['i'] = self.toolkit.array([I, -I])
+
+        return result
+
+    def limit(self, xnew, xold, epar=defaultepar):
+        """Limit the update of the diode voltage with pnjlim"""
+        return self.limit_batch(self.toolkit.array([xnew]), 
+                                self.toolkit.array([xold]),
+                                {'IS': self.iparv.IS}, epar)[0]
+
+    @classmethod
+    def limit_batch(cls, Xnew, Xold, params, epar=defaultepar):
+        VDnew = Xnew[:,0] - Xnew[:,1]
+        VDold = Xold[:,0] - Xold[:,1]
+        VT = numeric.kboltzmann * epar.T / numeric.qelectron
+        vcrit = VT * np.log(VT / (np.sqrt(2) * params['IS']))
+        dVD = VDnew - VDold
+        ratio = np.where(dVD != 0, 
+                         (pnjlim(VDnew, VDold, VT, vcrit) - VDold) / 
+                         np.where(dVD != 0, dVD, 1), 1.)
+        return Xold + ratio[:,np.newaxis] * (Xnew - Xold)
+
+    @classmethod
+    def eval_all_batch(cls, X, params, epar=defaultepar, 
+                       want=('i', 'q', 'G', 'C')):
+        VD = X[:,0] - X[:,1]
+        VT = numeric.kboltzmann * epar.T / numeric.qelectron
+        expVD = np.exp(VD/VT)
+
+        result = {}
+        for name in want:
+            if name == 'G':
+                result[name] = np.multiply.outer(params['IS'] * expVD / VT, 
+                                                 twoterminal_stamp)
+            elif name == 'i':
+                I = params['IS'] * (expVD - 1)
+                result[name] = np.column_stack((I, -I))
+            else:
+                result[name] = batchmethod(cls, name)(X, params, epar)
+        return result
+
 class VCVS_limited(Circuit):
     """Voltage controlled voltage source with limited output voltage.
 
@@ -785,6 +983,29 @@ class VCVS_limited(Circuit):
         vout = x[3] - x[2] - self.function.fprime(x[1]-x[0])*self.function.f(x[1]-x[0])
         return self.toolkit.array([0,0,x[4],-x[4],vout])
 
+    @classmethod
+    def G_batch(cls, X, params, epar=defaultepar):
+        function = func.Tanh(params['offset'], params['level'])
+        g = function.fprime(X[:,1]-X[:,0]) * params['g']
+        G = np.zeros((len(X), 5, 5))
+        G[:, 2, 4] = 1
+        G[:, 3, 4] = -1
+        G[:, 4, 2] = -1
+        G[:, 4, 3] = 1
+        G[:, 4, 0] = g
+        G[:, 4, 1] = -g
+        return G
+
+    @classmethod
+    def i_batch(cls, X, params, epar=defaultepar):
+        function = func.Tanh(params['offset'], params['level'])
+        vin = X[:,1] - X[:,0]
+        i = np.zeros(X.shape)
+        i[:, 2] = X[:,4]
+        i[:, 3] = -X[:,4]
+        i[:, 4] = X[:,3] - X[:,2] - function.fprime(vin) * function.f(vin)
+        return i
+
 class Idt(Circuit):
     """Integrator
     
@@ -793,6 +1014,7 @@ class Idt(Circuit):
     """
     
     terminals = ('iplus', 'iminus', 'oplus', 'ominus')
+    linear = True
     branches = (Branch(Node('oplus'), Node('ominus')),)
         
     def __init__(self, *args, **kvargs):
@@ -117,6 +117,10 @@ class LoopBreaker(CircuitProxy):
         if self.nulling_indices == None:
             raise LoopBreakError('Could not detect dependent source')
         
+    def hashkey(self):
+        return super(LoopBreaker, self).hashkey() + \
+            (repr(self.nulling_indices),)
+
     def G(self, x, epar=defaultepar): 
         G = self.device.G(x,epar)
         G[self.nulling_indices] = 0
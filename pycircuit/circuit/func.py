@@ -10,8 +10,12 @@ class TimeFunction(object):
     def f(self, t):
         return 0        
         
-    def next_event(self, t):
-        """Returns the time of the next event given the current time t"""
+    def next_event(self, t, discontinuous=False):
+        """Returns the time of the next event given the current time t
+
+        If *discontinuous* is True only events where the function or its
+        derivative is discontinuous are returned.
+        """
         return self.toolkit.inf
     
 class Sin(TimeFunction):
@@ -27,8 +31,13 @@ class Sin(TimeFunction):
         self.td = td
         self.toolkit = toolkit
     
-    def next_event(self, t):
-        """Return events at peaks and zero-crossings"""
+    def next_event(self, t, discontinuous=False):
+        """Return events at peaks and zero-crossings
+
+        The sine is smooth so there are no discontinuous events.
+        """
+        if self.omega == 0 or discontinuous:
+            return self.toolkit.inf
         
 #        phase = self.toolkit.simplify(self.omega * (t - self.td) + self.phase)
         phase = self.omega * (t - self.td) + self.phase
@@ -47,7 +56,8 @@ class Pulse(TimeFunction):
             v1, v2, td, tr, tf, pw, per
         self.toolkit = toolkit
 
-    def next_event(self, t):
+    def next_event(self, t, discontinuous=False):
+        ## All events of a pulse are corners
         if self.per != 0:
             tmod = t % self.per
         else:
@@ -63,8 +73,10 @@ class Pulse(TimeFunction):
             return t + self.td + self.tr + self.pw - tmod
         elif tmod < self.td + self.tr + self.pw + self.tf:
             return t + self.td + self.tr + self.pw + self.tf - tmod
-        else:
+        elif self.per != 0:
             return self.toolkit.ceil(t / self.per) * self.per
+        else:
+            return self.toolkit.inf
 
     def f(self, t):
         toolkit = self.toolkit
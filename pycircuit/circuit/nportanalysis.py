@@ -111,10 +111,11 @@ class TwoPortAnalysis(Analysis):
         if self.noise:
             (inp, inn), (outp, outn) = self.ports
             
-            circuit_vs = copy(self.cir)
+            ## Copy-on-write clones share the elements of the circuit
+            circuit_vs = self.cir.overlay()
             circuit_vs['VS_TwoPort'] = VS(inp, inn, vac = 1)
             
-            circuit_cs = copy(self.cir)
+            circuit_cs = self.cir.overlay()
             circuit_cs['IS_TwoPort'] = IS(inp, inn, iac = 1)
             
             if self.noise_outquantity == 'i':
@@ -221,7 +222,7 @@ class TwoPortAnalysis(Analysis):
 
         S = np.zeros((N,N), dtype=object)
         
-        circuit = copy(self.cir)
+        circuit = self.cir.overlay()
 
         refnode = self.ports[0][1]
 
@@ -327,11 +328,11 @@ class TwoPortAnalysis(Analysis):
 
         ## Add voltage source at input port and create
         ## copies with output open and shorted respectively
-        circuit_vs_open = copy(self.cir)
+        circuit_vs_open = self.cir.overlay()
 
         circuit_vs_open['VS_TwoPort'] = VS(inp, inn, vac=1)
 
-        circuit_vs_shorted = copy(circuit_vs_open)
+        circuit_vs_shorted = circuit_vs_open.overlay()
 
         circuit_vs_shorted['VL_TwoPort'] = VS(outp, outn, vac=0)
 
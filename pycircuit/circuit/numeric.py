@@ -12,6 +12,7 @@ The module is based on `numpy <http://numpy.org>`_.
 from constants import *
 
 import numpy as np
+import scipy.linalg
 from numpy import cos, sin, tan, cosh, sinh, tanh, log, exp, pi, linalg,\
      inf, ceil, floor, dot, linspace, eye, concatenate, sqrt, real, imag,\
      ones, complex, diff, delete, alltrue, maximum, size, conj
@@ -26,9 +27,53 @@ def linearsolver(*args, **kvargs):
 def linearsolverError(*args, **kvargs):
     return np.linalg.LinAlgError
 
+class LinearSolver(object):
+    """Linear solver that is reused between solves of similar systems
+
+    The dense solver factorizes the matrix in every call to solve. The 
+    factorization is kept so that the resolve method can solve new right 
+    hand sides with the same matrix. The *stats* attribute counts the 
+    number of factorizations, solves and reused factorizations.
+
+    """
+    def __init__(self):
+        self.stats = {'full': 0, 'solve': 0, 'reuse': 0}
+        self.reset()
+
+    def reset(self):
+        """Forget the saved factorization"""
+        self._lu = None
+
+    @property
+    def factorized(self):
+        """True if there is a saved factorization for resolve"""
+        return self._lu is not None
+
+    def solve(self, A, b):
+        self.stats['full'] += 1
+        self.stats['solve'] += 1
+        if len(A) == 0:
+            self._lu = None
+            return np.zeros(np.shape(b), dtype=np.result_type(A, b))
+        lu, piv = scipy.linalg.lu_factor(A, check_finite=False)
+        if np.any(np.diag(lu) == 0):
+            self._lu = None
+            raise np.linalg.LinAlgError('Singular matrix')
+        self._lu = lu, piv
+        return scipy.linalg.lu_solve(self._lu, b, check_finite=False)
+
+    def resolve(self, b):
+        """Solve with the matrix of the last call to solve"""
+        self.stats['solve'] += 1
+        self.stats['reuse'] += 1
+        return scipy.linalg.lu_solve(self._lu, b, check_finite=False)
+
 def toMatrix(array): 
     return array.astype('complex')
 
+def todense(array):
+    return array
+
 def det(x): 
     return np.linalg.det(x)
 
@@ -0,0 +1,188 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Persistent store of operating points used as starting points of analyses
+
+The store is a directory of compressed numpy npz files, one file for each
+circuit topology. A file contains the x-vector names and up to *maxstates*
+states together with the numeric instance parameters of the circuit when
+the state was saved. When a state is loaded the state with the parameters
+closest to those of the circuit is returned, so circuits with slightly
+different parameter values still get a good starting point.
+
+The number of files is bounded by *maxsize*, the least recently used file
+is removed first.
+
+"""
+
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+from circuit import SubCircuit
+
+class OperatingPointStore(object):
+    """Directory of operating points keyed by circuit topology
+
+    >>> import tempfile, shutil
+    >>> from elements import *
+    >>> directory = tempfile.mkdtemp()
+    >>> store = OperatingPointStore(directory)
+    >>> c = SubCircuit()
+    >>> c['is'] = IS(gnd, 'n1', i=1e-3)
+    >>> c['R'] = R('n1', gnd, r=1e3)
+    >>> store.load(c) is None
+    True
+    >>> store.save(c, np.array([1., 0.]))
+    >>> c['R'].ipar.r = 1.1e3
+    >>> store.load(c)
+    array([ 1.,  0.])
+    >>> shutil.rmtree(directory)
+
+    """
+    def __init__(self, directory, maxsize=100, maxstates=8):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.maxstates = maxstates
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def load(self, cir, kind='dc'):
+        """Return the stored state of the given kind closest to the circuit
+
+        None is returned if there is no state of a circuit with the same
+        topology.
+        """
+        filename = self._filename(cir)
+        data = self._read(filename)
+        if data is None:
+            return None
+
+        names, params, X, kinds = data
+        params0 = circuit_params(cir)
+        candidates = [k for k in range(len(X))
+                      if kinds[k] == kind and
+                      params[k].shape == params0.shape]
+        if len(candidates) == 0:
+            return None
+
+        ## Relative distance between parameter values
+        def distance(k):
+            scale = abs(params[k]) + abs(params0) + 1e-300
+            return np.sum(((params[k] - params0) / scale)**2)
+        best = min(candidates, key=distance)
+
+        ## Mark the file as recently used
+        os.utime(filename, None)
+
+        index = dict((name, i) for i, name in enumerate(names))
+        x = np.zeros(cir.n)
+        for i, name in enumerate(state_names(cir)):
+            if name in index:
+                x[i] = X[best][index[name]]
+        return x
+
+    def save(self, cir, x, kind='dc'):
+        """Save state x of the given kind"""
+        filename = self._filename(cir)
+        names = np.array(state_names(cir))
+        params0 = circuit_params(cir)
+        x = np.asarray(x, dtype=float)
+
+        states = []
+        data = self._read(filename)
+        if data is not None and list(data[0]) == list(names):
+            storednames, params, X, kinds = data
+            states = [(params[k], X[k], kinds[k]) for k in range(len(X))
+                      if not (kinds[k] == kind and
+                              np.array_equal(params[k], params0))]
+        states.append((params0, x, kind))
+        states = states[-self.maxstates:]
+
+        ## Parameter vectors of different length are padded with nan
+        m = max(len(state[0]) for state in states)
+        params = np.nan * np.ones((len(states), m))
+        for k, state in enumerate(states):
+            params[k, :len(state[0])] = state[0]
+
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, names=names, params=params,
+                                x=np.array([state[1] for state in states]),
+                                kinds=np.array([state[2] for state in states]))
+        os.rename(tmpname, filename)
+
+        self._evict()
+
+    def clear(self):
+        for filename in self._files():
+            os.remove(filename)
+
+    def _filename(self, cir):
+        return os.path.join(self.directory, topology_digest(cir) + '.npz')
+
+    def _files(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.npz')]
+
+    def _read(self, filename):
+        if not os.path.exists(filename):
+            return None
+        try:
+            data = np.load(filename)
+            result = (data['names'], data['params'], data['x'],
+                      data['kinds'])
+            data.close()
+        except (IOError, KeyError, ValueError):
+            return None
+
+        ## Padded parameter vectors
+        params = [p[~np.isnan(p)] for p in result[1]]
+        return result[0], params, result[2], result[3]
+
+    def _evict(self):
+        """Remove the least recently used files"""
+        files = self._files()
+        if len(files) > self.maxsize:
+            files.sort(key=os.path.getmtime)
+            for filename in files[:len(files) - self.maxsize]:
+                os.remove(filename)
+
+def _leafs(cir):
+    if isinstance(cir, SubCircuit):
+        return sorted(cir.xflatleafs(), key=lambda leaf: leaf[0])
+    return [('', cir, np.arange(cir.n))]
+
+def topology_digest(cir):
+    """Return a hex digest of the leaf element classes and connections
+
+    The digest is independent of the parameter values and is the same in
+    all python processes.
+    """
+    nodenames = dict((node, name) for name, node in cir.nodenames.items())
+    topology = [cir.n, [nodenames.get(node, node.name) for node in cir.nodes]]
+    for name, element, nodemap in _leafs(cir):
+        cls = element.__class__
+        topology.append((name, cls.__module__ + '.' + cls.__name__,
+                         [int(i) for i in nodemap]))
+    return hashlib.sha1(repr(topology)).hexdigest()
+
+def state_names(cir):
+    """Return names of the x-vector, node names followed by branch numbers"""
+    nodenames = dict((node, name) for name, node in cir.nodenames.items())
+    return [nodenames.get(node, node.name) for node in cir.nodes] + \
+        ['branch%d' % k for k in range(len(cir.branches))]
+
+def circuit_params(cir):
+    """Return array of the numeric instance parameters of the leaf elements"""
+    values = []
+    for name, element, nodemap in _leafs(cir):
+        for paramname, value in element.iparv.items():
+            if isinstance(value, (int, long, float, np.number)) and \
+                    not isinstance(value, bool):
+                values.append(float(value))
+    return np.array(values)
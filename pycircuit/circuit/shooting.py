@@ -115,7 +115,7 @@ class PSS(Analysis):
             x = self.solve_timestep(x, times[0], dt)
             x0 = copy(x)
             Jshoot = np.mat(toolkit.eye(n-1))
-            C = copy(np.mat(self._C))
+            C = copy(np.mat(toolkit.todense(self._C)))
 
             ## Save C and transient jacobian for PAC analysis
             self.Cvec = [copy(self._C)]
@@ -125,8 +125,8 @@ class PSS(Analysis):
                 x = copy(self.solve_timestep(x, t, dt))
                 self.Cvec.append(copy(self._C))
                 self.Jtvec.append(copy(self._Jf))
-                Jshoot = np.mat(self._Jf).I * C * Jshoot
-                C = copy(np.mat(self._C))
+                Jshoot = np.mat(toolkit.todense(self._Jf)).I * C * Jshoot
+                C = copy(np.mat(toolkit.todense(self._C)))
 
             residual = x0 - x
 
@@ -0,0 +1,185 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Module of sparse numeric operations that can be used as a toolkit for
+Analysis objects
+
+The module is based on the numeric toolkit but matrices are handled as
+`scipy.sparse <http://scipy.org>`_ matrices and linear systems are solved
+with sparse LU factorization using the SuperLU library. The columns are
+permuted with a fill-reducing ordering (COLAMD) before factorization so the
+cost of solving circuit equations grows close to linearly with the number
+of non-zero elements.
+
+Circuits that use this toolkit assemble G, C and CY as CSR matrices.
+
+"""
+
+from numeric import *
+import numeric as numeric_toolkit
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+sparse = True
+
+## Column permutation used by the sparse LU factorization
+permc_spec = 'COLAMD'
+
+def issparse(A):
+    return scipy.sparse.issparse(A)
+
+def linearsolver(A, b):
+    """Solve the linear system A x = b using sparse LU factorization"""
+    A = scipy.sparse.csc_matrix(A)
+    b = np.asarray(b)
+
+    if A.shape[0] == 0:
+        return np.zeros(b.shape, dtype=np.result_type(A.dtype, b.dtype))
+
+    dtype = np.result_type(A.dtype, b.dtype)
+    A, b = A.astype(dtype), b.astype(dtype)
+
+    try:
+        lu = scipy.sparse.linalg.splu(A, permc_spec=permc_spec)
+    except RuntimeError, e:
+        ## SuperLU signals a singular matrix with a RuntimeError
+        raise np.linalg.LinAlgError(str(e))
+
+    return lu.solve(b)
+
+def linearsolverError(*args, **kvargs):
+    return np.linalg.LinAlgError
+
+class LinearSolver(object):
+    """Sparse LU solver that keeps the factorization of the last solve
+
+    Each call to solve factors the matrix with splu using the 
+    fill-reducing column ordering of the module. The factorization is 
+    kept so that the resolve method can solve new right hand sides with 
+    the same matrix. The *stats* attribute counts the number of 
+    factorizations (full), solves and reused factorizations (reuse).
+
+    """
+    def __init__(self):
+        self.stats = {'full': 0, 'solve': 0, 'reuse': 0}
+        self.reset()
+
+    def reset(self):
+        """Forget the saved factorization"""
+        self._lusolve = None
+
+    @property
+    def factorized(self):
+        """True if there is a saved factorization for resolve"""
+        return self._lusolve is not None
+
+    def resolve(self, b):
+        """Solve with the matrix of the last call to solve"""
+        self.stats['solve'] += 1
+        self.stats['reuse'] += 1
+        return self._lusolve(np.asarray(b))
+
+    def solve(self, A, b):
+        A = scipy.sparse.csc_matrix(A)
+        b = np.asarray(b)
+        dtype = np.result_type(A.dtype, b.dtype)
+        A, b = A.astype(dtype), b.astype(dtype)
+
+        self.stats['solve'] += 1
+
+        if A.shape[0] == 0:
+            self._lusolve = None
+            return np.zeros(b.shape, dtype=dtype)
+
+        try:
+            lu = scipy.sparse.linalg.splu(A, permc_spec=permc_spec)
+        except RuntimeError, e:
+            self.reset()
+            raise np.linalg.LinAlgError(str(e))
+
+        self.stats['full'] += 1
+        self._lusolve = lu.solve
+        return lu.solve(b)
+
+def toMatrix(A):
+    if issparse(A):
+        return A.astype('complex')
+    return numeric_toolkit.toMatrix(A)
+
+def todense(A):
+    if issparse(A):
+        return A.toarray()
+    return A
+
+def array(a, *args, **kvargs):
+    if issparse(a):
+        if 'dtype' in kvargs:
+            return a.astype(kvargs['dtype'])
+        return a
+    return np.array(a, *args, **kvargs)
+
+def dot(a, b):
+    if issparse(a):
+        return a.dot(b)
+    elif issparse(b):
+        return np.asarray(b.T.dot(np.asarray(a).T)).T
+    return np.dot(a, b)
+
+def delete(a, obj, axis=None):
+    """Delete rows (axis=0) or columns (axis=1) of a dense or sparse array"""
+    if not issparse(a):
+        return np.delete(a, obj, axis=axis)
+
+    keep = np.ones(a.shape[axis], dtype=bool)
+    keep[obj] = False
+
+    if axis == 0:
+        return a.tocsr()[np.flatnonzero(keep)]
+    elif axis == 1:
+        return a.tocsc()[:, np.flatnonzero(keep)]
+    else:
+        raise ValueError('axis must be 0 or 1 for sparse matrices')
+
+def det(A):
+    """Calculate determinant from the diagonal of the LU factors"""
+    if not issparse(A):
+        return numeric_toolkit.det(A)
+
+    try:
+        lu = scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(A),
+                                      permc_spec=permc_spec)
+    except RuntimeError:
+        return 0.0
+
+    ## Sign of the row and column permutations
+    sign = permutation_sign(lu.perm_r) * permutation_sign(lu.perm_c)
+    return sign * np.prod(lu.U.diagonal())
+
+def inv(A):
+    if issparse(A):
+        return scipy.sparse.linalg.inv(scipy.sparse.csc_matrix(A))
+    return numeric_toolkit.inv(A)
+
+def permutation_sign(perm):
+    """Return the sign (+1 or -1) of a permutation vector
+
+    >>> permutation_sign([1, 0, 2])
+    -1
+    """
+    perm = list(perm)
+    sign = 1
+    visited = [False] * len(perm)
+    for start in range(len(perm)):
+        if not visited[start]:
+            length = 0
+            i = start
+            while not visited[i]:
+                visited[i] = True
+                i = perm[i]
+                length += 1
+            if length % 2 == 0:
+                sign = -sign
+    return sign
@@ -10,6 +10,15 @@ from numpy.testing import assert_array_almost_equal, assert_array_equal
 from test_circuit import create_current_divider
 import unittest
 
+def setup():
+    ## The symbolic toolkit replaces the temperature with a symbol
+    global oldT
+    oldT = defaultepar['T']
+    defaultepar['T'] = Parameter('T', 'Temperature', unit='K', default=300)
+
+def teardown():
+    defaultepar['T'] = oldT
+
 def test_integer_component_values():
     """Test dc analysis with integer component values
     
@@ -30,6 +39,199 @@ def test_integer_component_values():
 
     assert_equal(res.i('R2.plus'), 0.09)
 
+def test_dc_junction_limiting():
+    """Test that limiting of diode voltages lets simple Newton converge"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    c = SubCircuit(toolkit=numeric)
+    c['vs'] = VS('net1', gnd, v=10)
+    c['R1'] = R('net1', 'net2', r=1e3)
+    for k in range(10):
+        c['D%d'%k] = Diode('net2', 'a%d'%k)
+        c['RS%d'%k] = R('a%d'%k, gnd, r=1e-2)
+
+    dc = DC(c)
+    res = dc.solve()
+
+    assert_equal(dc.niter, dc.infodict['niter'])
+    assert dc.infodict['nlimit'] > 0
+    assert dc.niter < 20
+
+    ## Kirchhoff's current law at net2
+    vt = numeric.kboltzmann * 300 / numeric.qelectron
+    vd = res.v('net2') - res.v('a0')
+    assert_almost_equal(10 * 1e-13 * (np.exp(vd / vt) - 1) / 
+                        ((10 - res.v('net2')) / 1e3), 1, places=4)
+
+def test_dc_strategies():
+    """Test that the DC strategies are tried in the given order and that 
+    a failed strategy hands over its best iterate"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    c = SubCircuit(toolkit=numeric)
+    c['vs'] = VS('net1', gnd, v=10)
+    c['R1'] = R('net1', 'net2', r=1e3)
+    c['D1'] = Diode('net2', gnd)
+
+    expected = DC(c).solve().v('net2')
+
+    dc = DC(c, strategies=['ptran'])
+    assert_almost_equal(dc.solve().v('net2'), expected, places=6)
+
+    ## Simple Newton gets close but runs out of iterations
+    dc = DC(c, strategies=['simple'], maxiter=3)
+    try:
+        dc.solve()
+    except NoConvergenceError, e:
+        assert_equal(len(e.x), c.n)
+    else:
+        raise AssertionError('Expected NoConvergenceError')
+
+    dc = DC(c, strategies=['simple', 'ptran'], maxiter=3)
+    assert_almost_equal(dc.solve().v('net2'), expected, places=6)
+
+    assert_raises(ValueError, DC(c, strategies=['newton']).solve)
+
+def test_dc_parallel():
+    """Test racing of DC strategies in a process pool"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    c = SubCircuit(toolkit=numeric)
+    c['vs'] = VS('net1', gnd, v=10)
+    c['R1'] = R('net1', 'net2', r=1e3)
+    c['D1'] = Diode('net2', gnd)
+
+    expected = DC(c).solve().v('net2')
+
+    ## Only pseudo-transient continuation converges in 3 iterations
+    with DC(c, strategies=['simple', 'gmin', 'source', 'ptran'], maxiter=3, 
+            parallel=True) as dc:
+        assert_almost_equal(dc.solve().v('net2'), expected, places=6)
+        assert_equal(dc.strategy, 'ptran')
+        pool = dc._pool
+
+        ## The workers are reused with new parameter values until the 
+        ## topology changes
+        dc.solve()
+        assert dc._pool is pool
+        c['vs'].ipar.v = 9
+        assert_almost_equal(dc.solve().v('net2'), DC(c).solve().v('net2'), 
+                            places=6)
+        assert dc._pool is pool
+        c['R2'] = R('net2', gnd, r=1e3)
+        assert_almost_equal(dc.solve().v('net2'), DC(c).solve().v('net2'), 
+                            places=6)
+        assert dc._pool is not pool
+        pool = dc._pool
+
+        ## Analysis parameters are also sent to the workers
+        dc.par.maxiter = 1
+        assert_raises(NoConvergenceError, dc.solve)
+        assert dc._pool is pool
+    assert dc._pool is None
+
+    ## The workers are terminated when the analysis is garbage collected
+    dc = DC(c, strategies=['simple', 'gmin', 'source', 'ptran'], maxiter=3, 
+            parallel=True)
+    dc.solve()
+    processes = dc._pool._pool
+    del dc
+    for process in processes:
+        process.join(10)
+        assert not process.is_alive()
+
+def test_dc_sweep():
+    """Test that a DC sweep gives the same result as separate DC analyses"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    c = SubCircuit(toolkit=numeric)
+    c['vs'] = VS('in', gnd, v=1)
+    c['R1'] = R('in', 'out', r=1e3)
+    c['D1'] = Diode('out', gnd)
+
+    values = np.linspace(-1, 5, 201)
+    sweep = DCSweep(c)
+    res = sweep.solve(values, param='v', instance='vs')
+
+    assert_array_equal(res.v('out').x[0], values)
+    assert_equal(list(res.v('out').xunits), ['V'])
+    ## The predictor gives about one Newton iteration per point
+    assert sweep.niter < 1.5 * len(values)
+    ## The swept parameter is restored
+    assert_equal(c['vs'].ipar.v, 1)
+
+    for i in 0, 100, 200:
+        c['vs'].ipar.v = values[i]
+        assert_almost_equal(res.v('out').y[i], DC(c).solve().v('out'), 
+                            places=6)
+
+def test_opcache():
+    """Test that small-signal analyses share the cached operating point"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    c = SubCircuit(toolkit=numeric)
+    c['vs'] = VS('in', gnd, v=1, vac=1)
+    c['R1'] = R('in', 'out', r=1e3)
+    c['D1'] = Diode('out', gnd)
+
+    from pycircuit.circuit.analysis_ss import OperatingPointCache
+    with OperatingPointCache() as opcache:
+        vac = AC(c).solve(1e3).v('out')
+        res = Noise(c, inputsrc='vs', outputnodes=('out', gnd)).solve(1e3)
+        assert_equal(opcache.stats, {'hit': 1, 'miss': 1})
+
+        ## A new parameter value gives a new operating point
+        c['vs'].ipar.v = 2
+        vac2 = AC(c).solve(1e3).v('out')
+        assert_equal(opcache.stats, {'hit': 1, 'miss': 2})
+        assert abs(vac2) < abs(vac)
+
+    ## The entries are cleared at the end of the with statement and no
+    ## cache is used outside it
+    assert_equal(len(opcache.entries), 0)
+    assert_almost_equal(AC(c).solve(1e3).v('out'), vac2)
+    assert_equal(opcache.stats, {'hit': 1, 'miss': 2})
+
+    ## A cache given to the analysis keeps a bounded number of CY matrices
+    opcache = OperatingPointCache(maxfreqs=2)
+    for f in 1e3, 2e3, 3e3, 1e3:
+        AC(c, opcache=opcache).solve(f)
+    assert_equal(opcache.stats, {'hit': 3, 'miss': 1})
+    assert_equal(len(opcache.entries.values()[0]['CY']), 2)
+
+def test_opstore():
+    """Test warm start of DC from the persistent operating point store"""
+    import tempfile, shutil, os
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    def create(n):
+        c = SubCircuit(toolkit=numeric)
+        c['vs'] = VS('in', gnd, v=5)
+        for k in range(n):
+            c['R%d'%k] = R('in', 'a%d'%k, r=1e3)
+            c['D%d'%k] = Diode('a%d'%k, gnd)
+        return c
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = OperatingPointStore(directory, maxsize=2)
+        c = create(3)
+        dc = DC(c, store=store)
+        dc.solve()
+        niter = dc.niter
+
+        ## Small parameter changes still use the stored solution
+        c['vs'].ipar.v = 5.01
+        dc = DC(c, store=store)
+        res = dc.solve()
+        assert dc.niter < niter
+        assert_almost_equal(res.v('a0'), DC(c).solve().v('a0'))
+
+        ## The least recently used topology is removed
+        for n in 4, 5:
+            DC(create(n), store=store).solve()
+        assert_equal(len(os.listdir(directory)), 2)
+        assert_equal(store.load(c), None)
+    finally:
+        shutil.rmtree(directory)
+
 def TODOtest_noise_dc_steady_state():
     """Test that dc-steady state is accounted for in noise simulations
     """
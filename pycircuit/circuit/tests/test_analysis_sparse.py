@@ -0,0 +1,106 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Tests of analyses using the sparse toolkit
+"""
+
+from nose.tools import *
+import pycircuit.circuit.circuit 
+from pycircuit.circuit import *
+from pycircuit.circuit.elements import VSin
+from pycircuit.circuit.transient import Transient
+from pycircuit.utilities import Parameter, ParameterDict
+import numpy as np
+import scipy.sparse
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+def create_circuit(toolkit):
+    pycircuit.circuit.circuit.default_toolkit = toolkit
+    c = SubCircuit()
+    n1, n2, n3 = c.add_nodes('1', '2', '3')
+    c['vs'] = VS(n1, gnd, v=1.0, vac=1.0)
+    c['R1'] = R(n1, n2, r=1e3)
+    c['R2'] = R(n2, gnd, r=1e3)
+    c['C1'] = C(n2, gnd, c=1e-9)
+    c['G1'] = VCCS(n2, gnd, n3, gnd, gm=1e-3)
+    c['R3'] = R(n3, gnd, r=1e3)
+    c['L1'] = L(n3, gnd, L=1e-6)
+    return c
+
+def test_sparse_assembly_with_toolkit():
+    """Test that circuits with the sparse toolkit return CSR matrices"""
+    cir = create_circuit(sparse)
+
+    assert scipy.sparse.isspmatrix_csr(cir.G(np.zeros(cir.n)))
+    assert scipy.sparse.isspmatrix_csr(cir.C(np.zeros(cir.n)))
+
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+def test_linearsolver():
+    A = scipy.sparse.csr_matrix(np.array([[4., 1., 0.], 
+                                          [1., 3., 0.], 
+                                          [0., 0., 2.]]))
+    b = np.array([1., 2., 3.])
+
+    assert_array_almost_equal(sparse.linearsolver(A, b),
+                              np.linalg.solve(A.toarray(), b))
+
+    assert_array_almost_equal(sparse.linearsolver(A, 1j*b),
+                              np.linalg.solve(A.toarray(), 1j*b))
+
+    singular = scipy.sparse.csr_matrix(np.array([[1., 1.], [1., 1.]]))
+    assert_raises(sparse.linearsolverError(), 
+                  lambda: sparse.linearsolver(singular, b[:2]))
+
+def test_linearsolver_reuse():
+    """Test that LinearSolver keeps the factorization for resolve"""
+    A = np.array([[4., 1., 0.], [1., 3., 1.], [0., 1., 2.]])
+    b = np.array([1., 2., 3.])
+    solver = sparse.LinearSolver()
+    assert not solver.factorized
+
+    assert_array_almost_equal(solver.solve(scipy.sparse.csr_matrix(A), b),
+                              np.linalg.solve(A, b))
+    assert solver.factorized
+    assert_array_almost_equal(solver.resolve(2 * b), np.linalg.solve(A, 2 * b))
+
+    assert_equal(solver.stats, {'full': 1, 'solve': 2, 'reuse': 1})
+
+def test_delete():
+    A = np.arange(9.).reshape(3,3)
+    Asparse = scipy.sparse.csr_matrix(A)
+    for axis in 0, 1:
+        assert_array_equal(sparse.delete(Asparse, [1], axis=axis).toarray(),
+                           np.delete(A, [1], axis=axis))
+
+def test_det():
+    A = np.array([[0., 2., 1.], [3., 1., 0.], [1., 0., 4.]])
+    assert_almost_equal(sparse.det(scipy.sparse.csr_matrix(A)), 
+                        np.linalg.det(A))
+
+def test_dc():
+    xref = DC(create_circuit(numeric)).solve().x
+    x = DC(create_circuit(sparse)).solve().x
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    assert_array_almost_equal(x, xref)
+
+def test_ac():
+    freqs = np.array([1e3, 1e6])
+    epar = ParameterDict(Parameter('T', default=300))
+    vref = AC(create_circuit(numeric), epar=epar).solve(freqs).v('2')
+    v = AC(create_circuit(sparse), epar=epar).solve(freqs).v('2')
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    assert_array_almost_equal(v.y, vref.y)
+
+def test_transient():
+    results = []
+    for toolkit in numeric, sparse:
+        cir = create_circuit(toolkit)
+        cir['vs'] = VSin(cir.nodes[0], gnd, va=1, freq=1e5)
+        ## Use Newton's method so the Jacobian is factorized in every step
+        tran = Transient(cir, fastlinear=False)
+        res = tran.solve(tend=2e-5, timestep=1e-6)
+        results.append(res.v('2').y)
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    assert_array_almost_equal(results[0], results[1])
@@ -4,16 +4,27 @@
 """Circuit element tests
 """
 
-from pycircuit.circuit.elements import VSin, ISin, IS, R, L, C, SubCircuit, gnd
+from pycircuit.circuit.elements import VSin, ISin, IS, R, L, C, Diode, \
+    VPulse, SubCircuit, gnd
 from pycircuit.circuit.transient import Transient
 from pycircuit.circuit import circuit #new
 from math import floor
 import numpy as np
+from numpy.testing import assert_array_equal
 import unittest
 
-from pycircuit.circuit import Circuit, defaultepar
+from pycircuit.circuit import Circuit, defaultepar, numeric, sparse
 from pycircuit.utilities.param import Parameter
 
+def setup():
+    ## The symbolic toolkit replaces the temperature with a symbol
+    global oldT
+    oldT = defaultepar['T']
+    defaultepar['T'] = Parameter('T', 'Temperature', unit='K', default=300)
+
+def teardown():
+    defaultepar['T'] = oldT
+
 class myC(Circuit):
     """Capacitor
 
@@ -117,6 +128,222 @@ def test_transient_nonlinear_C():
     assert  abs(res_imp.v(2,gnd)[-1] - expected) < 1e-2*expected,\
         'Does not match QUCS result:'
 
+def test_transient_chord():
+    """Test that the chord method gives the same result with fewer 
+    factorizations of the Jacobian
+    """
+    circuit.default_toolkit = circuit.numeric
+
+    c = SubCircuit()
+    c['VSin'] = VSin(1, gnd, va=2, freq=1e3)
+    c['R1'] = R(1, 2, r=100)
+    c['D'] = Diode(2, 3)
+    c['C'] = C(3, gnd, c=1e-6)
+    c['RL'] = R(3, gnd, r=1e3)
+
+    results = []
+    for chord in False, True:
+        tran = Transient(c, chord=chord)
+        res = tran.solve(tend=1e-3, timestep=1e-5)
+        results.append((res.v(3, gnd).y, tran.solver.stats))
+
+    (v, stats), (vchord, statschord) = results
+    assert np.max(abs(v - vchord)) < 1e-3 * np.max(abs(v))
+    assert statschord['full'] < stats['full'] / 2
+    assert statschord['reuse'] > 0
+
+def test_transient_adaptive():
+    """Test that the adaptive time step follows the analytic RC response
+    with fewer steps than a fixed time step"""
+    circuit.default_toolkit = circuit.numeric
+    c = SubCircuit()
+    c['Is'] = IS(gnd, 1, i=1e-3)
+    c['R'] = R(1, gnd, r=1e3)
+    c['C'] = C(1, gnd, c=1e-9)
+
+    for method in 'euler', 'trapezoidal':
+        tran = Transient(c, adaptive=True, method=method)
+        res = tran.solve(tend=10e-6, timestep=1e-9)
+        t = res.v(1, gnd).x[0]
+        v = res.v(1, gnd).y
+
+        assert len(t) < 200
+        assert tran.stepstats['accepted'] == len(t)
+        ## Non-uniform time axis
+        assert np.max(np.diff(t)) > 10 * np.min(np.diff(t))
+        assert t[-1] >= 10e-6 - 1e-12
+        assert np.max(abs(v - (1 - np.exp(-t / 1e-6)))) < 1e-2
+
+def test_transient_breakpoints():
+    """Test that time steps land on the edges of a pulse that is narrower
+    than the time step"""
+    circuit.default_toolkit = circuit.numeric
+    c = SubCircuit()
+    c['vs'] = VPulse(1, gnd, v1=0, v2=1, td=2.01e-6, tr=1e-9, tf=1e-9, 
+                     pw=20e-9)
+    c['R'] = R(1, 2, r=1e3)
+    c['C'] = C(2, gnd, c=1e-11)
+    
+    edges = np.array([2.01e-6, 2.011e-6, 2.031e-6, 2.032e-6])
+    for adaptive in False, True:
+        res = Transient(c, adaptive=adaptive, method='trapezoidal', 
+                        breakpoints=True).solve(tend=6e-6, timestep=1e-7)
+        t = res.v(2, gnd).x[0]
+        for edge in edges:
+            assert np.min(abs(t - edge)) < 1e-15
+        ## The time grid of a fixed time step is kept
+        if not adaptive:
+            assert np.min(abs(t - 3e-6)) < 1e-15
+
+    ## The adaptive step follows the pulse response
+    v = res.v(2, gnd).y
+    vexpected = 1 - np.exp(-20e-9 / 10e-9)
+    assert abs(np.max(v) - vexpected) < 1e-2 * vexpected
+
+    ## Without breakpoints the pulse is missed
+    res = Transient(c, adaptive=True, breakpoints=False).solve(tend=6e-6, 
+                                                               timestep=1e-7)
+    assert np.max(res.v(2, gnd).y) < 1e-3
+
+def test_transient_streaming():
+    """Test saving a subset of the nodes to a memory-mapped file"""
+    import tempfile, shutil, os
+    circuit.default_toolkit = circuit.numeric
+    c = SubCircuit()
+    c['VSin'] = VSin(1, gnd, va=1, freq=1e5)
+    c['R1'] = R(1, 2, r=1e3)
+    c['C1'] = C(2, gnd, c=1e-9)
+    c['R2'] = R(2, 3, r=1e3)
+    c['C2'] = C(3, gnd, c=1e-9)
+
+    expected = Transient(c).solve(tend=20e-6, timestep=1e-8)
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'tran.dat')
+        times = []
+        tran = Transient(c, save=['3'], outfile=filename, chunksize=100,
+                         callback=lambda t, x: times.append(t))
+        res = tran.solve(tend=20e-6, timestep=1e-8)
+
+        v = res.v(3, gnd)
+        assert np.array_equal(v.y, expected.v(3, gnd).y)
+        assert np.array_equal(v.x[0], times)
+        ## The result is backed by the file
+        assert isinstance(tran.storage._data, np.memmap)
+        assert os.path.getsize(filename) == len(times) * 3 * 8
+        try:
+            res.v(2, gnd)
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('Expected KeyError for unsaved node')
+        del res, v, tran
+    finally:
+        shutil.rmtree(directory)
+
+def test_transient_store():
+    """Test that a stored initial condition is only a starting guess"""
+    import tempfile, shutil
+    from pycircuit.circuit import OperatingPointStore
+    circuit.default_toolkit = circuit.numeric
+    c = SubCircuit()
+    c['Is'] = IS(gnd, 1, i=1e-3)
+    c['R1'] = R(1, gnd, r=1e3)
+    c['C1'] = C(1, gnd, c=1e-9)
+    c['D1'] = Diode(1, gnd)
+
+    expected = Transient(c).solve(tend=2e-6, timestep=1e-7).v(1, gnd).y
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = OperatingPointStore(directory)
+        x0 = np.array([2., 0.])
+        vic = Transient(c, store=store).solve(tend=2e-6, timestep=1e-7, 
+                                              x0=x0).v(1, gnd).y
+        assert_array_equal(store.load(c, 'tran'), x0)
+
+        v = Transient(c, store=store).solve(tend=2e-6, 
+                                            timestep=1e-7).v(1, gnd).y
+        assert np.max(abs(v - expected)) < 1e-6
+        assert np.max(abs(vic - expected)) > 1e-2
+    finally:
+        shutil.rmtree(directory)
+
+def test_transient_sin_breakpoints():
+    """Test that a sine source does not change the time steps"""
+    circuit.default_toolkit = circuit.numeric
+    c = SubCircuit()
+    c['VSin'] = VSin(1, gnd, va=1, freq=1e6)
+    c['R'] = R(1, 2, r=1e3)
+    c['C'] = C(2, gnd, c=1e-10)
+
+    expected = Transient(c, breakpoints=False).solve(tend=3e-6, 
+                                                     timestep=1e-8)
+    for breakpoints in None, True:
+        res = Transient(c, breakpoints=breakpoints).solve(tend=3e-6, 
+                                                          timestep=1e-8)
+        assert np.array_equal(res.v(2, gnd).x[0], expected.v(2, gnd).x[0])
+        assert np.array_equal(res.v(2, gnd).y, expected.v(2, gnd).y)
+    assert Transient(c).par.breakpoints is None
+
+def test_transient_linear():
+    """Test that linear circuits give the same result without Newton 
+    iterations with one factorization per time step size"""
+    for toolkit in numeric, sparse:
+        circuit.default_toolkit = toolkit
+        c = SubCircuit()
+        c['VSin'] = VSin(1, gnd, va=1, freq=1e5)
+        c['R1'] = R(1, 2, r=1e3)
+        c['C1'] = C(2, gnd, c=1e-9)
+        c['L1'] = L(2, 3, L=1e-4)
+        c['R2'] = R(3, gnd, r=1e3)
+
+        for method, adaptive in [('euler', False), ('trapezoidal', False),
+                                 ('gear2', False), ('euler', True), 
+                                 ('trapezoidal', True)]:
+            results = []
+            for fastlinear in False, True:
+                tran = Transient(c, method=method, adaptive=adaptive,
+                                 fastlinear=fastlinear)
+                res = tran.solve(tend=10e-6, timestep=1e-7)
+                results.append((res.v(3, gnd), tran))
+            (v, tran), (vfast, tranfast) = results
+            assert len(v.x[0]) == len(vfast.x[0])
+            assert np.max(abs(v.x[0] - vfast.x[0])) < 1e-15
+            assert np.max(abs(v.y - vfast.y)) < 1e-6 * np.max(abs(v.y))
+
+            ## No Newton iterations
+            assert tranfast.solver.stats['solve'] == 0
+            if not adaptive:
+                ## The first backward euler step and the following steps
+                assert len(tranfast.linearsolvers) == 2
+                for solver in tranfast.linearsolvers.values():
+                    assert solver.stats['full'] == 1
+    circuit.default_toolkit = circuit.numeric
+
+    ## Elements that are not flagged as linear are solved by Newton's method
+    class NonlinearC(Circuit):
+        terminals = ('plus', 'minus')
+        def C(self, x, epar=defaultepar):
+            c = 1e-9 * (1 + (x[0] - x[1])**2)
+            return np.array([[c, -c], [-c, c]])
+        def q(self, x, epar=defaultepar):
+            v = x[0] - x[1]
+            q = 1e-9 * (v + v**3 / 3)
+            return np.array([q, -q])
+
+    c = SubCircuit()
+    c['IS'] = IS(gnd, 1, i=1e-3)
+    c['R1'] = R(1, gnd, r=1e4)
+    c['C1'] = NonlinearC(1, gnd)
+    results = []
+    for fastlinear in False, True:
+        tran = Transient(c, fastlinear=fastlinear)
+        results.append(tran.solve(tend=10e-6, timestep=1e-7).v(1, gnd).y)
+        assert len(tran.linearsolvers) == 0
+    assert_array_equal(results[0], results[1])
+
 def test_transient_get_diff():
     """Test of differentiation method
     """
@@ -18,6 +18,7 @@ import numpy as np
 from numpy.testing import assert_array_almost_equal, assert_array_equal
 from numpy.testing.decorators import slow
 from copy import copy
+import scipy.sparse
 
 def generate_testcircuit():
     subc = SubCircuit()
@@ -394,6 +395,31 @@ def test_global_parameters():
 
     assert_equal(a['R1'].iparv.r, 30)
 
+def test_parameter_dependencies():
+    """Test that only expressions that depend on a changed parameter are 
+    evaluated again"""
+    a = SubCircuit()
+
+    a['R1'] = R(1, 0, r='Ra + 10')
+    a['R2'] = R(1, 0, r='Rb + 10')
+
+    globalparams = ParameterDict(Parameter('Ra'), Parameter('Rb'), 
+                                 Ra=20, Rb=30)
+    a.update_iparv(globalparams=globalparams)
+    assert_equal(a['R1'].iparv.r, 30)
+    assert_equal(a['R2'].iparv.r, 40)
+
+    evaluated1 = a['R1'].ipar._evaluated['r']
+    evaluated2 = a['R2'].ipar._evaluated['r']
+
+    globalparams.Ra = 100
+    a.update_iparv(globalparams=globalparams)
+    assert_equal(a['R1'].iparv.r, 110)
+    assert_equal(a['R2'].iparv.r, 40)
+
+    assert_false(a['R1'].ipar._evaluated['r'] is evaluated1)
+    assert_true(a['R2'].ipar._evaluated['r'] is evaluated2)
+
 def test_replace_element():
     """Test node list consitency when replacing an element"""
     c = SubCircuit()
@@ -426,3 +452,374 @@ def test_get_node():
     out = c.add_node('out')
     c['V1'] = VS(out, gnd)
     assert_equal(c.get_node('V1.plus'), out)
+
+def test_sparse_assembly():
+    """Test that sparse and dense assembly of G, C and CY give the same result"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    cir = generate_testcircuit()
+    cir['C1'] = C('plus', gnd, c=1e-12)
+    cir['D1'] = Diode('minus', gnd)
+
+    x = np.linspace(0.1, 0.5, cir.n)
+    epar = ParameterDict(Parameter('T', default=300))
+
+    for method in 'G', 'C':
+        A = getattr(cir, method)(x, epar, sparse=True)
+        assert scipy.sparse.isspmatrix_csr(A)
+        assert_array_almost_equal(A.toarray(), getattr(cir, method)(x, epar))
+
+    assert_array_almost_equal(cir.CY(x, 1, epar, sparse=True).toarray(), 
+                              cir.CY(x, 1, epar))
+
+    ## The sparsity pattern is reused when the values change
+    G1 = cir.G(np.zeros(cir.n), epar, sparse=True)
+    assert_array_almost_equal(G1.toarray(), cir.G(np.zeros(cir.n), epar))
+
+def test_compile():
+    """Test that a compiled circuit gives the same result as the hierarchy"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    cir = generate_testcircuit()
+    cir['C1'] = C('plus', gnd, c=1e-12)
+    cir['D1'] = Diode('minus', gnd)
+    cir['VS'] = VS('plus', gnd, v=1.0)
+
+    compiled = cir.compile()
+    assert_equal(len(list(cir.xflatleafs())), 
+                 sum(len(group) for group in compiled.groups))
+
+    x = np.linspace(0.1, 0.5, cir.n)
+    epar = ParameterDict(Parameter('T', default=300))
+
+    for i in range(2):
+        for method in 'G', 'C':
+            assert_array_almost_equal(getattr(compiled, method)(x, epar),
+                                      getattr(cir, method)(x, epar))
+            assert_array_almost_equal(
+                getattr(compiled, method)(x, epar, sparse=True).toarray(),
+                getattr(cir, method)(x, epar))
+        for method in 'i', 'q':
+            assert_array_almost_equal(getattr(compiled, method)(x, epar),
+                                      getattr(cir, method)(x, epar))
+        assert_array_almost_equal(compiled.u(0, epar, analysis='dc'),
+                                  cir.u(0, epar, analysis='dc'))
+        assert_array_almost_equal(compiled.CY(x, 1, epar), cir.CY(x, 1, epar))
+
+def test_compile_invalidation():
+    """Test that the compiled circuit follows netlist and parameter changes"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    cir = generate_testcircuit()
+    x = np.zeros(cir.n)
+    epar = ParameterDict(Parameter('T', default=300))
+    
+    compiled = cir.compile()
+    assert cir.compile() is compiled
+    
+    ## Changed instance parameters of a leaf element deep in the hierarchy
+    cir['I1']['R2'].ipar.r = 2e3
+    assert cir.compile() is compiled
+    assert_array_almost_equal(compiled.G(x, epar), cir.G(x, epar))
+
+    ## Changed netlist
+    cir['R4'] = R('plus', gnd, r=1e3)
+    assert not compiled.isvalid()
+    assert cir.compile() is not compiled
+    assert_array_almost_equal(cir.compile().G(x, epar), cir.G(x, epar))
+
+def test_linear_stamp_cache():
+    """Test that linear stamps are reused until a parameter changes"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    calls = []
+    class CountingR(R):
+        def G(self, x, epar=defaultepar):
+            calls.append(self)
+            return super(CountingR, self).G(x, epar)
+
+    cir = SubCircuit()
+    cir['R1'] = CountingR(1, gnd, r=1e3)
+    cir['VS'] = VS(1, gnd, v=1.0)
+    cir['D1'] = Diode(1, gnd)
+
+    epar = ParameterDict(Parameter('T', default=300))
+    x = np.zeros(cir.n)
+    G = cir.G(x, epar)
+    for i in range(3):
+        cir.G(x, epar)
+        cir.G(x, epar, sparse=True)
+    assert_equal(len(calls), 2)
+
+    ## Nonlinear elements are still evaluated in every call
+    x[0] = 0.5
+    assert cir.G(x, epar)[0,0] > G[0,0]
+
+    ## The cache follows changes of instance and environment parameters
+    cir['R1'].ipar.r = 2e3
+    assert_array_almost_equal(cir.G(np.zeros(cir.n), epar)[0,0] - G[0,0], 
+                              -0.5e-3)
+    epar.T = 310
+    cir.G(x, epar)
+    assert_equal(len(calls), 4)
+
+    ## The u vector of the DC analysis is cached
+    assert_array_equal(cir.u(0, epar, analysis='dc'), [0, 0, -1])
+    cir['VS'].ipar.v = 2.0
+    assert_array_equal(cir.u(0, epar, analysis='dc'), [0, 0, -2])
+
+def test_linear_stamp_cache_unflagged():
+    """Test that the stamps of an element without the linear flag are 
+    evaluated in every call"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    class NonlinearC(Circuit):
+        terminals = ('plus', 'minus')
+        instparams = [Parameter(name='c', default=1e-9)]
+        def C(self, x, epar=defaultepar):
+            c = self.iparv.c * (1 + (x[0] - x[1])**2)
+            return np.array([[c, -c], [-c, c]])
+
+    cir = SubCircuit()
+    cir['C1'] = NonlinearC(1, gnd)
+    cir['R1'] = R(1, gnd)
+
+    epar = ParameterDict(Parameter('T', default=300))
+    assert_almost_equal(cir.C(np.zeros(cir.n), epar)[0,0] / 1e-9, 1)
+    assert_almost_equal(cir.C(np.array([2., 0.]), epar)[0,0] / 1e-9, 5)
+
+def test_eval_all():
+    """Test that eval_all gives the same result as the separate methods"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    cir = generate_testcircuit()
+    cir['C1'] = C('plus', gnd, c=1e-12)
+    cir['D1'] = Diode('minus', gnd)
+    cir['D2'] = Diode('plus', 'minus')
+
+    x = np.linspace(0.1, 0.5, cir.n)
+    epar = ParameterDict(Parameter('T', default=300))
+
+    result = cir.eval_all(x, 0, epar, analysis='dc')
+    assert_equal(set(result.keys()), set(['i', 'q', 'G', 'C', 'u']))
+    for method in 'i', 'q', 'G', 'C':
+        assert_array_almost_equal(result[method], 
+                                  getattr(cir, method)(x, epar))
+    assert_array_almost_equal(result['u'], cir.u(0, epar, analysis='dc'))
+
+    ## Per-instance evaluation of an element with shared intermediates
+    result = cir['D1'].eval_all(x[:2], epar=epar, want=('G', 'i'))
+    assert_array_almost_equal(result['G'], cir['D1'].G(x[:2], epar))
+    assert_array_almost_equal(result['i'], cir['D1'].i(x[:2], epar))
+
+def test_node_branch_index():
+    """Test node and branch index lookup after adding and deleting elements"""
+    cir = SubCircuit()
+    n1, n2 = cir.add_nodes('n1', 'n2')
+
+    cir['R1'] = R(n1, n2)
+    cir['V1'] = VS(n1, gnd)
+    cir['V2'] = VS(n2, gnd)
+    cir['V3'] = VS(n2, gnd)
+
+    for node in cir.nodes:
+        assert_equal(cir.get_node_index(node), cir.nodes.index(node))
+    for branch in cir.branches:
+        assert_equal(cir.get_branch_index(branch), 
+                     len(cir.nodes) + cir.branches.index(branch))
+
+    assert_equal(cir.get_node_index(n2, refnode=n1), 
+                 cir.nodes.index(n2) - 1)
+    assert_equal(cir.get_node_index(n1, refnode=n1), None)
+
+    del cir['V1']
+    del cir['R1']
+
+    assert_raises(ValueError, cir.get_node_index, n1)
+    assert_equal(cir.get_node_index(n2), cir.nodes.index(n2))
+    assert_equal(cir.get_branch_index(cir.branches[-1]), len(cir.nodes))
+    assert_equal(cir.elementnodemap['V3'], [cir.nodes.index(n2), 
+                                          cir.nodes.index(gnd),
+                                          len(cir.nodes)])
+
+    cir.add_terminals(['n2'])
+    assert_equal(cir.get_node_index(n2), 0)
+    assert_equal(cir.elementnodemap['V3'], [0, cir.nodes.index(gnd),
+                                            len(cir.nodes)])
+
+def test_add_instances():
+    """Test bulk adding of instances and lazy update of node maps"""
+    cir = SubCircuit()
+    cir['V1'] = VS('in', gnd)
+    cir.add_instances(('R%d'%k, R(k, k + 1)) for k in range(5))
+    cir.add_instances({'C1': C(5, gnd)})
+
+    for instancename, element in cir.elements.items():
+        nodes = [cir.term_node_map[instancename][terminal] 
+                 for terminal in element.terminals]
+        branches = list(cir._instance_branches(element, instancename))
+        assert_equal(cir.elementnodemap[instancename],
+                     [cir.get_node_index(node) for node in nodes] +
+                     [cir.get_branch_index(branch) for branch in branches])
+
+    ## Only instances with changed indices are updated
+    nodemap = cir.elementnodemap
+    cir['R5'] = R('in', 'out')
+    assert_true(cir.elementnodemap['R1'] is nodemap['R1'])
+    assert_false(cir.elementnodemap['V1'] is nodemap['V1'])
+    assert_equal(cir.elementnodemap['V1'], [cir.get_node_index(Node('in')),
+                                            cir.get_node_index(gnd),
+                                            len(cir.nodes)])
+
+    del cir['R5']
+    assert_equal(set(cir.elementnodemap.keys()), 
+                 set(['V1', 'C1'] + ['R%d'%k for k in range(5)]))
+
+def test_pickle_node_branch():
+    import pickle
+
+    n1, n2 = Node('n1'), Node('n2!')
+    branch = Branch(n1, n2)
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        n1copy, n2copy, branchcopy = \
+            pickle.loads(pickle.dumps((n1, n2, branch), protocol))
+        assert_equal(n1copy, n1)
+        assert_true(n2copy.isglobal)
+        assert_equal(branchcopy, branch)
+        assert_true(branchcopy.plus.name is n1.name)
+
+def test_batch_update():
+    """Test that parameter changes in a batch update the instances once"""
+    class CountingR(R):
+        updates = 0
+        def update(self, subject):
+            CountingR.updates += 1
+            super(CountingR, self).update(subject)
+
+    class A(SubCircuit):
+        instparams = [Parameter('x', default=1), Parameter('y', default=1)]
+
+    a = A()
+    a['R1'] = CountingR(1, 0, r='x + y')
+    assert_equal(a['R1'].iparv.r, 2)
+
+    CountingR.updates = 0
+    with a.batch_update():
+        a.ipar.x = 2
+        a.ipar.y = 3
+        assert_equal(CountingR.updates, 0)
+    assert_equal(CountingR.updates, 1)
+    assert_equal(a['R1'].iparv.r, 5)
+
+    ## Setting unchanged values does not update the instances
+    a.ipar.set(x=2, y=3)
+    assert_equal(CountingR.updates, 1)
+
+    ## Other circuits and other threads are updated immediately
+    import threading
+    b = A()
+    b['R1'] = R(1, 0, r='x + y')
+    with a.batch_update():
+        b.ipar.x = 2
+        assert_equal(b['R1'].iparv.r, 3)
+        thread = threading.Thread(target=lambda: a.ipar.set(x=4))
+        thread.start()
+        thread.join()
+        assert_equal(a['R1'].iparv.r, 7)
+
+def test_bypass():
+    """Test that G of nonlinear elements is reused for small changes of x"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    cir = SubCircuit()
+    cir['R1'] = R('in', 'a', r=1e3)
+    cir['D1'] = Diode('a', gnd)
+    cir['D2'] = Diode('in', gnd)
+    cc = cir.compile()
+    epar = ParameterDict(Parameter('T', default=300))
+
+    x0 = np.array([0.6, 0.5, 0.])
+    G0 = cc.eval_all(x0, epar=epar, want=('G',), bypass=1e-3)['G']
+
+    ## Only the voltage of D2 has changed more than the tolerance
+    x = x0 + np.array([1e-2, 1e-4, 0.])
+    values = cc.eval_all(x, epar=epar, want=('i', 'G'), bypass=1e-3)
+    assert_equal(cc.nbypass, 1)
+
+    reference = cc.eval_all(x, epar=epar, want=('i', 'G'))
+    assert_array_equal(values['i'], reference['i'])
+    assert_array_equal(values['G'][1, 1], G0[1, 1])
+    assert_array_equal(values['G'][0, 0], reference['G'][0, 0])
+    assert values['G'][1, 1] != reference['G'][1, 1]
+
+def test_overlay():
+    """Test that a copy-on-write overlay gives the same result as a copy"""
+    from pycircuit.circuit import sparse
+    epar = ParameterDict(Parameter('T', default=300))
+
+    for toolkit in numeric, sparse:
+        pycircuit.circuit.circuit.default_toolkit = toolkit
+        
+        cir = generate_testcircuit()
+        cir['D1'] = Diode('minus', gnd)
+        cir['C1'] = C('plus', gnd, c=1e-12)
+        cir['V1'] = VS('plus', gnd, v=1)
+        cir['V2'] = VS('plus', gnd, v=1)
+        cir['R4'] = R('minus', 'floating')
+
+        Gbase = toolkit.todense(cir.G(np.zeros(cir.n), epar))
+
+        for modify in (lambda c: c.__setitem__('VL', VS('minus', 'new')),
+                       lambda c: c.__delitem__('V1'),
+                       lambda c: c.__delitem__('R4'),
+                       lambda c: c.__setitem__('D1', 
+                                               Diode('plus', 'minus'))):
+            overlay = cir.overlay()
+            reference = copy(cir)
+            modify(overlay)
+            modify(reference)
+
+            assert_equal(overlay.n, reference.n)
+            assert_equal(overlay.nodes, reference.nodes)
+            assert_equal(overlay.branches, reference.branches)
+
+            x = np.linspace(0.1, 0.3, overlay.n)
+            for method in 'G', 'C':
+                assert_array_almost_equal(
+                    toolkit.todense(getattr(overlay, method)(x, epar)),
+                    toolkit.todense(getattr(reference, method)(x, epar)))
+            for method in 'i', 'q':
+                assert_array_almost_equal(getattr(overlay, method)(x, epar),
+                                          getattr(reference, method)(x, epar))
+            assert_array_almost_equal(overlay.u(0, epar, analysis='dc'),
+                                      reference.u(0, epar, analysis='dc'))
+            assert_array_almost_equal(toolkit.todense(overlay.CY(x, 1, epar)),
+                                      toolkit.todense(reference.CY(x, 1, epar)))
+
+            ## The base circuit is unchanged
+            assert_array_equal(toolkit.todense(cir.G(np.zeros(cir.n), epar)),
+                               Gbase)
+
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+def test_overlay_removed_precision():
+    """Test that removed instances are not subtracted from the base"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    cir = SubCircuit()
+    cir['Rsmall'] = R(1, gnd, r=1e-6)
+    cir['Rlarge'] = R(1, gnd, r=1e9)
+    overlay = cir.overlay()
+    del overlay['Rsmall']
+    assert_almost_equal(overlay.G(np.zeros(overlay.n), epar)[0,0] / 1e-9, 1)
+
+    ## The diode current overflows at 100V
+    cir = SubCircuit()
+    cir['V1'] = VS(1, gnd, v=100)
+    cir['R1'] = R(1, gnd, r=1e3)
+    cir['D1'] = Diode(1, gnd)
+    overlay = cir.overlay()
+    del overlay['D1']
+    x = np.array([100., 0., 0.])
+    assert_array_almost_equal(overlay.i(x, epar), [0.1, -0.1, 100.])
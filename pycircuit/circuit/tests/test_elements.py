@@ -350,5 +350,46 @@ def test_Idtmod_modulo():
     # vout = vin * t with constant input => test that v(nout) = t
     assert_array_equal(y[1:]/(x[1:]%1.0), np.ones(y[1:].size)) #avoid divide by t=0.0
 
+def test_batch_methods():
+    """Test that the batch methods agree with the instance methods"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    instances = [[R(r=1e3), R(r=2.2e3)],
+                 [C(c=1e-12), C(c=3e-9)],
+                 [L(L=1e-9), L(L=2e-6)],
+                 [VS(v=1, vac=2, phase=30), VS(v=-2)],
+                 [IS(i=1e-3, iac=1, phase=45), IS(i=2e-3)],
+                 [VCCS(gm=1e-3), VCCS(gm=-2e-3)],
+                 [VCVS(g=2), VCVS(g=-10)],
+                 [Diode(IS=1e-14), Diode(IS=2e-13)],
+                 [VCVS_limited(g=2, level=1), 
+                  VCVS_limited(g=3, level=0.5, offset=0.1)]]
+
+    for elements in instances:
+        cls = elements[0].__class__
+        params = dict((param.name, 
+                       np.array([e.iparv.get(param) for e in elements]))
+                      for param in cls.instparams)
+        X = np.random.uniform(-0.5, 0.5, (len(elements), elements[0].n))
+
+        for method in 'G', 'C', 'i', 'q':
+            batch = pycircuit.circuit.circuit.batchmethod(cls, method)
+            assert batch is not None, '%s.%s'%(cls.__name__, method)
+            assert_array_almost_equal(
+                batch(X, params, epar),
+                [getattr(e, method)(x, epar) for e, x in zip(elements, X)])
+
+        for analysis in None, 'dc', 'ac':
+            batch = pycircuit.circuit.circuit.batchmethod(cls, 'u')
+            if batch is not None:
+                assert_array_almost_equal(
+                    batch(0, params, epar, analysis),
+                    [e.u(0, epar, analysis) for e in elements])
+
+    ## Time dependent sources and elements without batch methods
+    for cls in VSin, VPulse, ISin, Nullor:
+        assert_equal(pycircuit.circuit.circuit.batchmethod(cls, 'u'), None)
+
 if __name__ == '__main__':
     test_nullor_vva()
@@ -4,12 +4,19 @@
 
 from pycircuit.circuit.analysis import *
 from pycircuit.circuit.dcanalysis import DC
-from pycircuit.circuit.dcanalysis import refnode_removed
+from pycircuit.circuit.circuit import CompiledCircuit, Branch
+
+import numpy as np
+from collections import OrderedDict
 
 class Transient(Analysis):
     """Simple transient analysis class.
 
-    Time step is fixed.
+    The time step is fixed unless the adaptive parameter is set. Then the
+    local truncation error of the charges is estimated from the difference
+    between the backward euler and trapezoidal derivatives and steps with
+    too large error or where Newton's method fails are rejected and 
+    retried with a shorter step.
 
     i(t) = c*dv/dt
     v(t) = L*di/dt
@@ -52,12 +59,23 @@ class Transient(Analysis):
     >>> expected = 0.063
     >>> abs(res.v(n1,gnd)[-1]) < 1e-1*expected #node 2 of last x
     True
+
+    Adaptive time step, the time axis of the result is non-uniform:
+
+    >>> c = SubCircuit()
+    >>> c['Is'] = IS(gnd, 1, i=1e-3)
+    >>> c['R'] = R(1, gnd, r=1e3)
+    >>> c['C'] = C(1, gnd, c=1e-9)
+    >>> tran = Transient(c, adaptive=True, method='trapezoidal')
+    >>> res = tran.solve(tend=10e-6, timestep=1e-8)
+    >>> round(res.v(1, gnd)[-1], 3)
+    1.0
+    >>> len(res.v(1, gnd).x[0]) < 200
+    True
     
     """
-    ## TODO:
-    ## * Implement automatic timestep adjustment, using difference between
-    ##   BE and trapezoidal as a measure of the error.
-    ##   Reference: "Time Step Control in Transient Analysis", by SHUBHA VIJAYCHAND
+    ## Reference: "Time Step Control in Transient Analysis", by 
+    ## SHUBHA VIJAYCHAND
     
 
     parameters = Analysis.parameters + \
@@ -78,7 +96,57 @@ class Transient(Analysis):
                    default=100),
          Parameter(name='method', 
                    desc='Differentiation method', unit='', 
-                   default="euler")]        
+                   default="euler"),
+         Parameter(name='chord', 
+                   desc='Reuse the Jacobian factorization between Newton '
+                   'iterations and timesteps and bypass unchanged devices',
+                   unit='', default=False),
+         Parameter(name='fastlinear', 
+                   desc='Solve the time steps of circuits where all '
+                   'elements set linear = True without Newton iterations '
+                   'using one factorization per time step size', 
+                   unit='', default=True),
+         Parameter(name='bypasstol', 
+                   desc='Largest change of the x-vector of a device '
+                   'whose G and C matrices are reused in chord mode', 
+                   unit='V', default=1e-6),
+         Parameter(name='adaptive', 
+                   desc='Control the time step by the local truncation '
+                   'error', unit='', default=False),
+         Parameter(name='chgtol', 
+                   desc='Absolute charge error tolerance', unit='C', 
+                   default=1e-14),
+         Parameter(name='trtol', 
+                   desc='Factor of overestimation of the truncation error', 
+                   unit='', default=7),
+         Parameter(name='dtmin', desc='Smallest time step', unit='s', 
+                   default=1e-15),
+         Parameter(name='dtmax', 
+                   desc='Largest time step, default is tend/50', unit='s', 
+                   default=None),
+         Parameter(name='maxgrowth', 
+                   desc='Largest increase factor of the time step', unit='', 
+                   default=2.),
+         Parameter(name='breakpoints', 
+                   desc='Land time steps on the discontinuities of the '
+                   'sources, default is only with adaptive time steps', 
+                   unit='', default=None),
+         Parameter(name='save', 
+                   desc='Nodes and branches to save, default is all', 
+                   unit='', default=None),
+         Parameter(name='outfile', 
+                   desc='File of memory-mapped result, default is to keep '
+                   'the result in memory', unit='', default=None),
+         Parameter(name='chunksize', 
+                   desc='Number of time points that are written together', 
+                   unit='', default=1024),
+         Parameter(name='callback', 
+                   desc='Function called as callback(t, x) after each '
+                   'time step', unit='', default=None),
+         Parameter(name='store', 
+                   desc='OperatingPointStore of initial conditions, a '
+                   'stored state is only used as starting guess of the '
+                   'first time step', unit='', default=None)]        
 
     def __init__(self, cir, toolkit=None, irefnode=None, **kvargs):
         self.parameters = super(Transient, self).parameters + self.parameters            
@@ -95,70 +163,235 @@ class Transient(Analysis):
         
         self._dt = None
         self._diff_error = None #used for saving difference between euler and trapezoidal
+        self._jacobiankey = None #timestep and method of the last factorized Jacobian
+        self._steperror = None #truncation error ratio of the last step, None if Newton failed
+
+        ## Number of accepted steps and of steps rejected by the truncation
+        ## error or by Newton's method
+        self.stepstats = {'accepted': 0, 'lte': 0, 'newton': 0}
+
+        ## Linear solver that is shared by all Newton iterations and timesteps
+        self.solver = self.create_solver()
+
+        ## Constant G and C matrices of a linear circuit and the linear 
+        ## solvers with the factorized G + Geq for each time step size and
+        ## integration method, see _solve_linear_timestep
+        self._linearGC = None
+        self.linearsolvers = OrderedDict()
+
+        ## Work vectors that are reused between the time steps, see 
+        ## _setup_buffers
+        self._keep = None
+        self._buffers = {}
+
+    ## Largest number of kept factorizations of linear circuits
+    maxlinearsolvers = 16
     
     ## This is borrowed from dcanalysis.py, would like to 
     ## import it from there instead.
     ## But it's an object method requiring a DC as self
     ## so using DC._newton doesn't work
-    def _newton(self, func, x0): 
-        ones_nodes = self.toolkit.ones(len(self.cir.nodes))
-        ones_branches = self.toolkit.ones(len(self.cir.branches))
-        
-        abstol = self.toolkit.concatenate((self.par.iabstol * ones_nodes,
-                                 self.par.vabstol * ones_branches))
-        xtol = self.toolkit.concatenate((self.par.vabstol * ones_nodes,
-                                 self.par.iabstol * ones_branches))
-        
-        (x0, abstol, xtol) = remove_row_col((x0, abstol, xtol), self.irefnode, self.toolkit)
+    def _newton(self, func, x0, reuse=False): 
+        if self._keep is None:
+            self._setup_buffers()
+        x0 = self._reduce(x0)
+        xnew, xold = self._xnew, self._xold
         
+        def reduced(x, *args, **kvargs):
+            f, J = func(self._expand(x, xnew), *args, **kvargs)
+            return self._reduce(f), self._reduce(J)
+
+        cir = self.cir.compile()
+        def limit(x, x0):
+            limited = cir.limit(self._expand(x, xnew), self._expand(x0, xold),
+                                self.epar)
+            if limited is xnew:
+                return x
+            return self._reduce(limited)
+
         try:
-            result = fsolve(refnode_removed(func, self.irefnode, self.toolkit), 
+            result = fsolve(reduced, 
                             x0, 
                             full_output = True, 
                             reltol = self.par.reltol,
-                            abstol = abstol, xtol=xtol,
+                            abstol = self._abstol, xtol = self._xtol,
                             maxiter = self.par.maxiter,
-                            toolkit = self.toolkit)
+                            toolkit = self.toolkit,
+                            solver = self.solver,
+                            limit = limit,
+                            chord = self.par.chord, reuse = reuse)
         except self.toolkit.linalg.LinAlgError, e:
             raise SingularMatrix(e.message)
         
         x, infodict, ier, mesg = result
+        self.infodict = infodict
         
         if ier != 1:
             raise NoConvergenceError(mesg)
         
         # Insert reference node voltage
-        return self.toolkit.concatenate((x[:self.irefnode], self.toolkit.array([0.0]), x[self.irefnode:]))
-    
+        return self._expand(x)
+
+    def _setup_buffers(self):
+        """Preallocate the work vectors of the time steps
+
+        Newton's method solves the system with the row and column of the 
+        reference node excluded. When the reference node is the first or 
+        last element of the x-vector the reduced vectors and dense matrices
+        are views of the full ones.
+        """
+        toolkit = self.toolkit
+        n, i = self.cir.n, self.irefnode
+        if i == 0:
+            keep = slice(1, n)
+            self._keep2 = keep, keep
+        elif i == n - 1:
+            keep = slice(0, n - 1)
+            self._keep2 = keep, keep
+        else:
+            keep = np.delete(np.arange(n), i)
+            self._keep2 = np.ix_(keep, keep)
+        self._keep = keep
+
+        ones_nodes = toolkit.ones(len(self.cir.nodes))
+        ones_branches = toolkit.ones(len(self.cir.branches))
+        abstol = toolkit.concatenate((self.par.iabstol * ones_nodes,
+                                      self.par.vabstol * ones_branches))
+        xtol = toolkit.concatenate((self.par.vabstol * ones_nodes,
+                                    self.par.iabstol * ones_branches))
+        self._abstol, self._xtol = abstol[keep], xtol[keep]
+
+        ## Full x-vectors of the reduced iterates
+        self._xnew = toolkit.zeros(n)
+        self._xold = toolkit.zeros(n)
+        self._zeros = toolkit.zeros(n)
+        self._buffers = {}
+
+    def _reduce(self, A):
+        """Return vector or matrix without the reference node"""
+        if A is None:
+            return None
+        if len(A.shape) == 1:
+            return A[self._keep]
+        if isinstance(A, np.ndarray):
+            return A[self._keep2]
+        return A[self._keep][:, self._keep]
+
+    def _expand(self, x, out=None):
+        """Insert the reference node into a reduced x-vector"""
+        if out is None:
+            out = self.toolkit.zeros(self.cir.n, dtype=x.dtype)
+        out[self._keep] = x
+        out[self.irefnode] = 0
+        return out
+
+    def _buffer(self, name, like):
+        """Return a reused work vector with the shape and type of like"""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != like.shape or buf.dtype != like.dtype:
+            buf = self._buffers[name] = np.empty_like(like)
+        return buf
+
     def get_timestep(self,endtime,dtmin=1e-12):
         """Method to provide the next timestep for transient simulation.
-        
+
+        Yields time and timestep of the next step. With a fixed timestep
+        the time is incremented by the timestep. With the adaptive 
+        parameter set the error ratio of the last step in self._steperror
+        decides if the step is accepted and the size of the next step.
+        A step is accepted if the ratio is less than one and the next step
+        is scaled by 0.9/sqrt(ratio), bounded by the maxgrowth parameter.
+        A step where Newton's method failed is retried with 1/8 of the 
+        timestep.
+
+        With the breakpoints parameter set, by default only for adaptive
+        time steps, the steps also land on the discontinuities of the 
+        sources given by the next_event method of the circuit, such as 
+        the corners of a pulse. The integration is restarted with backward 
+        euler after a breakpoint and an adaptive step is then limited to 
+        the initial timestep and a tenth of the time to the next breakpoint.
         """
-        ## Use the difference between euler and trapezoidal
-        ## Error as abs(self._diff_error)/abs(self._iq) - iq_tolerance
-        ## If error > 0: decrease timestep
-        ## If error < 0: increase timestep
-        
-        ## Start with simple variant:
-        ## increase as dt *=2
-        ## decrease as dt /=2
-        ## with convergence error, both decrease and reject timestep
-        ## support for rejecting timesteps need to be implemented
-        
-        iq_tolerance = 1e-2
-        iq_p = 1e4 #proportionality constant
-        iq_i = 1 #integrator constant
-        dt=self._dt
+        cir = self.cir.compile()
+        self._breakpoints = self.par.breakpoints
+        if self._breakpoints is None:
+            self._breakpoints = self.par.adaptive
+        timestep=dt=self._dt
         t=0
-        while t<endtime:
+        ## Events closer than tol are considered to be at the same time
+        tol = 1e-9 * timestep
+        tbreak = self._next_breakpoint(cir, t, endtime, tol)
+        if not self.par.adaptive:
+            tgrid = t
+            while t<endtime:
+                yield t,dt
+                ongrid = t == tgrid
+                if ongrid:
+                    tgrid += timestep
+                if self._breakpoints and t >= tbreak - tol:
+                    self._iqlast = None
+                    tbreak = self._next_breakpoint(cir, t, endtime, tol)
+                if tbreak < tgrid - tol:
+                    t, dt = tbreak, tbreak - t
+                elif ongrid:
+                    t, dt = tgrid, timestep
+                else:
+                    t, dt = tgrid, tgrid - t
+            return
+
+        dtmin = self.par.dtmin
+        dtmax = self.par.dtmax or endtime / 50.
+        dt = min(dt, dtmax)
+        tlast = t - dt
+        while tlast<endtime:
             yield t,dt
-            de=self._diff_error
-            iq=self._iq
-            if (de != None) and (iq != None):
-                #iq_error=self.toolkit.dot(de,de)/self.toolkit.dot(iq,iq)-iq_tolerance
-                #print iq_error
-                dt = max(dt, dtmin)
-            t+=dt
+            error = self._steperror
+            if error is None:
+                dt /= 8
+            elif error > 1:
+                dt *= max(0.9 / self.toolkit.sqrt(error), 0.25)
+            else:
+                tlast = t
+                if tlast >= endtime:
+                    return
+                dt *= min(0.9 / self.toolkit.sqrt(max(error, 1e-12)), 
+                          self.par.maxgrowth)
+                dt = min(dt, dtmax)
+                if tlast >= tbreak - tol:
+                    ## Restart with a small backward euler step
+                    self._iqlast = None
+                    tbreak = self._next_breakpoint(cir, tlast, endtime, tol)
+                    dt = min(dt, timestep, 0.1 * (tbreak - tlast))
+            ## Land on the next breakpoint without a tiny step before it
+            if tlast + 1.01 * dt > tbreak > tlast:
+                dt = tbreak - tlast
+            if dt < dtmin:
+                raise NoConvergenceError('Time step too small at t=%g' % t)
+            t = tlast + dt
+
+    def _next_breakpoint(self, cir, t, endtime, tol):
+        """Return the first source discontinuity after time t, at most 
+        endtime"""
+        if not self._breakpoints:
+            return endtime
+        ## next_event may return t itself if t is at an event
+        return min(cir.next_event(t + tol, discontinuous=True), endtime)
+
+    def _lte_ratio(self, q, qlast):
+        """Return the largest ratio of truncation error to tolerance
+
+        The local truncation error of the charges is estimated as 
+        dt * (trapezoidal - backward euler derivative) and is weighted by
+        reltol*|q| + chgtol.
+        """
+        de = self._diff_error
+        if de is None:
+            return 0.
+        tol = self.par.reltol * self.toolkit.maximum(abs(q), abs(qlast)) + \
+            self.par.chgtol
+        error = abs(self._dt * de) / tol / self.par.trtol
+        if len(error) == 0:
+            return 0.
+        return max(error)
     
     def get_diff(self,q,C):#shouldn't I provide an x0 here?
         """Method used to calculate time derivative for charge storing elements (i_eq and g_eq).
@@ -171,49 +404,101 @@ class Transient(Analysis):
         """
         #calculate in a more general way with coefficients dependent on method
         #the amount of history values is determined by the length of the coefficient-vector
+        #the derivatives are calculated in place in reused work vectors
         
         dt=self._dt
         a,b,b_=self._method[self.par.method] 
-        resultEuler = (q-self._qlast[0])/dt
-        if self._iqlast == None: #first step always requires backward euler
-            geq=C/dt
+        firststep = self._iqlast is None
+        geq = None #not needed when C is not given
+        if C is not None:
+            geq = C * self._geq_factor(firststep)
+
+        iq = self._buffer('iq', q)
+        np.subtract(q, self._qlast[0], out=iq)
+        iq /= dt #backward euler
+        if firststep: #first step always requires backward euler
             n=self.cir.n
-            self._iqlast=self.toolkit.zeros((len(b),n)) #initialize history vectors at first step
-            iq = resultEuler
+            self._iqlast=History(len(b), n, self.toolkit) #initialize history vectors at first step
         else:
-            geq=C/dt/b_
-            resultTrap = 2*(q-self._qlast[0])/dt-self._iqlast[0]
-            self._diff_error = resultTrap-resultEuler # Difference between euler and trap.
-            if self.par.method == 'euler':
-                iq = resultEuler
-            elif self.par.method == 'trapezoidal':
-                iq = resultTrap
-            else:
-                iq=(q-self.toolkit.dot(a,self._qlast))/dt/b_ - self.toolkit.dot(b,self._iqlast)/b_
+            ## Difference between trapezoidal and euler, 2*euler - iqlast - euler
+            self._diff_error = np.subtract(iq, self._iqlast[0], 
+                                           out=self._buffer('diff_error', q))
+            if self.par.method == 'trapezoidal':
+                iq *= 2
+                iq -= self._iqlast[0]
+            elif self.par.method != 'euler':
+                self._qlast.weighted(a, out=iq)
+                np.subtract(q, iq, out=iq)
+                iq /= dt*b_
+                iq -= self._iqlast.weighted(b / b_)
         self._iq=iq #make accessible by get_timestep
         return iq,geq
-    
+
+    def _geq_factor(self, firststep):
+        """Return the factor of C in the companion model conductance Geq"""
+        a,b,b_=self._method[self.par.method] 
+        if firststep:
+            return 1. / self._dt
+        return 1. / (self._dt * b_)
     
     def solve_timestep(self, x0, t, refnode=gnd, provided_function=None):
         #if provided_function is not None, it is called as a function with 
         #most of what is calculated during a time_step, f,J,ueq,Geq,xlast,x
         
-        n=self.cir.n
+        cir = self.cir.compile()
+        n=cir.n
         x0 = x0
         dt = self._dt
         
-        def func(x):
-            C = self.cir.C(x)
-            q=self.cir.q(x)
-            iq,Geq = self.get_diff(q,C)
-            f =self.cir.i(x) + iq + self.cir.u(t, analysis=self.par.analysis)
-            J = self.cir.G(x) + Geq #return C somehow?
-            return self.toolkit.array(f, dtype=float), self.toolkit.array(J, dtype=float)
+        if provided_function is None and self.par.fastlinear and \
+                self.solver is not None and cir.linear:
+            return self._solve_linear_timestep(cir, t), None
+
+        kvargs = {}
+        if self.par.chord and isinstance(cir, CompiledCircuit):
+            kvargs['bypass'] = self.par.bypasstol
+
+        ## get_diff initializes the history at the first call, all Newton
+        ## iterations of the first step must use backward euler
+        firststep = self._iqlast is None
+
+        ## The compiled circuit returns new arrays that f and J are 
+        ## assembled in, leaf circuits may return their own arrays
+        inplace = isinstance(cir, CompiledCircuit)
+        geqfactor = self._geq_factor(firststep)
+
+        def func(x, jacobian=True):
+            if firststep:
+                self._iqlast = None
+            if jacobian:
+                want = ('i', 'q', 'G', 'C', 'u')
+            else:
+                want = ('i', 'q', 'u')
+            values = cir.eval_all(x, t, analysis=self.par.analysis, 
+                                  want=want, **kvargs)
+            if not inplace:
+                values = dict((name, self.toolkit.array(value, dtype=float))
+                              for name, value in values.items())
+            ## The last evaluation is at the solution
+            q = self._qstep = values['q']
+            iq,Geq = self.get_diff(q,None)
+            f = values['i']
+            f += iq
+            f += values['u']
+            if not jacobian:
+                return f, None
+            Geq = values['C']
+            Geq *= geqfactor
+            J = values['G']
+            J += Geq
+            return f, J
         
-        x=self._newton(func,x0)
-        #history update
-        self._iqlast = self.toolkit.concatenate((self.toolkit.array([self._iq]),self._iqlast))[:-1]
-        self._qlast = self.toolkit.concatenate((self.toolkit.array([self.cir.q(x)]),self._qlast))[:-1]
+        ## The Jacobian depends on x and on the coefficients of the 
+        ## companion models, the first step always uses backward euler
+        jacobiankey = dt, firststep
+        x=self._newton(func, x0, reuse = jacobiankey == self._jacobiankey)
+        self._jacobiankey = jacobiankey
+        self._update_history(self._qstep)
         
         # Insert reference node voltage
         #x = self.toolkit.concatenate((x[:irefnode], self.toolkit.array([0.0]), x[irefnode:]))
@@ -224,11 +509,131 @@ class Transient(Analysis):
         return result
     
     
+    def _solve_linear_timestep(self, cir, t):
+        """Solve a time step of a linear circuit without Newton iterations
+
+        G and C are constant and the companion models are linear in q so
+        the matrix G + Geq only depends on the time step and on whether the
+        first step backward euler or the selected method is used. The 
+        factorization of the matrix is kept and the time step is solved by
+        a back-substitution of a right hand side of the sources and the 
+        history of the charges.
+
+        >>> c = SubCircuit()
+        >>> c['Is'] = IS(gnd, 1, i=1e-3)
+        >>> c['R'] = R(1, gnd, r=1e3)
+        >>> c['C'] = C(1, gnd, c=1e-9)
+        >>> tran = Transient(c, method='trapezoidal')
+        >>> res = tran.solve(tend=10e-6, timestep=1e-7)
+        >>> sorted(tran.linearsolvers.keys())
+        [(1e-07, False), (1e-07, True)]
+        >>> [solver.stats['full'] for solver in tran.linearsolvers.values()]
+        [1, 1]
+
+        """
+        toolkit = self.toolkit
+        if self._keep is None:
+            self._setup_buffers()
+        if self._linearGC is None:
+            x = toolkit.zeros(cir.n)
+            self._linearGC = cir.G(x, self.epar), cir.C(x, self.epar)
+        G, C = self._linearGC
+
+        firststep = self._iqlast is None
+        key = self._dt, firststep
+        geqfactor = self._geq_factor(firststep)
+
+        ## The derivative of the charges and the difference between the 
+        ## trapezoidal and euler derivatives at q = 0
+        iq, Geq = self.get_diff(self._zeros, None)
+
+        b = -cir.u(t, self.epar, analysis=self.par.analysis)
+        b -= iq
+
+        solver = self.linearsolvers.pop(key, None)
+        try:
+            if solver is None:
+                solver = self.create_solver()
+                x = solver.solve(self._reduce(G + geqfactor * C), 
+                                 self._reduce(b))
+            else:
+                x = solver.resolve(self._reduce(b))
+        except toolkit.linalg.LinAlgError, e:
+            raise SingularMatrix(e.message)
+        self.linearsolvers[key] = solver
+        if len(self.linearsolvers) > self.maxlinearsolvers:
+            self.linearsolvers.popitem(last=False)
+
+        x = self._expand(x)
+
+        q = toolkit.dot(C, x)
+        iq += geqfactor * q
+        if not firststep:
+            self._diff_error += q / self._dt
+        self._update_history(q)
+        return x
+
+    def _update_history(self, q):
+        """Push the charges and their derivatives of a step to the history"""
+        self._iqlast.push(self._iq)
+        self._qlast.push(q)
+
+    def _mark_history(self):
+        """Return a mark of the history that _restore_history returns to"""
+        if self._iqlast is None:
+            iqmark = None
+        else:
+            iqmark = self._iqlast.mark()
+        diff_error = self._diff_error
+        if diff_error is not None:
+            diff_error = self._buffer('saved_diff_error', diff_error)
+            diff_error[:] = self._diff_error
+        return self._qlast.mark(), iqmark, diff_error
+
+    def _restore_history(self, mark):
+        """Undo the history update of a rejected time step"""
+        qmark, iqmark, self._diff_error = mark
+        self._qlast.restore(qmark)
+        if iqmark is None:
+            self._iqlast = None
+        else:
+            self._iqlast.restore(iqmark)
+
     def solve(self, refnode=gnd, tend=1e-3, x0=None, timestep=1e-6, provided_function=None):
         #provided_function is a function that is sent to solve_timestep for evaluation
-        
-        X = [] # will contain a list of all x-vectors
+        for t, x in self.steps(refnode, tend, x0, timestep, provided_function):
+            pass
+        return self.result
+
+    def steps(self, refnode=gnd, tend=1e-3, x0=None, timestep=1e-6, provided_function=None):
+        """Generator of the accepted time steps, yields time and x-vector
+
+        The saved part of the x-vectors is written to the storage of the 
+        analysis as the steps are taken and the result is available as
+        the result attribute when the generator is exhausted. The callback
+        parameter, if given, is called as callback(t, x) for every step.
+
+        >>> c = SubCircuit()
+        >>> n1 = c.add_node('1')
+        >>> c['Is'] = IS(gnd, n1, i=1e-3)
+        >>> c['R'] = R(n1, gnd, r=1e3)
+        >>> c['C'] = C(n1, gnd, c=1e-9)
+        >>> tran = Transient(c, save=[n1])
+        >>> for t, x in tran.steps(tend=4e-6, timestep=1e-6):
+        ...     print round(t, 9), round(x[0], 3)
+        0.0 0.5
+        1e-06 0.75
+        2e-06 0.875
+        3e-06 0.938
+        >>> print tran.result.v(n1, gnd)[-1]
+        0.9375
+
+        """
         self.irefnode=self.cir.get_node_index(refnode)
+        self._jacobiankey = None
+        self._setup_buffers()
+        self._linearGC = None
+        self.linearsolvers.clear()
         n = self.cir.n
         self._dt = timestep
         if x0 is None:
@@ -237,34 +642,250 @@ class Transient(Analysis):
             x = x0 
         
         a,b,b_=self._method[self.par.method] 
-        self._qlast=self.toolkit.zeros((len(a),n))#initialize q-history vector
+        self._qlast=History(len(a), n, self.toolkit)#initialize q-history vector
         #shift in q(x0) to q-history
-        self._qlast = self.toolkit.concatenate((self.toolkit.array([self.cir.q(x)]),self._qlast))[:-1]
-        #is this still needed
-        order=1 #number of past x-values needed
-        for i in xrange(order):
-            X.append(copy(x))
+        self._qlast.push(self.cir.q(x))
+        xlast = x
+
+        ## Initial conditions are saved in the store. A stored state never 
+        ## changes the initial condition, it is only the starting guess of 
+        ## the first step
+        store = self.par.store
+        if x0 is None and store is not None:
+            xstored = store.load(self.cir, 'tran')
+            if xstored is not None:
+                xlast = xstored
+        elif store is not None:
+            store.save(self.cir, x0, 'tran')
+
+        storage = TransientStorage(self._save_indices(), 
+                                   chunksize=self.par.chunksize,
+                                   filename=self.par.outfile)
+        self.storage = storage
         
         times = self.get_timestep(tend)
-        timelist=[] #for plotting purposes
         self._iqlast=None #forces first step to be Backward Euler
+        self._diff_error=None
+        self.stepstats = {'accepted': 0, 'lte': 0, 'newton': 0}
         for t,dt in times:
-            timelist.append(t)
             self._dt=dt
-            x,feval=self.solve_timestep(X[-1], t, provided_function=provided_function)
-            X.append(copy(x))
-        X = self.toolkit.array(X[1:]).T
-        timelist = self.toolkit.array(timelist)
-        
-        #print("steps: "+str( len(timelist)))
+            if not self.par.adaptive:
+                x,feval=self.solve_timestep(xlast, t, provided_function=provided_function)
+            else:
+                history = self._mark_history()
+                try:
+                    x,feval=self.solve_timestep(xlast, t, provided_function=provided_function)
+                except (NoConvergenceError, SingularMatrix):
+                    self._steperror = None
+                else:
+                    self._steperror = self._lte_ratio(self._qlast[0], 
+                                                      self._qlast[1])
+
+                if self._steperror is None or self._steperror > 1:
+                    ## Reject the step and restore the history
+                    self._restore_history(history)
+                    self._jacobiankey = None
+                    if self._steperror is None:
+                        self.stepstats['newton'] += 1
+                    else:
+                        self.stepstats['lte'] += 1
+                    continue
+            self.stepstats['accepted'] += 1
+            storage.append(t, x)
+            xlast = x
+            if self.par.callback is not None:
+                self.par.callback(t, x)
+            yield t, x
+
+        storage.close()
+
+        if self.par.save is None:
+            X = storage.x
+        else:
+            X = storage
         
         self.result = CircuitResult(self.cir, x=X, xdot=None,
-                                    sweep_values=timelist, 
+                                    sweep_values=storage.t, 
                                     sweep_label='time', 
                                     sweep_unit='s')
-        
-        return self.result
 
+    def _save_indices(self):
+        """Return x-vector indices of the save parameter, all if None
+
+        The reference node is always saved.
+        """
+        if self.par.save is None:
+            return range(self.cir.n)
+
+        indices = set([self.irefnode])
+        for item in self.par.save:
+            if isinstance(item, Branch):
+                indices.add(self.cir.get_branch_index(item))
+            else:
+                if type(item) is str:
+                    item = self.cir.get_node(item)
+                indices.add(self.cir.get_node_index(item))
+        return sorted(indices)
+
+class History(object):
+    """Ring buffer of the last vectors of a quantity, the newest first
+
+    A push copies the vector into the buffer without allocating a new 
+    array. The buffer has a row more than the depth so the vector that 
+    was dropped by the last push is still available as h[depth] and the
+    push can be undone by restoring a mark.
+
+    >>> h = History(1, 3)
+    >>> h.push(np.ones(3))
+    >>> mark = h.mark()
+    >>> h.push(np.arange(3.))
+    >>> h[0], h[1]
+    (array([ 0.,  1.,  2.]), array([ 1.,  1.,  1.]))
+    >>> h.restore(mark)
+    >>> h[0]
+    array([ 1.,  1.,  1.])
+
+    """
+    def __init__(self, depth, n, toolkit=None):
+        if toolkit is None:
+            toolkit = numeric
+        self.depth = depth
+        self._rows = toolkit.zeros((depth + 1, n))
+        self._head = 0
+        self._weighted = toolkit.zeros(n)
+
+    def __getitem__(self, k):
+        return self._rows[(self._head - k) % len(self._rows)]
+
+    def __len__(self):
+        return self.depth
+
+    def push(self, x):
+        self._head = (self._head + 1) % len(self._rows)
+        self._rows[self._head] = x
+
+    def mark(self):
+        return self._head
+
+    def restore(self, mark):
+        self._head = mark
+
+    def weighted(self, coefficients, out=None):
+        """Return the sum of coefficients[k] * h[k] of the last vectors
+
+        >>> h = History(2, 2)
+        >>> h.push(np.array([1., 2.]))
+        >>> h.push(np.array([3., 4.]))
+        >>> h.weighted([1., 0.5])
+        array([ 3.5,  5. ])
+
+        """
+        if out is None:
+            out = self._weighted
+        out[:] = 0
+        for k, c in enumerate(coefficients):
+            if c != 0:
+                out += c * self[k]
+        return out
+
+class TransientStorage(object):
+    """Chunked storage of saved x-vector elements of a transient analysis
+
+    Every stored time point is a row with the time followed by the saved
+    elements. The rows are collected in a buffer of *chunksize* rows that 
+    is written to a growing array when full. If *filename* is given the 
+    array is a numpy memory-mapped file so the memory use does not grow 
+    with the number of time points.
+
+    Indexing with an x-vector index returns the values of that element at
+    all time points.
+
+    >>> storage = TransientStorage([0, 2], chunksize=2)
+    >>> for t in range(3):
+    ...     storage.append(t, np.array([t, 10 * t, 100 * t]))
+    >>> storage.close()
+    >>> storage.t
+    array([ 0.,  1.,  2.])
+    >>> storage[2]
+    array([   0.,  100.,  200.])
+    >>> storage[1]
+    Traceback (most recent call last):
+    ...
+    KeyError: 'x-vector element 1 is not saved'
+
+    """
+    def __init__(self, indices, chunksize=1024, filename=None):
+        self.indices = np.array(indices, dtype=int)
+        self.columns = dict((index, k + 1) for k, index in enumerate(indices))
+        self.chunksize = chunksize
+        self.filename = filename
+        self.n = 0
+        self._buffer = np.zeros((chunksize, len(indices) + 1))
+        self._pending = 0
+        self._data = np.zeros((0, len(indices) + 1))
+        if filename is not None:
+            open(filename, 'wb').close()
+
+    def append(self, t, x):
+        row = self._buffer[self._pending]
+        row[0] = t
+        row[1:] = np.real(x[self.indices])
+        self._pending += 1
+        if self._pending == self.chunksize:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the array"""
+        if self._pending == 0:
+            return
+        nrows = self.n + self._pending
+        if nrows > len(self._data):
+            self._resize(max(2 * len(self._data), nrows))
+        self._data[self.n:nrows] = self._buffer[:self._pending]
+        self.n, self._pending = nrows, 0
+
+    def close(self):
+        """Flush the buffer and trim the array to the stored rows"""
+        self.flush()
+        self._resize(self.n)
+
+    def _resize(self, nrows):
+        ncols = self._buffer.shape[1]
+        if self.filename is None:
+            data = np.zeros((nrows, ncols))
+            data[:self.n] = self._data[:self.n]
+            self._data = data
+            return
+
+        if isinstance(self._data, np.memmap):
+            self._data.flush()
+        self._data = None
+        with open(self.filename, 'r+b') as f:
+            f.truncate(nrows * ncols * np.dtype(float).itemsize)
+        if nrows == 0:
+            self._data = np.zeros((0, ncols))
+        else:
+            self._data = np.memmap(self.filename, dtype=float, 
+                                        mode='r+', shape=(nrows, ncols))
+
+    @property
+    def t(self):
+        """Array of the stored time points"""
+        return self._view()[:self.n, 0]
+
+    @property
+    def x(self):
+        """Array of the saved elements with one column per time point"""
+        return self._view()[:self.n, 1:].T
+
+    def __getitem__(self, index):
+        if index not in self.columns:
+            raise KeyError('x-vector element %d is not saved' % index)
+        return self._view()[:self.n, self.columns[index]]
+
+    def _view(self):
+        ## Plain ndarray view of the memory-mapped array
+        return self._data.view(np.ndarray)
 
 if __name__ == "__main__":
     import doctest
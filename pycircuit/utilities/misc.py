@@ -7,6 +7,9 @@ from itertools import izip, groupby
 from operator import itemgetter
 import tempfile
 import shutil
+import contextlib
+import threading
+from collections import OrderedDict
 
 def isiterable(object):
     return hasattr(object,'__iter__')
@@ -155,25 +158,95 @@ def factor_cartesian(table):
 
 class ObserverSubject(object):
     """Subject class in the observer design pattern"""
+    __slots__ = ('_observers',)
+
     def __init__(self):
-        self._observers = []
+        ## The observer list is created when the first observer is attached
+        self._observers = ()
         
     def attach(self, observer, updatemethod='update'):
         """Attach observer that will be notified when an item changes"""
+        if not self._observers:
+            self._observers = []
         if not observer in self._observers:
             self._observers.append((observer, updatemethod))
 
     def detach(self, observer, updatemethod='update'):
-        try:
+        if (observer, updatemethod) in self._observers:
             self._observers.remove((observer, updatemethod))
-        except ValueError:
-            pass
 
     def notify(self, modifier=None, args=None):
+        pending = _batch_pending(self)
         for observer, updatemethodname in self._observers:
             if modifier != observer:
-                updatemethod = getattr(observer, updatemethodname)
-                updatemethod(self)
+                if pending is not None:
+                    key = id(self), id(observer), updatemethodname
+                    if key not in pending:
+                        pending[key] = self, observer, updatemethodname
+                else:
+                    updatemethod = getattr(observer, updatemethodname)
+                    updatemethod(self)
+
+## Notifications deferred by batch_notifications in each thread keyed by 
+## subject, observer and update method, and the deferred subjects keyed 
+## by id or None for all subjects
+_batch = threading.local()
+
+def _batch_pending(subject):
+    """Return the pending notifications if those of subject are deferred"""
+    pending = getattr(_batch, 'pending', None)
+    if pending is not None and \
+            (_batch.subjects is None or id(subject) in _batch.subjects):
+        return pending
+
+@contextlib.contextmanager
+def batch_notifications(subjects=None):
+    """Context manager that defers and coalesces observer notifications
+
+    Inside the block the notifications of the ObserverSubject objects in 
+    *subjects*, or of all objects if not given, are recorded instead of 
+    being sent. When the outermost block exits each observer update method 
+    is called once per subject. Notifications that are caused by these 
+    updates are coalesced in the same way. Only notifications sent by the
+    current thread are deferred.
+
+    >>> class Observer(object):
+    ...     def update(self, subject):
+    ...         print 'update'
+    >>> subject = ObserverSubject()
+    >>> subject.attach(Observer())
+    >>> with batch_notifications():
+    ...     subject.notify()
+    ...     subject.notify()
+    update
+
+    """
+    if subjects is not None:
+        subjects = dict((id(subject), subject) for subject in subjects)
+
+    if getattr(_batch, 'pending', None) is not None:
+        ## The subjects of a nested block are deferred until the outermost
+        ## block exits
+        if subjects is None:
+            _batch.subjects = None
+        elif _batch.subjects is not None:
+            _batch.subjects.update(subjects)
+        yield
+        return
+
+    _batch.pending = pending = OrderedDict()
+    _batch.subjects = subjects
+    try:
+        yield
+    finally:
+        try:
+            while pending:
+                key, (subject, observer, updatemethodname) = \
+                    pending.popitem(last=False)
+                getattr(observer, updatemethodname)(subject)
+        finally:
+            _batch.pending = None
+            _batch.subjects = None
 
 
 class TempDir(object):
@@ -3,9 +3,13 @@
 # See LICENSE for details.
 
 import copy
+import numbers
+import weakref
 import misc
 
 class Parameter(object):
+    __slots__ = ('name', 'desc', 'unit', 'default')
+
     def __init__(self, name, desc=None, unit=None, default=None):
         self.name = name
         self.desc = desc
@@ -18,6 +22,14 @@ class Parameter(object):
     def __hash__(self):
         return self.name.__hash__()
 
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in Parameter.__slots__ + 
+                    tuple(getattr(self, '__dict__', ())))
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def copy(self):
         return copy.copy(self)
 
@@ -33,49 +45,184 @@ class Parameter(object):
 
 class EvalError(Exception): pass
 
+## Code objects of parameter expressions keyed by the expression string
+_compiled_expressions = {}
+
+def compile_expression(expr):
+    """Compile a parameter expression
+
+    Returns the code object and the names the expression depends on. Each
+    distinct expression is only compiled once.
+
+    >>> code, names = compile_expression('2*a + b')
+    >>> names
+    ('a', 'b')
+    >>> eval(code, {'a': 1, 'b': 2})
+    4
+
+    """
+    try:
+        return _compiled_expressions[expr]
+    except KeyError:
+        code = compile(expr, '<parameter expression>', 'eval')
+        compiled = _compiled_expressions[expr] = code, code.co_names
+        return compiled
+
+## Marks names that are not found in any ParameterDict
+_missing = object()
+
+def _lookup(name, values):
+    """Find value of parameter in a sequence of ParameterDicts, the last 
+    one has the highest priority"""
+    for paramdict in reversed(values):
+        index = paramdict._schema.index.get(name)
+        if index is not None:
+            return paramdict._values[index]
+    return _missing
+
+def _evaluate(code, names, inputs):
+    return eval(code, dict((name, value) for name, value in zip(names, inputs)
+                           if value is not _missing))
+
+def _same_value(a, b):
+    """Return True if a and b are known to be equal
+
+    Only numbers and strings are compared by value, other objects such as
+    arrays and ParameterDicts are compared by identity.
+    """
+    if a is b:
+        return True
+    if type(a) is not type(b) or \
+            not isinstance(a, (numbers.Number, basestring)):
+        return False
+    try:
+        return bool(a == b)
+    except:
+        return False
+
+class ParameterSchema(object):
+    """Immutable ordered collection of Parameter objects
+
+    Schemas are cached so all ParameterDict objects that are created from 
+    the same Parameter objects, for example the instance parameters of 
+    all instances of a circuit class, share one schema. Only the values 
+    are stored per ParameterDict.
+
+    >>> a = ParameterSchema.get((Parameter('gm'), Parameter('gds')))
+    >>> a.names
+    ('gm', 'gds')
+    >>> a.extend((Parameter('gmb'),)).names
+    ('gm', 'gds', 'gmb')
+
+    """
+    __slots__ = ('parameterlist', 'names', 'parameters', 'index', 
+                 '__weakref__')
+
+    _cache = weakref.WeakValueDictionary()
+
+    @classmethod
+    def get(cls, parameters):
+        """Return the shared schema of a sequence of Parameter objects"""
+        parameters = tuple(parameters)
+
+        ## The schema holds references to the parameters so the ids stay 
+        ## unique as long as the schema is in the cache
+        key = tuple(id(param) for param in parameters)
+
+        schema = cls._cache.get(key)
+        if schema is None:
+            schema = cls._cache[key] = cls(parameters)
+        return schema
+
+    def __init__(self, parameters):
+        self.parameterlist = parameters
+        self.names = tuple(param.name for param in parameters)
+        self.parameters = dict(zip(self.names, parameters))
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+    def __reduce__(self):
+        return _get_schema, (self.parameterlist,)
+
+    def extend(self, parameters):
+        """Return schema with parameters appended"""
+        return ParameterSchema.get(self.parameterlist + tuple(parameters))
+
+    def replace(self, parameter):
+        """Return schema with the parameter of the same name replaced"""
+        parameters = list(self.parameterlist)
+        parameters[self.index[parameter.name]] = parameter
+        return ParameterSchema.get(parameters)
+
+def _get_schema(parameters):
+    """Return shared schema, used when unpickling ParameterSchema objects"""
+    return ParameterSchema.get(parameters)
+
 class ParameterDict(misc.ObserverSubject):
+    __slots__ = ('_schema', '_values', '_evaluated')
+
     def __init__(self, *parameters, **kvargs):
         super(ParameterDict, self).__init__()
-        self._paramnames = []
-        self._parameters = {}
-        self._values = {}
+        self._schema = ParameterSchema.get(())
+        self._values = []
+        self._evaluated = None
         self.append(*parameters)
         self.set(**kvargs)
 
+    @property
+    def _parameters(self):
+        return self._schema.parameters
+
+    @property
+    def _paramnames(self):
+        return self._schema.names
+
     def __eq__(self, a):
         return self._parameters == a._parameters
         
     def append(self, *parameters):
+        index = self._schema.index
+        newparameters = []
+        newnames = set()
         for param in parameters:
-            if param.name not in self._parameters:
-                self._parameters[param.name] = param
-                self._paramnames.append(param.name)
-                self._values[param.name] = param.default
-            else:
-                self._values[param.name] = param.default
+            if param.name not in index and param.name not in newnames:
+                newparameters.append(param)
+                newnames.add(param.name)
+
+        if newparameters:
+            self._schema = self._schema.extend(newparameters)
+            self._values.extend([None] * len(newparameters))
+
+        index = self._schema.index
+        for param in parameters:
+            self._values[index[param.name]] = param.default
 
         self.notify([param.name for param in parameters])
                 
     def set(self, **kvargs):
+        """Set parameter values, observers are only notified if a value 
+        has changed"""
+        index = self._schema.index
+        changed = []
         for k,v in kvargs.items():
-            if k not in self._values:
+            if k not in index:
                 raise KeyError('parameter %s not in parameter dictionary'%k )
-            self._values[k] = v
+            if not _same_value(self._values[index[k]], v):
+                self._values[index[k]] = v
+                changed.append(k)
             
-        self.notify(kvargs.keys())
+        if changed:
+            self.notify(changed)
 
     def get(self, param):
         """Get value by parameter object or parameter name"""
         if isinstance(param, Parameter):
-            return self._values[param.name]
-        else:
-            return self._values[param]
+            param = param.name
+        return self._values[self._schema.index[param]]
 
     def copy(self, *parameters, **kvargs):
         newpd = ParameterDict()
-        newpd._values = copy.copy(self._values)
-        newpd._parameters = copy.copy(self._parameters)
-        newpd._paramnames = copy.copy(self._paramnames)
+        newpd._schema = self._schema
+        newpd._values = list(self._values)
         newpd.append(*parameters)
         newpd.set(**kvargs)
 
@@ -84,6 +231,17 @@ class ParameterDict(misc.ObserverSubject):
     def __copy__(self):
         return self.copy()
 
+    def __getstate__(self):
+        ## The cache of evaluated expressions contains code objects
+        return dict((k, getattr(self, k)) 
+                    for k in ParameterDict.__slots__ + ('_observers',)
+                    if k != '_evaluated')
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_evaluated', None)
+        for k, v in state.items():
+            object.__setattr__(self, k, v)
+
     def eval_expressions(self, values, parameters=None, ignore_errors=False):
         """Evaluate expressions using parameter values from other ParameterDicts
         
@@ -101,24 +259,21 @@ class ParameterDict(misc.ObserverSubject):
         """
         out = ParameterDict(*self.parameters)
 
-        ## Create a substition dictionary
-        substdict = {}
-        for paramdict in values:
-            if paramdict != None:
-                for param in paramdict.parameters:
-                    substdict[param.name] = paramdict.get(param)
+        values = [paramdict for paramdict in values if paramdict != None]
 
         if parameters == None:
             parameters = self.keys()
 
-        updated_values = {}
         for paramname in parameters:
             expr = self.get(paramname)
 
             if expr != None:
                 try:
                     if isinstance(expr, str):
-                        value = eval(expr, substdict)
+                        code, names = compile_expression(expr)
+                        value = _evaluate(code, names, 
+                                          [_lookup(name, values) 
+                                           for name in names])
                     else:
                         value = expr
                 except:
@@ -130,8 +285,79 @@ class ParameterDict(misc.ObserverSubject):
 
         return out
 
+    def update_evaluated(self, target, values, ignore_errors=False):
+        """Evaluate expressions and update the changed values in target
+
+        This gives the same values in *target* as 
+        target.update_values(self.eval_expressions(values)) but an 
+        expression is only evaluated again if the expression itself or the 
+        values of the parameters it depends on have changed since the 
+        last call. Only the parameters of *target* whose values have 
+        changed are set, so observers of target are not notified if 
+        nothing has changed.
+
+        Returns a list of the names of the changed parameters.
+
+        >>> expr = ParameterDict(Parameter('gm'), Parameter('gds'), 
+        ...                      gm='2*a', gds='b')
+        >>> ab = ParameterDict(Parameter('a'), Parameter('b'), a=1, b=2)
+        >>> target = ParameterDict(Parameter('gm'), Parameter('gds'))
+        >>> expr.update_evaluated(target, (ab,))
+        ['gm', 'gds']
+        >>> ab.a = 2
+        >>> expr.update_evaluated(target, (ab,))
+        ['gm']
+        >>> target.gm, target.gds
+        (4, 2)
+
+        """
+        values = [paramdict for paramdict in values if paramdict != None]
+
+        if self._evaluated is None:
+            self._evaluated = {}
+        evaluated = self._evaluated
+
+        changed = []
+        newvalues = {}
+        for param, expr in zip(self._schema.parameterlist, self._values):
+            name = param.name
+            if isinstance(expr, str):
+                try:
+                    code, names = compile_expression(expr)
+                except SyntaxError:
+                    code, names = None, ()
+                inputs = [_lookup(dependency, values) for dependency in names]
+
+                cached = evaluated.get(name)
+                if cached is not None and cached[0] == expr and \
+                        all(_same_value(a, b) 
+                            for a, b in zip(cached[1], inputs)):
+                    value = cached[2]
+                else:
+                    try:
+                        value = _evaluate(code, names, inputs)
+                    except:
+                        if not ignore_errors:
+                            msg = "Can't evaluate %s (%s)" % (name, expr)
+                            raise EvalError(msg)
+                        value = param.default
+                    evaluated[name] = expr, inputs, value
+            elif expr != None:
+                value = expr
+            else:
+                value = param.default
+
+            if not _same_value(target.get(name), value):
+                changed.append(name)
+                newvalues[name] = value
+
+        if newvalues:
+            target.set(**newvalues)
+
+        return changed
+
     def keys(self):
-        return [param.name for param in self.parameters]
+        return list(self._schema.names)
     
     def items(self):
         return [(param.name, getattr(self, param.name)) 
@@ -139,7 +365,7 @@ class ParameterDict(misc.ObserverSubject):
 
     def update_values(self, d):
         """Update values from another paramdict"""
-        self.set(**d._values)
+        self.set(**dict(zip(d._schema.names, d._values)))
 
     def __getitem__(self, key):
         return self._parameters[key]
@@ -148,22 +374,23 @@ class ParameterDict(misc.ObserverSubject):
         if key not in self._parameters:
             self.append(parameter)
         else:
-            self._parameters[key] = parameter
-            self._values[key] = parameter.default
+            self._schema = self._schema.replace(parameter)
+            self._values[self._schema.index[key]] = parameter.default
 
     def __getattr__(self, key):
-        if key != '_parameters' and hasattr(self, '_parameters') and \
-                key in self._parameters:
-            return self._values[key]
+        if key != '_schema' and key in self._schema.index:
+            return self._values[self._schema.index[key]]
         else:
-            return self.__dict__[key]
+            raise AttributeError(key)
 
     def __setattr__(self, key, value):
-        if hasattr(self, '_parameters') and key in self._parameters:
-            self._values[key] = value
-            self.notify(args=(key,))
+        schema = getattr(self, '_schema', None)
+        if schema is not None and key in schema.index:
+            if not _same_value(self._values[schema.index[key]], value):
+                self._values[schema.index[key]] = value
+                self.notify(args=(key,))
         else:
-            self.__dict__[key] = value
+            object.__setattr__(self, key, value)
     
     def __contains__(self, key):
         if isinstance(key, Parameter):
@@ -176,4 +403,4 @@ class ParameterDict(misc.ObserverSubject):
 
     @property
     def parameters(self):
-        return [self._parameters[name] for name in self._paramnames]
+        return list(self._schema.parameterlist)
@@ -86,3 +86,25 @@ def test_ObserverSubject_notify():
 
     assert_equal(b.value, None)
     assert_equal(b.value1, ('update1', a, 10))
+
+def test_ObserverSubject_attach():
+    """Test attaching observers to a plain subject and a ParameterDict"""
+    from pycircuit.utilities.param import ParameterDict
+
+    class Observer(object):
+        def __init__(self):
+            self.subjects = []
+
+        def update(self, subject):
+            self.subjects.append(subject)
+
+    for subject in ObserverSubject(), ParameterDict():
+        observer = Observer()
+        subject.attach(observer)
+        subject.notify()
+        assert_equal(observer.subjects, [subject])
+        subject.detach(observer)
+        subject.notify()
+        assert_equal(observer.subjects, [subject])
+
+    assert not hasattr(ParameterDict(), '__dict__')
@@ -198,3 +198,37 @@ def test_update_parameterdict():
     assert_equal(paramdict1.gm, 30)
     assert_equal(paramdict2.gm, 30)
     
+
+def test_shared_schema():
+    """ParameterDicts created from the same parameters share the schema"""
+    gm = Parameter(name="gm", default=1e-3)
+    gds = Parameter(name="gds", default=1e-6)
+    
+    paramdict1 = ParameterDict(gm, gds)
+    paramdict2 = ParameterDict(gm, gds, gm=2e-3)
+
+    assert paramdict1._schema is paramdict2._schema
+    assert_equal(paramdict1.gm, 1e-3)
+    assert_equal(paramdict2.gm, 2e-3)
+
+    ## Changing one dictionary does not affect the other
+    paramdict2.append(Parameter(name="gmb", default=0))
+    assert 'gmb' in paramdict2
+    assert 'gmb' not in paramdict1
+    assert_equal(paramdict1.keys(), ['gm', 'gds'])
+
+    paramdict3 = paramdict1.copy()
+    assert paramdict3._schema is paramdict1._schema
+    paramdict3.gds = 2e-6
+    assert_equal(paramdict1.gds, 1e-6)
+
+def test_pickle_parameterdict():
+    import pickle
+
+    gm = Parameter(name="gm", default=1e-3)
+    paramdict = ParameterDict(gm, gm=2e-3)
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        paramdict2 = pickle.loads(pickle.dumps(paramdict, protocol))
+        assert_equal(paramdict2, paramdict)
+        assert_equal(paramdict2.gm, 2e-3)